@@ -10,8 +10,9 @@ from tornado import gen
 from tornado.gen import Return
 from tornado.iostream import StreamClosedError
 
-from .core import Server, read, write, rpc, pingpong, send_recv
-from .utils import ignoring, ignore_exceptions, All, get_ip
+from .core import (Server, read, write, rpc, pingpong,
+        broadcast_to_workers)
+from .utils import ignoring, ignore_exceptions, get_ip
 
 
 logger = logging.getLogger(__name__)
@@ -38,6 +39,8 @@ class Center(Server):
         Number of cores per worker
     *   ``nannies:: {worker: port}``
         The port of the nanny process for a particular worker
+    *   ``resources:: {worker: {resource: quantity}}``
+        Abstract resources declared by workers, like ``{'GPU': 2}``
 
     Workers and clients check in with the Center to discover available resources
 
@@ -87,13 +90,15 @@ class Center(Server):
         self.has_what = defaultdict(set)
         self.ncores = dict()
         self.nannies = dict()
+        self.resources = dict()
         self.status = None
 
         d = {func.__name__: func
              for func in [self.add_keys, self.remove_keys, self.get_who_has,
                           self.get_has_what, self.register, self.get_ncores,
                           self.unregister, self.delete_data, self.terminate,
-                          self.get_nannies, self.broadcast]}
+                          self.get_nannies, self.get_resources,
+                          self.broadcast]}
         d = {k[len('get_'):] if k.startswith('get_') else k: v for k, v in
                 d.items()}
         d['ping'] = pingpong
@@ -110,12 +115,14 @@ class Center(Server):
         return b'OK'
 
     def register(self, stream, address=None, keys=(), ncores=None,
-                 nanny_port=None):
+                 nanny_port=None, resources=None):
         self.has_what[address] = set(keys)
         for key in keys:
             self.who_has[key].add(address)
         self.ncores[address] = ncores
         self.nannies[address] = nanny_port
+        if resources:
+            self.resources[address] = resources
         logger.info("Register %s", str(address))
         return b'OK'
 
@@ -127,6 +134,7 @@ class Center(Server):
             del self.ncores[address]
         with ignoring(KeyError):
             del self.nannies[address]
+        self.resources.pop(address, None)
         for key in keys:
             s = self.who_has[key]
             s.remove(address)
@@ -173,6 +181,12 @@ class Center(Server):
         else:
             return self.nannies
 
+    def get_resources(self, stream, addresses=None):
+        if addresses is not None:
+            return {k: self.resources.get(k, {}) for k in addresses}
+        else:
+            return self.resources
+
     @gen.coroutine
     def delete_data(self, stream, keys=None):
         who_has2 = {k: v for k, v in self.who_has.items() if k in keys}
@@ -195,9 +209,16 @@ class Center(Server):
         raise Return(b'OK')
 
     @gen.coroutine
-    def broadcast(self, stream, msg=None):
-        """ Broadcast message to workers, return all results """
-        workers = list(self.ncores)
-        results = yield All([send_recv(ip=ip, port=port, close=True, **msg)
-                             for ip, port in workers])
-        raise Return(dict(zip(workers, results)))
+    def broadcast(self, stream, msg=None, workers=None):
+        """ Broadcast message to workers, return all results
+
+        Send to all workers, or only to ``workers`` if given.  Large
+        messages travel along a tree of workers.  See
+        ``broadcast_to_workers``.
+        """
+        if workers is None:
+            workers = list(self.ncores)
+        else:
+            workers = [tuple(w) for w in workers]
+        results = yield broadcast_to_workers(workers, msg)
+        raise Return(results)
@@ -4,6 +4,7 @@ from collections import Iterable, defaultdict
 from itertools import count, cycle
 import random
 import socket
+from time import time
 import uuid
 
 from tornado import gen
@@ -14,6 +15,7 @@ from tornado.iostream import StreamClosedError
 from toolz import merge, concat, groupby, drop
 
 from .core import rpc, coerce_to_rpc
+from .sizeof import sizeof
 from .utils import ignore_exceptions, ignoring, All
 
 
@@ -75,13 +77,24 @@ _gather.__doc__ = gather.__doc__
 
 
 @gen.coroutine
-def gather_from_workers(who_has):
+def gather_from_workers(who_has, ip=None, transfers=None, bandwidth=None,
+                        limit=None, who=None):
     """ Gather data directly from peers
 
     Parameters
     ----------
     who_has: dict
         Dict mapping keys to sets of workers that may have that key
+    ip: str, optional
+        Our own host, peers on this host are preferred
+    transfers: dict, optional
+        Number of active transfers from each peer, updated in place
+    bandwidth: dict, optional
+        Measured bytes per second from each peer, updated in place
+    limit: tornado.locks.Semaphore, optional
+        Bounds the number of concurrent transfers
+    who: tuple, optional
+        Our own address, if we are a worker fetching from a peer
 
     Returns dict mapping key to value
 
@@ -89,10 +102,13 @@ def gather_from_workers(who_has):
     --------
     gather
     _gather
+    pick_source
     """
     bad_addresses = set()
     who_has = who_has.copy()
     results = dict()
+    if transfers is None:
+        transfers = dict()
 
     while len(results) < len(who_has):
         d = defaultdict(list)
@@ -101,17 +117,18 @@ def gather_from_workers(who_has):
         for key, addresses in who_has.items():
             if key in results:
                 continue
-            try:
-                addr = random.choice(list(addresses - bad_addresses))
-                d[addr].append(key)
-                rev[key] = addr
-            except IndexError:
+            addresses = addresses - bad_addresses
+            if not addresses:
                 bad_keys.add(key)
+                continue
+            addr = pick_source(addresses, ip, transfers, bandwidth)
+            d[addr].append(key)
+            rev[key] = addr
         if bad_keys:
             raise KeyError(*bad_keys)
 
-        coroutines = [rpc(ip=ip, port=port).get_data(keys=keys, close=True)
-                            for (ip, port), keys in d.items()]
+        coroutines = [_get_data(addr, keys, transfers, bandwidth, limit, who)
+                      for addr, keys in d.items()]
         response = yield ignore_exceptions(coroutines, socket.error,
                                                        StreamClosedError)
         response = merge(response)
@@ -121,6 +138,67 @@ def gather_from_workers(who_has):
     raise Return(results)
 
 
+def pick_source(addresses, ip=None, transfers=None, bandwidth=None):
+    """ Choose the peer from which to fetch a piece of data
+
+    Prefer peers on our own host, then peers with the fewest active
+    transfers, then peers with the highest measured bandwidth.  Peers that
+    we have not measured yet count as fast as the best measured peer, so
+    that we try them out.  Break remaining ties randomly so that load
+    spreads across equal peers.
+
+    >>> pick_source({('alice', 8000), ('bob', 8000)}, ip='bob')
+    ('bob', 8000)
+    >>> pick_source({('alice', 8000), ('bob', 8000)},
+    ...             transfers={('alice', 8000): 2})
+    ('bob', 8000)
+    >>> pick_source({('alice', 8000), ('bob', 8000)},
+    ...             bandwidth={('alice', 8000): 1e9, ('bob', 8000): 1e6})
+    ('alice', 8000)
+    >>> source = pick_source({('alice', 8000), ('bob', 8000),
+    ...                       ('charlie', 8000)},
+    ...                      bandwidth={('alice', 8000): 1e9,
+    ...                                 ('charlie', 8000): 1e6})
+    >>> source in {('alice', 8000), ('bob', 8000)}  # bob is not measured
+    True
+    """
+    transfers = transfers or {}
+    bandwidth = bandwidth or {}
+    unmeasured = max(bandwidth.values()) if bandwidth else 0
+    return min(addresses, key=lambda addr: (addr[0] != ip,
+                                            transfers.get(addr, 0),
+                                            -bandwidth.get(addr, unmeasured),
+                                            random.random()))
+
+
+@gen.coroutine
+def _get_data(addr, keys, transfers, bandwidth=None, limit=None, who=None):
+    """ Get keys from one peer, tracking active transfers and bandwidth
+
+    Workers pass their own address as ``who`` so that the peer counts the
+    request against its limit on outgoing transfers.
+    """
+    if limit is not None:
+        yield limit.acquire()
+    transfers[addr] = transfers.get(addr, 0) + 1
+    start = time()
+    try:
+        result = yield rpc(ip=addr[0], port=addr[1]).get_data(keys=keys,
+                                                              who=who,
+                                                              close=True)
+    finally:
+        transfers[addr] -= 1
+        if not transfers[addr]:
+            del transfers[addr]
+        if limit is not None:
+            limit.release()
+    if bandwidth is not None and result:
+        nbytes = sum(map(sizeof, result.values()))
+        rate = nbytes / max(time() - start, 1e-6)
+        bandwidth[addr] = (bandwidth.get(addr, rate) + rate) / 2
+    raise Return(result)
+
+
 class WrappedKey(object):
     """ Interface for a key in a dask graph.
 
@@ -4,11 +4,13 @@ import sys
 
 if sys.version_info[0] == 2:
     from Queue import Queue
+    from itertools import izip
     reload = reload
 
 if sys.version_info[0] == 3:
     from queue import Queue
     from importlib import reload
+    izip = zip
 
 
 try:
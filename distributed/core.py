@@ -9,7 +9,7 @@ import struct
 from time import sleep, time
 import uuid
 
-from toolz import assoc, first
+from toolz import assoc, first, merge
 import tornado
 import pickle
 import cloudpickle
@@ -20,8 +20,25 @@ from tornado.tcpclient import TCPClient
 from tornado.ioloop import IOLoop
 from tornado.iostream import IOStream, StreamClosedError
 
+from .utils import All
+
 
 def dumps(x):
+    """ Serialize with the C pickler if we can, or else with cloudpickle
+
+    The C pickler is much faster on plain data, like messages that carry
+    tasks already serialized to bytes.  Whenever it raises, as it does for
+    lambdas, closures and other functions that it can't find by name, we
+    use cloudpickle instead.  The C pickler doesn't raise for functions and
+    classes in ``__main__`` but pickles them by a name that other processes
+    can't import, so those go through cloudpickle too.
+    """
+    try:
+        result = pickle.dumps(x, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        result = None
+    if result is not None and b'__main__' not in result:
+        return result
     try:
         return cloudpickle.dumps(x, protocol=pickle.HIGHEST_PROTOCOL)
     except Exception as e:
@@ -51,6 +68,9 @@ def get_total_physical_memory():
 
 MAX_BUFFER_SIZE = get_total_physical_memory()
 
+BROADCAST_FANOUT = 4        # children of each server in a broadcast tree
+BROADCAST_TREE_NBYTES = 1e6  # send messages with larger payloads along a tree
+
 
 def handle_signal(sig, frame):
     IOLoop.instance().add_callback(IOLoop.instance().stop)
@@ -254,6 +274,101 @@ def send_recv_sync(stream=None, ip=None, port=None, reply=True, **kwargs):
                               **kwargs))
 
 
+def spanning_tree(nodes, fanout=BROADCAST_FANOUT):
+    """ Arrange nodes in a tree where each node has at most ``fanout`` children
+
+    Returns the children of a root that is not among the nodes, as a list of
+    ``(node, subtree)`` pairs.  The tree is about ``log(n, fanout)`` deep.
+
+    >>> spanning_tree([1, 2, 3, 4, 5, 6], fanout=2)
+    [(1, [(3, []), (5, [])]), (2, [(4, []), (6, [])])]
+    """
+    nodes = list(nodes)
+    children = nodes[:fanout]
+    rest = nodes[fanout:]
+    return [(child, spanning_tree(rest[i::fanout], fanout))
+            for i, child in enumerate(children)]
+
+
+def tree_nodes(tree):
+    """ All nodes of a tree made by ``spanning_tree``
+
+    >>> tree_nodes([(1, [(3, []), (5, [])]), (2, [(4, []), (6, [])])])
+    [1, 3, 5, 2, 4, 6]
+    """
+    return [n for node, subtree in tree
+              for n in [node] + tree_nodes(subtree)]
+
+
+@gen.coroutine
+def send_to_subtree(node, subtree, msg):
+    """ Send a message to one server and, through it, to its subtree
+
+    With a ``subtree`` of ``None`` we send ``msg`` to the server directly.
+    Otherwise the server handles it with its ``relay`` handler.  Returns a
+    dict mapping address to result.
+
+    If the server fails then we cannot tell which servers below it received
+    the message, so every server of the subtree maps to the exception.
+    """
+    node = tuple(node)
+    ip, port = node
+    try:
+        if subtree is None:
+            result = yield send_recv(ip=ip, port=port, close=True, **msg)
+            results = {node: result}
+        else:
+            results = yield send_recv(ip=ip, port=port, close=True,
+                                      op='relay', msg=msg, tree=subtree)
+    except Exception as e:
+        failed = [node] + [tuple(n) for n in tree_nodes(subtree or [])]
+        logger.warn("Failed to send %s to %s and %d servers below it: %s",
+                    msg.get('op'), node, len(failed) - 1, e)
+        results = {n: e for n in failed}
+    raise Return(results)
+
+
+@gen.coroutine
+def relay(tree, msg):
+    """ Send a message down a tree of servers, collect all of their results
+
+    Each server handles the message with its ``relay`` handler, which passes
+    it on to its own subtree.  Returns a dict mapping address to result.
+    Servers that we failed to reach map to the exception.
+
+    See Also
+    --------
+    spanning_tree
+    broadcast_to_workers
+    """
+    results = yield All([send_to_subtree(node, subtree, msg)
+                         for node, subtree in tree])
+    raise Return(merge(results))
+
+
+@gen.coroutine
+def broadcast_to_workers(workers, msg, fanout=BROADCAST_FANOUT,
+                         tree_nbytes=BROADCAST_TREE_NBYTES):
+    """ Send a message to many workers, return a dict of their results
+
+    We send small messages to every worker ourselves.  Messages whose bytes
+    payload exceeds ``tree_nbytes`` go along a spanning tree instead: we send
+    to ``fanout`` workers, each of which handles the message and forwards
+    it to ``fanout`` more, so that no one machine sends every copy.
+
+    Workers that fail, or that we cannot reach because a worker above them
+    failed, map to the exception rather than to a result.
+    """
+    workers = list(workers)
+    nbytes = sum(len(v) for v in msg.values() if isinstance(v, bytes))
+    if len(workers) <= fanout or nbytes <= tree_nbytes:
+        results = yield All([send_to_subtree(w, None, msg) for w in workers])
+        raise Return(merge(results))
+    else:
+        results = yield relay(spanning_tree(workers, fanout), msg)
+        raise Return(results)
+
+
 class rpc(object):
     """ Conveniently interact with a remote server
 
@@ -17,6 +17,12 @@ from ..utils import sync, ignoring, key_split, is_kernel
 logger = logging.getLogger(__name__)
 
 
+def flush_futures(keys):
+    """ Send buffered graph updates for any futures among keys """
+    for executor in {k.executor for k in keys if hasattr(k, 'executor')}:
+        executor.loop.add_callback(executor._flush)
+
+
 def get_scheduler(scheduler):
     if scheduler is None:
         scheduler = default_executor().scheduler
@@ -32,6 +38,8 @@ class ProgressBar(object):
     def __init__(self, keys, scheduler=None, interval=0.1, complete=True):
         self.scheduler = get_scheduler(scheduler)
 
+        keys = list(keys)
+        flush_futures(keys)
         self.keys = {k.key if hasattr(k, 'key') else k for k in keys}
         self.interval = interval
         self.complete = complete
@@ -148,6 +156,8 @@ class MultiProgressBar(object):
     def __init__(self, keys, scheduler=None, func=key_split, interval=0.1, complete=False):
         self.scheduler = get_scheduler(scheduler)
 
+        keys = list(keys)
+        flush_futures(keys)
         self.keys = {k.key if hasattr(k, 'key') else k for k in keys}
         self.func = func
         self.interval = interval
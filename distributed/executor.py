@@ -1,20 +1,22 @@
 from __future__ import print_function, division, absolute_import
 
-from collections import defaultdict
+from collections import defaultdict, deque
 from concurrent.futures._base import DoneAndNotDoneFutures, CancelledError
 from concurrent import futures
 from functools import wraps, partial
+from hashlib import md5
 import itertools
 import logging
 import os
+from threading import RLock
 from time import sleep
 import uuid
 
 import dask
 from dask.base import tokenize, normalize_token, Base
-from dask.core import flatten
+from dask.core import flatten, get_dependencies, toposort
 from dask.compatibility import apply
-from toolz import first, groupby, merge
+from toolz import first, groupby, identity, merge, valmap
 from tornado import gen
 from tornado.gen import Return
 from tornado.locks import Event
@@ -22,9 +24,13 @@ from tornado.ioloop import IOLoop, PeriodicCallback
 from tornado.iostream import StreamClosedError, IOStream
 from tornado.queues import Queue
 
-from .client import (WrappedKey, unpack_remotedata, pack_data)
-from .core import read, write, connect, rpc, coerce_to_rpc
-from .scheduler import Scheduler
+from .client import (WrappedKey, unpack_remotedata, pack_data,
+        gather_from_workers)
+from .compatibility import izip
+from .core import (read, write, connect, rpc, coerce_to_rpc, dumps,
+        broadcast_to_workers)
+from .scheduler import Scheduler, graph_dependencies
+from .sizeof import sizeof
 from .utils import All, sync, funcname, ignoring
 
 logger = logging.getLogger(__name__)
@@ -32,6 +38,10 @@ logger = logging.getLogger(__name__)
 
 _global_executor = [None]
 
+FLUSH_INTERVAL = 0.005  # seconds to buffer messages before sending
+GRAPH_CHUNKSIZE = 100000  # send larger graphs in pieces of this many tasks
+IMAP_MAXSIZE = 1000  # tasks in flight at once in Executor.imap
+
 
 class Future(WrappedKey):
     """ A remotely running computation
@@ -94,6 +104,7 @@ class Future(WrappedKey):
 
     @gen.coroutine
     def _result(self, raiseit=True):
+        self.executor._flush()
         try:
             d = self.executor.futures[self.key]
         except KeyError:
@@ -117,6 +128,7 @@ class Future(WrappedKey):
 
     @gen.coroutine
     def _exception(self):
+        self.executor._flush()
         yield self.event.wait()
         if self.status == 'error':
             exception = self.executor.futures[self.key]['exception']
@@ -139,6 +151,7 @@ class Future(WrappedKey):
 
     @gen.coroutine
     def _traceback(self):
+        self.executor._flush()
         yield self.event.wait()
         if self.status == 'error':
             raise Return(self.executor.futures[self.key]['traceback'])
@@ -182,6 +195,10 @@ class Executor(object):
         This can be the address of a ``Center`` or ``Scheduler`` servers, either
         as a string ``'127.0.0.1:8787'`` or tuple ``('127.0.0.1', 8787)``
         or it can be a local ``Scheduler`` object.
+    direct_to_workers: bool
+        Whether to gather results straight from the workers that hold them.
+        Set to ``False`` if this process can reach the scheduler but not the
+        workers, in which case the scheduler relays all results.
 
     Examples
     --------
@@ -207,12 +224,20 @@ class Executor(object):
     --------
     distributed.scheduler.Scheduler: Internal scheduler
     """
-    def __init__(self, address, start=True, loop=None):
+    def __init__(self, address, start=True, loop=None,
+                 direct_to_workers=True):
         self.futures = dict()
         self.refcount = defaultdict(lambda: 0)
         self.loop = loop or IOLoop()
         self.coroutines = []
         self._start_arg = address
+        self._pending_messages = []
+        # Reentrant, since Future.__del__ may release a key from within
+        # a buffering or sending call on the same thread
+        self._pending_lock = RLock()
+        self._flush_scheduled = False
+        self._sending_graph = False
+        self.direct_to_workers = direct_to_workers
 
         if start:
             self.start()
@@ -233,15 +258,143 @@ class Executor(object):
         sync(self.loop, self._start, **kwargs)
 
     def _send_to_scheduler(self, msg):
+        """ Send message to scheduler, buffering graph updates and releases
+
+        Consecutive ``update-graph`` messages are merged into one, as are
+        consecutive ``release-held-data`` messages, so that releasing many
+        futures at once sends one message with many keys.  Buffered messages
+        are sent after ``FLUSH_INTERVAL`` seconds, or sooner if we gather
+        results or send any other message.  Messages always arrive in the
+        order sent.  They are always written from the event loop, so this is
+        safe to call from any thread.
+
+        See Also
+        --------
+        Executor._flush
+        """
+        with self._pending_lock:
+            pending = self._pending_messages
+            if msg['op'] in ('update-graph', 'release-held-data'):
+                if pending and pending[-1]['op'] == msg['op']:
+                    if msg['op'] == 'update-graph':
+                        merge_graph_updates(pending[-1], msg)
+                    else:
+                        pending[-1]['keys'].extend(msg['keys'])
+                elif msg['op'] == 'update-graph':
+                    pending.append(msg)
+                else:
+                    pending.append(dict(msg, keys=list(msg['keys'])))
+                if not self._flush_scheduled:
+                    self._flush_scheduled = True
+                    self.loop.add_callback(self.loop.call_later,
+                                           FLUSH_INTERVAL, self._flush)
+                return
+            pending.append(msg)
+        self.loop.add_callback(self._flush)
+
+    def _flush(self):
+        """ Send all buffered messages to the scheduler
+
+        Call this on the event loop, from other threads use
+        ``loop.add_callback``.  The pieces of a large graph go out from
+        ``_send_graph_pieces``.  Messages buffered behind them wait until it
+        has sent them all.
+        """
+        with self._pending_lock:
+            self._flush_scheduled = False
+            pending = self._pending_messages
+            while pending and not self._sending_graph:
+                msg = pending.pop(0)
+                if msg['op'] == 'graph-pieces':
+                    self._sending_graph = True
+                    self.loop.add_callback(self._send_graph_pieces,
+                                           msg['messages'])
+                else:
+                    self._send_now(msg)
+
+    def _send_graph(self, dsk, dependencies, keys, restrictions=None,
+                    chunksize=None):
+        """ Send a graph to the scheduler, in pieces if it is large
+
+        Graphs with more than ``chunksize`` tasks are split in topological
+        order and sent as several ``update-graph`` messages, so that the
+        scheduler can start on the first pieces while we serialize the rest.
+        Each piece is serialized only once the one before it has been
+        written.  Keys that later pieces need are sent as their dependencies
+        only, we never ask for them by name.  Each piece lists them as its
+        ``boundary`` so that the scheduler does not fuse them away.
+
+        See Also
+        --------
+        split_graph
+        Executor._send_graph_pieces
+        """
+        restrictions = restrictions or {}
+        chunksize = chunksize or GRAPH_CHUNKSIZE
+        if len(dsk) <= chunksize:
+            self._send_to_scheduler({'op': 'update-graph',
+                                    'dsk': valmap(dumps, dsk),
+                                    'keys': keys,
+                                    'dependencies': dependencies,
+                                    'restrictions': restrictions})
+            return
+
+        keys = set(keys)
+        chunks = split_graph(dsk, dependencies, chunksize)
+        pieces = []
+        for i, (chunk, boundary) in enumerate(chunks):
+            chunk_keys = [k for k in chunk if k in keys]
+            if i == len(chunks) - 1:
+                chunk_keys.extend(k for k in keys if k not in dsk)
+            pieces.append((chunk, chunk_keys, list(boundary)))
+
+        def messages():
+            for i, (chunk, chunk_keys, boundary) in enumerate(pieces):
+                logger.debug("Send graph piece %d of %d", i + 1, len(pieces))
+                yield {'op': 'update-graph',
+                       'dsk': {k: dumps(dsk[k]) for k in chunk},
+                       'keys': chunk_keys,
+                       'dependencies': {k: dependencies[k] for k in chunk},
+                       'restrictions': {k: restrictions[k] for k in chunk
+                                        if k in restrictions},
+                       'boundary': boundary}
+
+        with self._pending_lock:
+            self._pending_messages.append({'op': 'graph-pieces',
+                                           'messages': messages()})
+        self.loop.add_callback(self._flush)
+
+    @gen.coroutine
+    def _send_graph_pieces(self, messages):
+        """ Send messages one at a time, waiting until each is written
+
+        This keeps one serialized piece of a large graph in memory at a time
+        and lets the event loop run between pieces.
+        """
+        try:
+            for msg in messages:
+                future = self._send_now(msg)
+                yield future if future is not None else gen.moment
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            with self._pending_lock:
+                self._sending_graph = False
+            self._flush()
+
+    def _send_now(self, msg):
+        """ Send one message to the scheduler, on the event loop """
         if isinstance(self.scheduler, Scheduler):
             self.loop.add_callback(self.scheduler_queue.put_nowait, msg)
         elif isinstance(self.scheduler_stream, IOStream):
-            write(self.scheduler_stream, msg)
+            return write(self.scheduler_stream, msg)
         else:
             raise NotImplementedError()
 
     @gen.coroutine
     def _start(self, **kwargs):
+        # Buffered messages flush on the loop that runs us
+        self.loop = IOLoop.current()
         if isinstance(self._start_arg, Scheduler):
             self.scheduler = self._start_arg
             self.center = self._start_arg.center
@@ -383,6 +536,9 @@ class Executor(object):
         workers: set, iterable of sets
             A set of worker hostnames on which computations may be performed.
             Leave empty to default to all workers (common case)
+        resources: dict (optional)
+            Abstract resources that the task needs while it runs, like
+            ``{'GPU': 1}``.  It only runs on a worker that has them free.
 
         Examples
         --------
@@ -403,6 +559,7 @@ class Executor(object):
         pure = kwargs.pop('pure', True)
         workers = kwargs.pop('workers', None)
         allow_other_workers = kwargs.pop('allow_other_workers', False)
+        resources = kwargs.pop('resources', None)
 
         if allow_other_workers not in (True, False, None):
             raise TypeError("allow_other_workers= must be True or False")
@@ -433,14 +590,17 @@ class Executor(object):
             restrictions = {}
             loose_restrictions = set()
 
-        task2, _ = unpack_remotedata(task)
+        task2, deps = unpack_remotedata(task)
 
         logger.debug("Submit %s(...), %s", funcname(func), key)
         self._send_to_scheduler({'op': 'update-graph',
-                                'dsk': {key: task2},
+                                'dsk': {key: dumps(task2)},
                                 'keys': [key],
+                                'dependencies': {key: deps},
                                 'restrictions': restrictions,
-                                'loose_restrictions': loose_restrictions})
+                                'loose_restrictions': loose_restrictions,
+                                'resources': {key: resources} if resources
+                                             else {}})
 
         return Future(key, self)
 
@@ -459,6 +619,9 @@ class Executor(object):
         workers: set, iterable of sets
             A set of worker hostnames on which computations may be performed.
             Leave empty to default to all workers (common case)
+        resources: dict (optional)
+            Abstract resources that each task needs while it runs, like
+            ``{'GPU': 1}``
 
         Examples
         --------
@@ -475,6 +638,7 @@ class Executor(object):
         pure = kwargs.pop('pure', True)
         workers = kwargs.pop('workers', None)
         allow_other_workers = kwargs.pop('allow_other_workers', False)
+        resources = kwargs.pop('resources', None)
 
         if allow_other_workers and workers is None:
             raise ValueError("Only use allow_other_workers= if using workers=")
@@ -497,7 +661,10 @@ class Executor(object):
             dsk = {key: (apply, func, args, kwargs)
                    for key, args in zip(keys, zip(*iterables))}
 
-        dsk = {key: unpack_remotedata(task)[0] for key, task in dsk.items()}
+        dependencies = dict()
+        for key, task in dsk.items():
+            task, dependencies[key] = unpack_remotedata(task)
+            dsk[key] = dumps(task)
 
         if isinstance(workers, str):
             workers = [workers]
@@ -525,15 +692,84 @@ class Executor(object):
         self._send_to_scheduler({'op': 'update-graph',
                                 'dsk': dsk,
                                 'keys': keys,
+                                'dependencies': dependencies,
                                 'restrictions': restrictions,
-                                'loose_restrictions': loose_restrictions})
+                                'loose_restrictions': loose_restrictions,
+                                'resources': {key: resources for key in keys}
+                                             if resources else {}})
 
         return [Future(key, self) for key in keys]
 
+    def imap(self, func, *iterables, **kwargs):
+        """ Lazily map a function over iterables, with bounded work in flight
+
+        Unlike ``map`` this pulls arguments from the iterables only as
+        results come back and keeps at most ``maxsize`` tasks on the cluster
+        at once.  The iterables may be larger than memory or unbounded.
+        This yields results rather than futures, and releases each task once
+        its result is yielded.  Errors raise when their result is reached.
+
+        Parameters
+        ----------
+        func: callable
+        iterables: Iterables
+        maxsize: int
+            Most tasks in flight at once, defaults to ``IMAP_MAXSIZE``
+        ordered: bool (defaults to True)
+            Yield results in input order.  Set ``ordered=False`` to yield
+            results in the order in which they finish.
+        **kwargs: dict
+            Other keywords like ``pure=`` and ``workers=`` as in ``map``
+
+        Examples
+        --------
+        >>> for result in executor.imap(func, records):  # doctest: +SKIP
+        ...     store(result)
+
+        See also
+        --------
+        Executor.map: Submit a whole sequence at once
+        """
+        maxsize = kwargs.pop('maxsize', IMAP_MAXSIZE)
+        ordered = kwargs.pop('ordered', True)
+        if not callable(func):
+            raise TypeError("First input to imap must be a callable function")
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1, got %s" % maxsize)
+        return self._imap(func, izip(*iterables), maxsize, ordered, kwargs)
+
+    def _imap(self, func, args, maxsize, ordered, kwargs):
+        """ Generator behind imap, which checks its arguments eagerly """
+        from .compatibility import Queue
+        queue = Queue()
+        pending = deque()
+
+        while True:
+            chunk = list(itertools.islice(args, maxsize - len(pending)))
+            if chunk:
+                futures = self.map(func, *zip(*chunk), **kwargs)
+                pending.extend(futures)
+                if not ordered:
+                    self.loop.add_callback(_as_completed, futures, queue)
+                del futures
+            if not pending:
+                return
+            if ordered:
+                future = pending.popleft()
+            else:
+                future = queue.get()
+                pending.remove(future)
+            result = future.result()
+            del future
+            yield result
+
     @gen.coroutine
-    def _gather(self, futures):
+    def _gather(self, futures, direct=None):
+        self._flush()
         futures2, keys = unpack_remotedata(futures)
         keys = list(keys)
+        if direct is None:
+            direct = self.direct_to_workers
 
         while True:
             logger.debug("Waiting on futures to clear before gather")
@@ -544,6 +780,19 @@ class Executor(object):
             if exceptions:
                 raise exceptions[0]
 
+            if direct:
+                if isinstance(self.scheduler, Scheduler):
+                    who_has = self.scheduler.get_who_has(None, keys=keys)
+                else:
+                    who_has = yield self.scheduler.who_has(keys=keys)
+                try:
+                    data = yield gather_from_workers(who_has)
+                    break
+                except KeyError as e:
+                    # Lost data or unreachable workers, let the scheduler
+                    # decide which keys are really missing
+                    logger.debug("Couldn't gather keys directly %s", e)
+
             response, data = yield self.scheduler.gather(keys=keys)
 
             if response == b'error':
@@ -558,10 +807,13 @@ class Executor(object):
         result = pack_data(futures2, data)
         raise gen.Return(result)
 
-    def gather(self, futures):
+    def gather(self, futures, direct=None):
         """ Gather futures from distributed memory
 
-        Accepts a future or any nested core container of futures
+        Accepts a future or any nested core container of futures.  Data moves
+        straight from the workers to this process unless ``direct=False``
+        or the executor was created with ``direct_to_workers=False``, in which
+        case the scheduler relays it.
 
         Examples
         --------
@@ -577,11 +829,16 @@ class Executor(object):
         --------
         Executor.scatter: Send data out to cluster
         """
-        return sync(self.loop, self._gather, futures)
+        return sync(self.loop, self._gather, futures, direct=direct)
 
     @gen.coroutine
-    def _scatter(self, data, workers=None):
-        remotes = yield self.scheduler.scatter(data=data, workers=workers)
+    def _scatter(self, data, workers=None, direct=None, broadcast=False):
+        if direct is None:
+            direct = self.direct_to_workers
+        if not direct:
+            remotes = yield self.scheduler.scatter(data=data, workers=workers)
+        else:
+            remotes = yield self._scatter_direct(data, workers=workers)
         if isinstance(remotes, list):
             remotes = [Future(r.key, self) for r in remotes]
             keys = {r.key for r in remotes}
@@ -593,9 +850,46 @@ class Executor(object):
             self.futures[key]['status'] = 'finished'
             self.futures[key]['event'].set()
 
+        if broadcast:
+            yield self.scheduler.replicate(keys=list(keys), workers=workers)
+
         raise gen.Return(remotes)
 
-    def scatter(self, data, workers=None):
+    @gen.coroutine
+    def _scatter_direct(self, data, workers=None):
+        """ Send data straight to workers, telling the scheduler where
+
+        The scheduler chooses workers from the size of each piece of data,
+        see ``Scheduler.scatter_plan``.  Only locations and sizes pass
+        through the scheduler, never the data itself.
+        """
+        if isinstance(data, dict):
+            names = list(data)
+            data2 = data
+        else:
+            key = str(uuid.uuid1())
+            names = ['%s-%d' % (key, i) for i in range(len(data))]
+            data2 = dict(zip(names, data))
+
+        plan = yield gen.maybe_future(self.scheduler.scatter_plan(
+                nbytes=valmap(sizeof, data2), workers=workers))
+        placement = plan['workers']
+        groups = groupby(placement.get, names)
+        out = yield All([rpc(ip=w[0], port=w[1]).update_data(
+                                data={k: data2[k] for k in keys},
+                                close=True, report=plan['report'])
+                         for w, keys in groups.items()])
+        nbytes = merge([o[1]['nbytes'] for o in out])
+        yield gen.maybe_future(self.scheduler.update_data(
+                who_has={k: [w] for k, w in placement.items()},
+                nbytes=nbytes))
+
+        if isinstance(data, dict):
+            raise gen.Return({k: WrappedKey(k) for k in names})
+        else:
+            raise gen.Return([WrappedKey(k) for k in names])
+
+    def scatter(self, data, workers=None, direct=None, broadcast=False):
         """ Scatter data into distributed memory
 
         Accepts a list of data elements or dict of key-value pairs
@@ -603,6 +897,14 @@ class Executor(object):
         Optionally provide a set of workers to constrain the scatter.  Specify
         workers as hostname/port pairs, e.g. ``('127.0.0.1', 8787)``.
 
+        Data goes straight to workers chosen by the scheduler, favoring those
+        with little data in memory, unless ``direct=False`` or the executor
+        was created with ``direct_to_workers=False``.  Then the data passes
+        through the scheduler.
+
+        Use ``broadcast=True`` to put a copy of each piece of data on every
+        worker, or on every one of ``workers``, as with ``replicate``.
+
         Examples
         --------
         >>> e = Executor('127.0.0.1:8787')  # doctest: +SKIP
@@ -617,23 +919,97 @@ class Executor(object):
 
         >>> e.scatter([1, 2, 3], workers=[('hostname', 8788)])  # doctest: +SKIP
 
+        Send a lookup table to every worker
+
+        >>> [table] = e.scatter([table], broadcast=True)  # doctest: +SKIP
+
         See Also
         --------
         Executor.gather: Gather data back to local process
+        Executor.replicate: Copy existing data onto more workers
+        """
+        return sync(self.loop, self._scatter, data, workers=workers,
+                    direct=direct, broadcast=broadcast)
+
+    @gen.coroutine
+    def _replicate(self, futures, n=None, workers=None):
+        futures = list(futures)
+        yield _wait(futures)
+        keys = list({f.key for f in futures})
+        yield self.scheduler.replicate(keys=keys, n=n, workers=workers)
+
+    def replicate(self, futures, n=None, workers=None):
+        """ Copy data onto many workers
+
+        Tasks that use the data can then run on any of those workers without
+        first moving it.  Workers copy the data from each other along a tree,
+        so that no one worker has to send every copy.
+
+        Parameters
+        ----------
+        futures: list of Futures
+        n: int (optional)
+            Number of workers that should hold each piece of data.  Defaults
+            to all of them.
+        workers: list of worker addresses (optional)
+            Only copy onto these workers
+
+        Examples
+        --------
+        >>> x = e.submit(func, *args)  # doctest: +SKIP
+        >>> e.replicate([x])  # doctest: +SKIP
+        >>> e.replicate([x], n=3)  # doctest: +SKIP
+
+        See Also
+        --------
+        Executor.scatter
+        """
+        return sync(self.loop, self._replicate, futures, n=n, workers=workers)
+
+    @gen.coroutine
+    def _rebalance(self, futures=None, workers=None):
+        keys = None
+        if futures is not None:
+            futures = list(futures)
+            yield _wait(futures)
+            keys = list({f.key for f in futures})
+        yield self.scheduler.rebalance(keys=keys, workers=workers)
+
+    def rebalance(self, futures=None, workers=None):
+        """ Even out memory use across workers
+
+        Data that tasks produced tends to stay near the data they started
+        from, so a few workers can end up holding most of it.  This moves
+        data from workers with more than their share of bytes to those with
+        less, directly between workers.
+
+        Parameters
+        ----------
+        futures: list of Futures (optional)
+            Only move these.  Defaults to all data.
+        workers: list of worker addresses (optional)
+            Only move data between these workers
+
+        Examples
+        --------
+        >>> e.rebalance()  # doctest: +SKIP
+        >>> e.rebalance(futures, workers=[alice, bob])  # doctest: +SKIP
+
+        See Also
+        --------
+        Executor.replicate
         """
-        return sync(self.loop, self._scatter, data, workers=workers)
+        return sync(self.loop, self._rebalance, futures, workers=workers)
 
     @gen.coroutine
-    def _get(self, dsk, keys, restrictions=None, raise_on_error=True):
+    def _get(self, dsk, keys, restrictions=None, raise_on_error=True,
+             chunksize=None):
         flatkeys = list(flatten([keys]))
         futures = {key: Future(key, self) for key in flatkeys}
-        dsk2 = {k: unpack_remotedata(v)[0] for k, v in dsk.items()}
-        dsk3 = {k: v for k, v in dsk2.items() if (k == v) is not True}
+        dsk3, dependencies = unpack_graph(dsk)
 
-        self._send_to_scheduler({'op': 'update-graph',
-                                'dsk': dsk3,
-                                'keys': flatkeys,
-                                'restrictions': restrictions or {}})
+        self._send_graph(dsk3, dependencies, flatkeys, restrictions,
+                         chunksize=chunksize)
 
         packed = pack_data(keys, futures)
         if raise_on_error:
@@ -656,6 +1032,9 @@ class Executor(object):
         restrictions: dict (optional)
             A mapping of {key: {set of worker hostnames}} that restricts where
             jobs can take place
+        chunksize: int (optional)
+            Send graphs with more tasks than this in pieces, defaults to
+            ``GRAPH_CHUNKSIZE``
 
         Examples
         --------
@@ -685,6 +1064,9 @@ class Executor(object):
             Collections like dask.array or dataframe or dask.value objects
         sync: bool (optional)
             Returns Futures if False (default) or concrete values if True
+        chunksize: int (optional)
+            Send graphs with more tasks than this in pieces, defaults to
+            ``GRAPH_CHUNKSIZE``
 
         Returns
         -------
@@ -710,6 +1092,7 @@ class Executor(object):
         Executor.get: Normal synchronous dask.get function
         """
         sync = kwargs.pop('sync', False)
+        chunksize = kwargs.pop('chunksize', None)
         assert not kwargs
         if sync:
             return dask.compute(*args, get=self.get)
@@ -723,11 +1106,9 @@ class Executor(object):
         names = ['finalize-%s' % tokenize(v) for v in variables]
         dsk2 = {name: (v._finalize, v._keys()) for name, v in zip(names, variables)}
 
-        dsk3 = {k: unpack_remotedata(v)[0] for k, v in merge(dsk, dsk2).items()}
+        dsk3, dependencies = unpack_graph(merge(dsk, dsk2))
 
-        self._send_to_scheduler({'op': 'update-graph',
-                                'dsk': dsk3,
-                                'keys': names})
+        self._send_graph(dsk3, dependencies, names, chunksize=chunksize)
 
         i = 0
         futures = []
@@ -761,9 +1142,19 @@ class Executor(object):
         with open(filename, 'rb') as f:
             data = f.read()
         _, fn = os.path.split(filename)
+        checksum = md5(data).hexdigest()
         d = yield self.center.broadcast(msg={'op': 'upload_file',
                                              'filename': fn,
-                                             'data': data})
+                                             'checksum': checksum})
+        missing = [w for w, v in d.items() if v is None]
+        if missing:
+            msg = {'op': 'upload_file', 'filename': fn, 'checksum': checksum,
+                   'data': data}
+            if self.direct_to_workers:
+                d2 = yield broadcast_to_workers(missing, msg)
+            else:
+                d2 = yield self.center.broadcast(msg=msg, workers=missing)
+            d.update(d2)
 
         if any(isinstance(v, Exception) for v in d.values()):
             exception = next(v for v in d.values() if isinstance(v, Exception))
@@ -781,6 +1172,9 @@ class Executor(object):
         into a temporary directory on Python's system path so any .py or .egg
         files will be importable.
 
+        Workers cache files by the hash of their contents, so we only send
+        the file to workers that have not seen this version of it yet.
+
         Parameters
         ----------
         filename: string
@@ -802,6 +1196,8 @@ class Executor(object):
 def _wait(fs, timeout=None, return_when='ALL_COMPLETED'):
     if timeout is not None:
         raise NotImplementedError("Timeouts not yet supported")
+    for executor in {f.executor for f in fs}:
+        executor._flush()
     if return_when == 'ALL_COMPLETED':
         yield All({f.event.wait() for f in fs})
         done, not_done = set(fs), set()
@@ -832,6 +1228,8 @@ def wait(fs, timeout=None, return_when='ALL_COMPLETED'):
 
 @gen.coroutine
 def _as_completed(fs, queue):
+    for executor in {f.executor for f in fs}:
+        executor._flush()
     groups = groupby(lambda f: f.key, fs)
     firsts = [v[0] for v in groups.values()]
     wait_iterator = gen.WaitIterator(*[f.event.wait() for f in firsts])
@@ -870,6 +1268,87 @@ def as_completed(fs):
         yield queue.get()
 
 
+def unpack_graph(dsk):
+    """ Replace futures in a graph with their keys, find dependencies
+
+    Returns the new graph without self-references, and a mapping from each
+    key to the keys on which it depends, either within the graph or futures.
+    Aliases of other keys become calls to ``identity``, because workers
+    receive tasks serialized and would take the bare key for data.
+
+    >>> dsk = {'x': 1, 'y': (inc, 'x'), 'z': 'z'}  # doctest: +SKIP
+    >>> unpack_graph(dsk)  # doctest: +SKIP
+    ({'x': 1, 'y': (inc, 'x')}, {'x': set(), 'y': {'x'}})
+    """
+    dsk2 = dict()
+    dependencies = dict()
+    for k, v in dsk.items():
+        v, futures = unpack_remotedata(v)
+        if (k == v) is not True:
+            dsk2[k] = v
+            dependencies[k] = futures
+    for k, v in dsk2.items():
+        try:
+            if v in dsk2 or v in dependencies[k]:  # alias of another key
+                dsk2[k] = (identity, v)
+        except TypeError:  # not hashable
+            pass
+        dependencies[k] |= get_dependencies(dsk2, k)
+    return dsk2, dependencies
+
+
+def split_graph(dsk, dependencies, chunksize):
+    """ Split a graph into pieces of ``chunksize`` tasks in topological order
+
+    Every task comes after its dependencies.  Returns a list of pairs of the
+    keys in each piece and the keys of that piece that later pieces need.
+
+    >>> dsk = {'x': 1, 'y': (inc, 'x'), 'z': (inc, 'y')}  # doctest: +SKIP
+    >>> dependencies = {'x': set(), 'y': {'x'}, 'z': {'y'}}
+    >>> split_graph(dsk, dependencies, 2)  # doctest: +SKIP
+    [(['x', 'y'], {'y'}), (['z'], set())]
+    """
+    ordered = toposort(dsk, dependencies=graph_dependencies(dsk, dependencies))
+    chunks = [ordered[i:i + chunksize]
+              for i in range(0, len(ordered), chunksize)]
+    index = {key: i for i, chunk in enumerate(chunks) for key in chunk}
+    boundaries = [set() for chunk in chunks]
+    for i, chunk in enumerate(chunks):
+        for key in chunk:
+            for dep in dependencies[key]:
+                if index.get(dep, i) < i:
+                    boundaries[index[dep]].add(dep)
+    return list(zip(chunks, boundaries))
+
+
+def merge_graph_updates(msg, other):
+    """ Merge the second ``update-graph`` message into the first, in place
+
+    >>> a = {'op': 'update-graph', 'dsk': {'x': 1}, 'keys': ['x']}
+    >>> b = {'op': 'update-graph', 'dsk': {'y': (inc, 'x')},  # doctest: +SKIP
+    ...      'keys': ['y'], 'restrictions': {'y': ['alice']}}
+    >>> merge_graph_updates(a, b)  # doctest: +SKIP
+    {'op': 'update-graph',
+     'dsk': {'x': 1, 'y': (inc, 'x')},
+     'keys': ['x', 'y'],
+     'restrictions': {'y': ['alice']},
+     'loose_restrictions': set()}
+    """
+    msg['dsk'].update(other['dsk'])
+    msg['keys'] = list(msg['keys']) + list(other['keys'])
+    if 'dependencies' in msg or 'dependencies' in other:
+        msg['dependencies'] = merge(msg.get('dependencies') or {},
+                                    other.get('dependencies') or {})
+    msg['restrictions'] = merge(msg.get('restrictions') or {},
+                                other.get('restrictions') or {})
+    msg['loose_restrictions'] = (set(msg.get('loose_restrictions') or ()) |
+                                 set(other.get('loose_restrictions') or ()))
+    if 'resources' in msg or 'resources' in other:
+        msg['resources'] = merge(msg.get('resources') or {},
+                                 other.get('resources') or {})
+    return msg
+
+
 def default_executor(e=None):
     """ Return an executor if exactly one has started """
     if e:
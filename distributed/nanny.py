@@ -23,10 +23,12 @@ class Nanny(Server):
     them as necessary.
     """
     def __init__(self, center_ip, center_port, ip=None,
-                ncores=None, loop=None, local_dir=None, **kwargs):
+                ncores=None, loop=None, local_dir=None, resources=None,
+                **kwargs):
         self.ip = ip or get_ip()
         self.worker_port = None
         self.ncores = ncores
+        self.resources = resources
         self.local_dir = local_dir
         self.worker_dir = ''
         self.status = None
@@ -95,7 +97,8 @@ class Nanny(Server):
         self.process = Process(target=run_worker,
                                args=(q, self.ip, self.center.ip,
                                      self.center.port, self.ncores,
-                                     self.port, self.local_dir))
+                                     self.port, self.local_dir,
+                                     self.resources))
         self.process.daemon = True
         self.process.start()
         while True:
@@ -174,7 +177,7 @@ class Nanny(Server):
 
 
 def run_worker(q, ip, center_ip, center_port, ncores, nanny_port,
-        local_dir):
+        local_dir, resources=None):
     """ Function run by the Nanny when creating the worker """
     from distributed import Worker
     from tornado.ioloop import IOLoop
@@ -182,7 +185,8 @@ def run_worker(q, ip, center_ip, center_port, ncores, nanny_port,
     loop = IOLoop()
     loop.make_current()
     worker = Worker(center_ip, center_port, ncores=ncores, ip=ip,
-                    nanny_port=nanny_port, local_dir=local_dir)
+                    nanny_port=nanny_port, local_dir=local_dir,
+                    resources=resources)
 
     @gen.coroutine
     def start():
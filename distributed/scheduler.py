@@ -1,15 +1,18 @@
 from __future__ import print_function, division, absolute_import
 
-from collections import defaultdict, deque
+from collections import defaultdict, deque, MutableMapping, MutableSet, Set
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from functools import partial
+import heapq
+from itertools import islice
 import logging
 from math import ceil
 import socket
 from time import time
 import uuid
 
-from toolz import frequencies, memoize, concat, identity, valmap
+from toolz import frequencies, memoize, concat, valmap, merge, first
 from tornado import gen
 from tornado.gen import Return
 from tornado.queues import Queue
@@ -20,15 +23,22 @@ from dask.core import istask, get_deps, reverse_dict
 from dask.order import order
 
 from .core import (rpc, coerce_to_rpc, connect, read, write, MAX_BUFFER_SIZE,
-        Server, send_recv)
-from .client import unpack_remotedata, scatter_to_workers, gather_from_workers
+        Server, broadcast_to_workers)
+from .client import (unpack_remotedata, scatter_to_workers,
+        gather_from_workers)
 from .utils import (All, ignoring, clear_queue, _deps, get_ip,
-        ignore_exceptions, ensure_ip)
+        ignore_exceptions, ensure_ip, key_split, execute_task)
 
 
 logger = logging.getLogger(__name__)
 
 
+BANDWIDTH = 100e6           # assumed bytes per second between workers
+DEFAULT_TASK_DURATION = 0.5  # assumed seconds per task of unknown prefix
+SPECULATIVE_FACTOR = 4      # how many times its estimate before a task lags
+SPECULATIVE_MINIMUM = 0.1   # seconds a task runs before it may lag
+
+
 class Scheduler(Server):
     """ Dynamic distributed task scheduler
 
@@ -63,6 +73,12 @@ class Scheduler(Server):
 
     **State**
 
+    We keep what we know about each key in one ``TaskState`` object.  The
+    per-key entries below are dictionary and set views onto these objects,
+    see ``TaskStateMapping`` and ``TaskStateSet``.
+
+    * **tasks:** ``{key: TaskState}``:
+        Everything we know about each key
     * **dask:** ``{key: task}``:
         Dask graph of all computations to perform
     * **dependencies:** ``{key: {key}}``:
@@ -83,8 +99,8 @@ class Scheduler(Server):
         What worker has what keys.  The transpose of who_has.
     * **processing:** ``{worker: {keys}}``:
         Set of keys currently in execution on each worker
-    * **stacks:** ``{worker: [keys]}``:
-        List of keys waiting to be sent to each worker
+    * **stacks:** ``{worker: PriorityStack}``:
+        Keys waiting to be sent to each worker, popped in order of keyorder
     * **retrictions:** ``{key: {hostnames}}``:
         A set of hostnames per key of where that key can be run.  Usually this
         is empty unless a key has been specifically restricted to only run on
@@ -93,6 +109,21 @@ class Scheduler(Server):
     * **loose_retrictions:** ``{key}``:
         Set of keys for which we are allow to violate restrictions (see above)
         if not valid workers are present.
+    * **hosts:** ``{hostname: {workers}}``:
+        Workers running on each host, used to apply restrictions
+    * **resources:** ``{worker: {resource: quantity}}``:
+        Abstract resources, like ``{'GPU': 2}``, declared by each worker
+    * **available_resources:** ``{worker: {resource: quantity}}``:
+        Resources of each worker not used by the tasks it is processing
+    * **resource_restrictions:** ``{key: {resource: quantity}}``:
+        Resources that a task needs while it runs.  It only runs on workers
+        with enough available resources.
+    * **resource_blocked:** ``{worker: {resource: PriorityStack}}``:
+        Tasks taken off a worker's stack while it lacked a resource they
+        need.  They go back on the stack once running tasks free it.
+    * **unrunnable:** ``{key}``:
+        Ready tasks that need resources which no current worker has.  They
+        wait here until such a worker arrives, see ``Scheduler.add_worker``.
     * **held_data:** ``{key}``:
         A set of keys that we are not allowed to garbage collect
     * **in_play:** ``{key}``:
@@ -100,6 +131,23 @@ class Scheduler(Server):
         key that will eventually be in memory.
     * **keyorder:** ``{key: tuple}``:
         A score per key that determines its priority
+    * **fused:** ``{key: [(key, task)]}``:
+        Tasks of a linear chain that run, in order, just before its last key.
+        Only used if the scheduler was created with ``fuse=True``.
+    * **task_duration:** ``{key-prefix: float}``:
+        Running average of compute time for tasks sharing a key prefix
+    * **task_start:** ``{key: float}``:
+        When each processing task was last sent to a worker
+    * **speculative:** ``{key: {worker}}``:
+        Workers running copies of a straggling task that we duplicated.
+        The first copy to finish wins.  At most ``speculative_limit`` tasks
+        are duplicated at once, none by default.
+    * **losing_copies:** ``{worker: {keys}}``:
+        Copies of duplicated tasks that lost the race but still run on a
+        worker.  They keep their place in ``processing`` and their resources
+        until the worker reports back.
+    * **steal_log:** ``deque``:
+        Recent work stealing decisions as ``(time, key, victim, thief)``
     * **scheduler_queues:** ``[Queues]``:
         A list of Tornado Queues from which we accept stimuli
     * **report_queues:** ``[Queues]``:
@@ -125,6 +173,8 @@ class Scheduler(Server):
     def __init__(self, center=None, loop=None,
             resource_interval=1, resource_log_size=1000,
             max_buffer_size=MAX_BUFFER_SIZE, delete_interval=500,
+            steal_interval=100, steal_log_size=1000,
+            background_graph_size=10000, fuse=False, speculative_limit=0,
             ip=None, **kwargs):
         self.scheduler_queues = [Queue()]
         self.report_queues = []
@@ -133,35 +183,55 @@ class Scheduler(Server):
         self.coroutines = []
         self.ip = ip or get_ip()
         self.delete_interval = delete_interval
+        self.steal_interval = steal_interval
+        self.background_graph_size = background_graph_size
+        self._graph_thread = None
+        self.fuse = fuse
+        self.speculative_limit = speculative_limit
 
         if center:
             self.center = coerce_to_rpc(center)
         else:
             self.center = None
 
-        self.dask = dict()
-        self.dependencies = dict()
-        self.dependents = dict()
+        self.tasks = tasks = dict()
+        self.dask = TaskStateMapping(tasks, 'task', NO_VALUE)
+        self.dependencies = TaskStateMapping(tasks, 'dependencies')
+        self.dependents = TaskStateMapping(tasks, 'dependents')
+        self.fused = TaskStateMapping(tasks, 'fused')
         self.generation = 0
         self.has_what = defaultdict(set)
-        self.held_data = set()
-        self.in_play = set()
-        self.keyorder = dict()
-        self.nbytes = dict()
+        self.held_data = TaskStateSet(tasks, 'held')
+        self.hosts = defaultdict(set)
+        self.resources = dict()
+        self.available_resources = dict()
+        self.resource_blocked = dict()
+        self.unrunnable = set()
+        self.resource_restrictions = TaskStateMapping(tasks,
+                                                      'resource_restrictions')
+        self.in_play = TaskStateSet(tasks, 'in_play')
+        self.keyorder = TaskStateMapping(tasks, 'keyorder')
+        self.nbytes = TaskStateMapping(tasks, 'nbytes')
         self.ncores = dict()
         self.nannies = dict()
         self.processing = dict()
-        self.restrictions = dict()
-        self.loose_restrictions = set()
+        self.restrictions = TaskStateMapping(tasks, 'restrictions')
+        self.loose_restrictions = TaskStateSet(tasks, 'loose_restrictions')
         self.stacks = dict()
-        self.waiting = dict()
-        self.waiting_data = dict()
-        self.who_has = defaultdict(set)
+        self.waiting = TaskStateMapping(tasks, 'waiting')
+        self.waiting_data = TaskStateMapping(tasks, 'waiting_data')
+        self.who_has = TaskStateMapping(tasks, 'who_has', default=set)
+        self.worker_queues = dict()
         self.deleted_keys = defaultdict(set)
-
-        self.exceptions = dict()
-        self.tracebacks = dict()
-        self.exceptions_blame = dict()
+        self.task_duration = dict()
+        self.task_start = TaskStateMapping(tasks, 'start')
+        self.speculative = dict()
+        self.losing_copies = defaultdict(set)
+        self.steal_log = deque(maxlen=steal_log_size)
+
+        self.exceptions = TaskStateMapping(tasks, 'exception')
+        self.tracebacks = TaskStateMapping(tasks, 'traceback', NO_VALUE)
+        self.exceptions_blame = TaskStateMapping(tasks, 'exception_blame')
         self.resource_logs = dict()
 
         self.loop = loop or IOLoop.current()
@@ -174,7 +244,7 @@ class Scheduler(Server):
 
         self.plugins = []
 
-        self.compute_handlers = {'update-graph': self.update_graph,
+        self.compute_handlers = {'update-graph': self.handle_update_graph,
                                  'update-data': self.update_data,
                                  'missing-data': self.mark_missing_data,
                                  'release-held-data': self.release_held_data,
@@ -182,6 +252,10 @@ class Scheduler(Server):
 
         self.handlers = {'start-control': self.control_stream,
                          'scatter': self.scatter,
+                         'scatter_plan': self.scatter_plan,
+                         'replicate': self.replicate,
+                         'rebalance': self.rebalance,
+                         'update_data': self.update_data,
                          'register': self.add_worker,
                          'unregister': self.remove_worker,
                          'gather': self.gather,
@@ -220,11 +294,15 @@ class Scheduler(Server):
     @gen.coroutine
     def sync_center(self):
         """ Connect to center, determine available workers """
-        self.ncores, self.has_what, self.who_has, self.nannies = yield [
+        (self.ncores, self.has_what, who_has, self.nannies,
+         self.resources) = yield [
                 self.center.ncores(),
                 self.center.has_what(),
                 self.center.who_has(),
-                self.center.nannies()]
+                self.center.nannies(),
+                self.center.resources()]
+        self.who_has.clear()
+        self.who_has.update(who_has)
 
         self._nanny_coroutines = []
         for (ip, wport), nport in self.nannies.items():
@@ -240,12 +318,20 @@ class Scheduler(Server):
         collections = [self.dask, self.dependencies, self.dependents,
                 self.waiting, self.waiting_data, self.in_play, self.keyorder,
                 self.nbytes, self.processing, self.restrictions,
-                self.loose_restrictions]
+                self.loose_restrictions, self.resource_restrictions,
+                self.task_start, self.speculative, self.losing_copies,
+                self.resource_blocked, self.unrunnable]
         for collection in collections:
             collection.clear()
 
         self.processing = {addr: set() for addr in self.ncores}
-        self.stacks = {addr: list() for addr in self.ncores}
+        self.stacks = {addr: PriorityStack(self.keyorder)
+                       for addr in self.ncores}
+        self.hosts.clear()
+        for addr in self.ncores:
+            self.hosts[addr[0]].add(addr)
+        self.available_resources = {addr: dict(r)
+                                    for addr, r in self.resources.items()}
 
         self.worker_queues = {addr: Queue() for addr in self.ncores}
 
@@ -260,6 +346,14 @@ class Scheduler(Server):
                                  io_loop=self.loop)
         self._delete_periodic_callback.start()
 
+        with ignoring(AttributeError):
+            self._steal_periodic_callback.stop()
+        self._steal_periodic_callback = \
+                PeriodicCallback(callback=self.work_steal,
+                                 callback_time=self.steal_interval,
+                                 io_loop=self.loop)
+        self._steal_periodic_callback.start()
+
         self.heal_state()
 
         self.status = 'running'
@@ -292,6 +386,8 @@ class Scheduler(Server):
         if self.center:
             yield self.center.close(close=True)
             self.center.close_streams()
+        if self._graph_thread is not None:
+            self._graph_thread.shutdown()
         self.status = 'closed'
 
     @gen.coroutine
@@ -302,6 +398,8 @@ class Scheduler(Server):
 
         self.status = 'closing'
         logger.debug("Cleaning up coroutines")
+        with ignoring(AttributeError):
+            self._steal_periodic_callback.stop()
         n = 0
         for w, nc in self.ncores.items():
             for i in range(nc):
@@ -325,63 +423,236 @@ class Scheduler(Server):
         Scheduler.ensure_occupied
         """
         logger.debug("Mark %s ready to run", key)
-        if key in self.waiting:
-            assert not self.waiting[key]
-            del self.waiting[key]
-
-        new_worker = decide_worker(self.dependencies, self.stacks,
-                self.who_has, self.restrictions, self.loose_restrictions,
-                self.nbytes, key)
-
+        tasks = self.tasks
+        ts = tasks[key]
+        assert not ts.waiting
+        ts.waiting = None
+
+        deps = ts.dependencies
+        new_worker = decide_worker({key: deps}, self.stacks,
+                {dep: tasks[dep].who_has or EMPTY for dep in deps},
+                self.restrictions, self.loose_restrictions,
+                {dep: tasks[dep].nbytes for dep in deps}, key, self.hosts,
+                self.resources, self.resource_restrictions)
+
+        if new_worker is None:
+            logger.info("No worker has resources for %s, wait for one", key)
+            self.unrunnable.add(key)
+            return
         self.stacks[new_worker].append(key)
         self.ensure_occupied(new_worker)
 
+    def place_ready_task(self, key):
+        """ Send a single ready task to a worker
+
+        This is a lightweight version of ``seed_ready_tasks`` for the common
+        case of one task at a time, as from ``Executor.submit``.  Tasks with
+        dependencies or restrictions go through ``decide_worker``, other
+        tasks are assigned round robin, as in ``assign_many_tasks``.
+
+        See Also
+        --------
+        Scheduler.seed_ready_tasks
+        Scheduler.mark_ready_to_run
+        """
+        ts = self.tasks[key]
+        if (ts.dependencies or ts.restrictions is not None or
+            ts.resource_restrictions is not None):
+            self.mark_ready_to_run(key)
+        else:
+            ts.waiting = None
+            workers = list(self.stacks)
+            worker = workers[_round_robin[0] % len(workers)]
+            _round_robin[0] += 1
+            self.stacks[worker].append(key)
+            self.ensure_occupied(worker)
+
     def mark_key_in_memory(self, key, workers=None):
         """ Mark that a key now lives in distributed memory """
         logger.debug("Mark %s in memory", key)
+        tasks = self.tasks
+        ts = tasks.get(key)
+        if ts is None:
+            ts = tasks[key] = TaskState(key)
+        if ts.who_has is None:
+            ts.who_has = set()
         if workers is None:
-            workers = self.who_has[key]
+            workers = ts.who_has
         for worker in workers:
-            self.who_has[key].add(worker)
+            ts.who_has.add(worker)
             self.has_what[worker].add(key)
-            with ignoring(KeyError):
+            if key in self.processing.get(worker, ()):
                 self.processing[worker].remove(key)
-
-        for dep in sorted(self.dependents.get(key, []), key=self.keyorder.get,
-                          reverse=True):
-            if dep in self.waiting:
-                s = self.waiting[dep]
-                with ignoring(KeyError):
-                    s.remove(key)
+                self.release_resources(key, worker)
+        ts.start = None
+
+        for dep in list(ts.dependents or ()):
+            s = tasks[dep].waiting
+            if s is not None:
+                if s:
+                    s.discard(key)
                 if not s:  # new task ready to run
                     self.mark_ready_to_run(dep)
 
-        for dep in self.dependencies.get(key, []):
-            if dep in self.waiting_data:
-                s = self.waiting_data[dep]
-                with ignoring(KeyError):
-                    s.remove(key)
-                if not s and dep and dep not in self.held_data:
+        for dep in ts.dependencies or ():
+            dts = tasks[dep]
+            s = dts.waiting_data
+            if s is not None:
+                if s:
+                    s.discard(key)
+                if not s and dep and not dts.held:
                     self.delete_data(keys=[dep])
 
         self.report({'op': 'key-in-memory',
                      'key': key,
                      'workers': workers})
 
+        if (ts.in_play and not ts.held and
+                not ts.waiting_data):  # released while computing
+            self.delete_data(keys=[key])
+
     def ensure_occupied(self, worker):
         """ Send tasks to worker while it has tasks and free cores """
         logger.debug('Ensure worker is occupied: %s', worker)
-        while (self.stacks[worker] and
-               self.ncores[worker] > len(self.processing[worker])):
-            key = self.stacks[worker].pop()
-            self.processing[worker].add(key)
-            logger.debug("Send job to worker: %s, %s, %s", worker, key, self.dask[key])
-            self.worker_queues[worker].put_nowait(
-                    {'op': 'compute-task',
-                     'key': key,
-                     'task': self.dask[key],
-                     'who_has': {dep: self.who_has[dep] for dep in
-                                 self.dependencies[key]}})
+        stack = self.stacks[worker]
+        tasks = self.tasks
+        while stack and self.ncores[worker] > len(self.processing[worker]):
+            key, count = stack.popitem()
+            ts = tasks[key]
+            missing = {dep for dep in ts.dependencies
+                           if not tasks[dep].who_has}
+            if missing:  # dependencies lost since this task became ready
+                logger.debug("Task %s lost dependencies %s", key, missing)
+                ts.waiting = missing
+                lost = {dep for dep in missing if not tasks[dep].in_play}
+                if lost:  # nothing else will compute these
+                    self.recompute(lost)
+                continue
+            required = ts.resource_restrictions
+            if required is not None:
+                available = self.available_resources.get(worker, {})
+                if not has_resources(available, required):
+                    self.block(worker, key, count, available)
+                    continue
+                for resource, quantity in required.items():
+                    available[resource] -= quantity
+            ts.start = time()
+            self.send_task(worker, key)
+
+    def block(self, worker, key, count, available):
+        """ Set aside a task until its worker has the resources to run it
+
+        The task waits on the first resource it lacks.  ``count`` is its
+        place on the stack, which it keeps when it comes back.
+
+        See Also
+        --------
+        Scheduler.unblock
+        """
+        resource = first(r for r, q in self.resource_restrictions[key].items()
+                           if available.get(r, 0) < q)
+        blocked = self.resource_blocked.setdefault(worker, dict())
+        if resource not in blocked:
+            blocked[resource] = PriorityStack(self.keyorder)
+        blocked[resource].append(key, count)
+
+    def unblock(self, worker, resources):
+        """ Return tasks to the stack of a worker that freed ``resources``
+
+        We take tasks waiting on each freed resource in priority order while
+        what is available could run them, without charging for them yet.
+        Tasks still short of another resource wait on that one instead.
+
+        See Also
+        --------
+        Scheduler.block
+        """
+        blocked = self.resource_blocked.get(worker)
+        if not blocked:
+            return
+        available = dict(self.available_resources[worker])
+        for resource in resources:
+            waiting = blocked.get(resource)
+            short = []
+            while waiting and available.get(resource, 0) > 0:
+                key, count = waiting.popitem()
+                required = self.resource_restrictions[key]
+                if has_resources(available, required):
+                    for r, quantity in required.items():
+                        available[r] -= quantity
+                    self.stacks[worker].append(key, count)
+                elif available.get(resource, 0) < required[resource]:
+                    short.append((key, count))
+                else:
+                    self.block(worker, key, count, available)
+            for key, count in short:
+                waiting.append(key, count)
+            if resource in blocked and not blocked[resource]:
+                del blocked[resource]
+        if not blocked:
+            del self.resource_blocked[worker]
+
+    def send_task(self, worker, key):
+        """ Put a task on a worker's queue and mark it as processing there """
+        self.processing[worker].add(key)
+        tasks = self.tasks
+        ts = tasks[key]
+        logger.debug("Send job to worker: %s, %s, %s", worker, key, ts.task)
+        msg = {'op': 'compute-task',
+               'key': key,
+               'task': ts.task,
+               'who_has': {dep: tasks[dep].who_has or EMPTY for dep in
+                           ts.dependencies}}
+        if ts.fused is not None:
+            msg['chain'] = ts.fused
+        self.worker_queues[worker].put_nowait(msg)
+
+    def drop_speculative_copy(self, key, worker):
+        """ Stop tracking one copy of a duplicated task
+
+        Returns whether another copy of the task is still processing
+        elsewhere, in which case the caller should wait for that one.
+        """
+        workers = self.speculative.get(key)
+        if not workers:
+            return False
+        workers.discard(worker)
+        others = {w for w in workers if key in self.processing.get(w, ())}
+        if not others:
+            del self.speculative[key]
+            return False
+        if key in self.processing.get(worker, ()):
+            self.processing[worker].remove(key)
+            self.release_resources(key, worker)
+        return True
+
+    def drop_losing_copy(self, key, worker):
+        """ Free the slot of a duplicate that lost the race to another copy
+
+        Called when ``worker`` reports back on ``key``.  Returns whether that
+        report was from a losing copy, in which case the caller should
+        otherwise ignore it.
+        """
+        keys = self.losing_copies.get(worker)
+        if not keys or key not in keys:
+            return False
+        keys.remove(key)
+        if not keys:
+            del self.losing_copies[worker]
+        if key in self.processing.get(worker, ()):
+            self.processing[worker].remove(key)
+            self.release_resources(key, worker)
+        return True
+
+    def release_resources(self, key, worker):
+        """ Return the resources of a task that has left a worker """
+        if key in self.resource_restrictions:
+            required = self.resource_restrictions[key]
+            available = self.available_resources.get(worker)
+            if available is not None:
+                for resource, quantity in required.items():
+                    available[resource] += quantity
+                self.unblock(worker, required)
 
     def seed_ready_tasks(self, keys=None):
         """ Distribute many leaf tasks among workers
@@ -399,13 +670,15 @@ class Scheduler(Server):
                 self.dependencies, self.waiting, self.keyorder, self.who_has,
                 self.stacks, self.restrictions, self.loose_restrictions,
                 self.nbytes,
-                [k for k in keys if k in self.waiting and not self.waiting[k]])
+                [k for k in keys if not self.waiting.get(k, True)],
+                self.hosts, self.resources, self.resource_restrictions,
+                self.unrunnable)
         logger.debug("Seed ready tasks: %s", new_stacks)
         for worker, stack in new_stacks.items():
             if stack:
                 self.ensure_occupied(worker)
 
-    def update_data(self, who_has=None, nbytes=None):
+    def update_data(self, stream=None, who_has=None, nbytes=None):
         """
         Learn that new data has entered the network from an external source
 
@@ -414,12 +687,12 @@ class Scheduler(Server):
         Scheduler.mark_key_in_memory
         """
         logger.debug("Update data %s", who_has)
+        self.held_data.update(who_has)
         for key, workers in who_has.items():
             self.mark_key_in_memory(key, workers)
 
         self.nbytes.update(nbytes)
 
-        self.held_data.update(who_has)
         self.in_play.update(who_has)
 
     def mark_task_erred(self, key, worker, exception, traceback):
@@ -429,8 +702,13 @@ class Scheduler(Server):
         --------
         Scheduler.mark_failed
         """
+        if (self.drop_losing_copy(key, worker) or
+                self.drop_speculative_copy(key, worker)):
+            self.ensure_occupied(worker)
+            return
         if key in self.processing[worker]:
             self.processing[worker].remove(key)
+            self.release_resources(key, worker)
             self.exceptions[key] = exception
             self.tracebacks[key] = traceback
             self.mark_failed(key, key)
@@ -459,11 +737,23 @@ class Scheduler(Server):
         for dep in self.dependents[key]:
             self.mark_failed(dep, failing_key)
 
-    def mark_task_finished(self, key, worker, nbytes):
+    def mark_task_finished(self, key, worker, nbytes, duration=None):
         """ Mark that a task has finished execution on a particular worker """
         logger.debug("Mark task as finished %s, %s", key, worker)
-        if key in self.processing[worker]:
-            self.nbytes[key] = nbytes
+        if self.drop_losing_copy(key, worker):
+            if key not in self.has_what.get(worker, ()):
+                self.deleted_keys[worker].add(key)
+            self.ensure_occupied(worker)
+        elif key in self.processing[worker]:
+            self.tasks[key].nbytes = nbytes
+            if duration is not None:
+                prefix = key_split(key)
+                old = self.task_duration.get(prefix, duration)
+                self.task_duration[prefix] = (old + duration) / 2
+            # Slower copies of a duplicated task still occupy their workers
+            for loser in self.speculative.pop(key, set()) - {worker}:
+                if key in self.processing.get(loser, ()):
+                    self.losing_copies[loser].add(key)
             self.mark_key_in_memory(key, [worker])
             self.ensure_occupied(worker)
             for plugin in self.plugins[:]:
@@ -473,7 +763,9 @@ class Scheduler(Server):
                     logger.exception(e)
         else:
             logger.debug("Key not found in processing, %s, %s, %s",
-                         key, worker, self.processing[worker])
+                         key, worker, self.processing.get(worker))
+            if key not in self.has_what.get(worker, ()):
+                self.deleted_keys[worker].add(key)
 
     def mark_missing_data(self, missing=None, key=None, worker=None):
         """ Mark that certain keys have gone missing.  Recover.
@@ -487,18 +779,22 @@ class Scheduler(Server):
         for k in missing:
             with ignoring(KeyError):
                 workers = self.who_has.pop(k)
-                for worker in workers:
-                    self.has_what[worker].remove(k)
-        self.my_heal_missing_data(missing)
+                for w in workers:
+                    self.has_what[w].remove(k)
+        added = self.my_heal_missing_data(missing)
 
-        if key and worker:
-            with ignoring(KeyError):
+        if key and worker and (self.drop_losing_copy(key, worker) or
+                               self.drop_speculative_copy(key, worker)):
+            self.ensure_occupied(worker)
+        elif key and worker and not self.who_has.get(key):
+            if key in self.processing.get(worker, ()):
                 self.processing[worker].remove(key)
+                self.release_resources(key, worker)
             self.waiting[key] = missing
             logger.debug('task missing data, %s, %s', key, self.waiting)
             self.ensure_occupied(worker)
 
-        self.seed_ready_tasks()
+        self.seed_ready_tasks(added)
 
     def log_state(self, msg=''):
         """ Log current full state of the scheduler """
@@ -512,7 +808,7 @@ class Scheduler(Server):
 
         See Also
         --------
-        Scheduler.heal_state
+        Scheduler.heal_lost_worker
         """
         logger.debug("Remove worker %s", address)
         if address not in self.processing:
@@ -522,9 +818,16 @@ class Scheduler(Server):
             self.worker_queues[address].put_nowait({'op': 'close', 'report': False})
         del self.worker_queues[address]
         del self.ncores[address]
-        del self.stacks[address]
-        del self.processing[address]
+        stack = list(self.stacks.pop(address))
+        for blocked in self.resource_blocked.pop(address, {}).values():
+            stack.extend(blocked)
+        processing = self.processing.pop(address)
         del self.nannies[address]
+        self.resources.pop(address, None)
+        self.available_resources.pop(address, None)
+        self.hosts[address[0]].discard(address)
+        if not self.hosts[address[0]]:
+            del self.hosts[address[0]]
         if not self.stacks:
             logger.critical("Lost all workers")
         missing_keys = set()
@@ -532,70 +835,265 @@ class Scheduler(Server):
             self.who_has[key].remove(address)
             if not self.who_has[key]:
                 missing_keys.add(key)
-        gone_data = {k for k, v in self.who_has.items() if not v}
+                del self.who_has[key]
         self.in_play.difference_update(missing_keys)
-        for k in gone_data:
-            del self.who_has[k]
+        losing = self.losing_copies.pop(address, set())
+        processing = [key for key in processing if key not in losing
+                      and not self.drop_speculative_copy(key, address)]
 
         if heal:
-            self.heal_state()
+            self.heal_lost_worker(stack + list(processing), missing_keys)
+
+    def heal_lost_worker(self, keys, missing):
+        """ Recover from the loss of a single worker
+
+        Unlike ``heal_state`` this only touches the keys that were on the lost
+        worker and their immediate dependents, so its cost scales with what
+        was lost rather than with the size of the graph.
+
+        Parameters
+        ----------
+        keys: list
+            Keys that were queued or processing on the lost worker
+        missing: set
+            Keys whose only copy in memory lived on the lost worker
+
+        Tasks queued on other workers that depend on lost data are caught by
+        ``ensure_occupied`` before dispatch.  Tasks already processing
+        elsewhere report missing data back to us.
+
+        See Also
+        --------
+        Scheduler.heal_state
+        Scheduler.mark_missing_data
+        """
+        logger.debug("Heal lost worker: %d tasks, %d missing keys",
+                     len(keys), len(missing))
+        needed = {dep for key in keys
+                      for dep in self.dependencies[key]
+                      if not self.who_has.get(dep)}
+        for key in missing:
+            dependents = {dep for dep in self.waiting_data.get(key, ())
+                              if dep in self.in_play}
+            if dependents or key in self.held_data:
+                needed.add(key)
+                for dep in dependents:
+                    if dep in self.waiting:
+                        self.waiting[dep].add(key)
+            else:
+                with ignoring(KeyError):
+                    del self.waiting_data[key]
+
+        for key in keys:
+            if key in self.in_play and not self.who_has.get(key):
+                self.waiting[key] = {dep for dep in self.dependencies[key]
+                                          if not self.who_has.get(dep)}
+
+        self.recompute(needed, keys)
+
+    def recompute(self, missing, keys=()):
+        """ Compute lost data again
+
+        Puts the ``missing`` keys, and any of their dependencies that are
+        also gone, back into ``waiting`` and starts those that are ready,
+        along with any ready ``keys``.  Data without a task, such as
+        scattered data, cannot come back, so we report it as lost.
+
+        See Also
+        --------
+        heal_missing_data
+        """
+        missing = set(missing)
+        for key in [k for k in missing if k not in self.dask]:
+            logger.info("Lost data with no task to recompute it: %s", key)
+            missing.remove(key)
+            self.report({'op': 'lost-key', 'key': key})
+
+        added = self.my_heal_missing_data(missing)
+
+        if self.stacks:
+            ready = {key for key in concat([keys, added])
+                         if key in self.waiting and not self.waiting[key]}
+            for key in sorted(ready, key=self.keyorder.get, reverse=True):
+                self.mark_ready_to_run(key)
 
     def add_worker(self, stream=None, address=None, keys=(), ncores=None,
-                   nanny_port=None):
+                   nanny_port=None, resources=None):
         self.ncores[address] = ncores
         self.nannies[address] = nanny_port
+        self.hosts[address[0]].add(address)
+        if resources:
+            self.resources[address] = resources
         if address not in self.processing:
+            if resources:
+                self.available_resources[address] = dict(resources)
             self.has_what[address] = set()
             self.processing[address] = set()
-            self.stacks[address] = []
+            self.stacks[address] = PriorityStack(self.keyorder)
             self.worker_queues[address] = Queue()
         for key in keys:
             self.mark_key_in_memory(key, [address])
 
+        if resources and self.unrunnable:
+            runnable = {key for key in self.unrunnable
+                            if has_resources(resources,
+                                             self.resource_restrictions[key])}
+            self.unrunnable -= runnable
+            for key in runnable:
+                self.mark_ready_to_run(key)
+
         self._worker_coroutines.append(self.worker(address))
 
         logger.info("Register %s", str(address))
+        self.work_steal()
         return b'OK'
 
+    def work_steal(self):
+        """ Move queued tasks from saturated workers to idle ones
+
+        This runs periodically every ``self.steal_interval`` milliseconds and
+        whenever a new worker arrives.  Once nothing is left to steal we
+        duplicate straggling tasks instead.
+
+        See Also
+        --------
+        steal_work
+        Scheduler.speculate
+        """
+        if self.status != 'running' or not self.stacks:
+            return
+        moves = steal_work(self.stacks, self.processing, self.ncores,
+                self.dependencies, self.who_has, self.restrictions,
+                self.loose_restrictions, self.nbytes, self.task_duration,
+                resources=self.resources,
+                resource_restrictions=self.resource_restrictions)
+        thieves = set()
+        now = time()
+        for key, victim, thief in moves:
+            logger.debug("Steal %s from %s to %s", key, victim, thief)
+            self.steal_log.append((now, key, victim, thief))
+            thieves.add(thief)
+        for thief in thieves:
+            self.ensure_occupied(thief)
+        self.speculate()
+
+    def speculate(self):
+        """ Run duplicates of straggling tasks on idle workers
+
+        When no tasks are queued on any worker we look for tasks that have
+        been processing for much longer than the estimate for their key
+        prefix and run another copy on an idle worker.  Whichever copy
+        finishes first wins, the other is discarded.  At most
+        ``self.speculative_limit`` tasks are duplicated at any one time.
+
+        See Also
+        --------
+        find_stragglers
+        """
+        if (self.status != 'running' or
+            len(self.speculative) >= self.speculative_limit):
+            return
+        duplicates = find_stragglers(self.stacks, self.processing,
+                self.ncores, self.task_start, self.task_duration, time(),
+                self.speculative_limit - len(self.speculative),
+                exclude=set(self.speculative).union(
+                    *self.losing_copies.values()),
+                restrictions=self.restrictions,
+                loose_restrictions=self.loose_restrictions,
+                available_resources=self.available_resources,
+                resource_restrictions=self.resource_restrictions)
+        for key, worker, thief in duplicates:
+            logger.info("Duplicate straggling task %s from %s on %s",
+                        key, worker, thief)
+            self.speculative[key] = {worker, thief}
+            for resource, quantity in self.resource_restrictions.get(
+                    key, {}).items():
+                self.available_resources[thief][resource] -= quantity
+            self.send_task(thief, key)
+
     def update_graph(self, dsk=None, keys=None, restrictions=None,
-                     loose_restrictions=None):
+                     loose_restrictions=None, dependencies=None,
+                     priorities=None, resources=None, boundary=None):
         """ Add new computations to the internal dask graph
 
         This happens whenever the Executor calls submit, map, get, or compute.
+
+        Tasks may require abstract resources of the workers that run them,
+        ``resources={key: {resource: quantity}}``.
+
+        The Executor sends large graphs in pieces.  Keys of this piece that
+        later pieces depend upon arrive in ``boundary``.  We do not fuse
+        them into chains, but neither do we hold them for the client.
+
+        See Also
+        --------
+        Scheduler.handle_update_graph
         """
         for k in list(dsk):
             if dsk[k] is k:
                 del dsk[k]
 
-        update_state(self.dask, self.dependencies, self.dependents,
-                self.held_data, self.who_has, self.in_play,
-                self.waiting, self.waiting_data, dsk, keys)
+        if (self.fuse and dependencies is not None and
+            not any(k in self.dependencies for k in dsk)):
+            dsk, dependencies, fused = fuse_chains(dsk, dependencies,
+                    set(keys) | set(boundary or ()),
+                    merge(restrictions or {}, resources or {}))
+            self.fused.update(fused)
 
-        cover_aliases(self.dask, dsk)
+        new_keys = self.add_tasks(dsk, keys, dependencies)
 
         if restrictions:
-            restrictions = {k: set(map(ensure_ip, v))
-                            for k, v in restrictions.items()}
-            self.restrictions.update(restrictions)
+            # many keys often share the same few hosts, resolve each set once
+            resolved = dict()
+            for k, v in restrictions.items():
+                v = tuple(v)
+                if v not in resolved:
+                    resolved[v] = set(map(ensure_ip, v))
+                self.restrictions[k] = resolved[v]
         if loose_restrictions:
             self.loose_restrictions |= loose_restrictions
-
-        new_keyorder = order(dsk)  # TODO: define order wrt old graph
-        for key in new_keyorder:
-            if key not in self.keyorder:
-                # TODO: add test for this
-                self.keyorder[key] = (self.generation, new_keyorder[key]) # prefer old
-        if len(dsk) > 1:
+        if resources:
+            self.resource_restrictions.update(resources)
+
+        tasks = self.tasks
+        if len(dsk) == 1:  # Executor.submit, the order of one task is zero
+            key, = dsk
+            if tasks[key].keyorder is None:
+                tasks[key].keyorder = (self.generation, 0)
+        else:
+            if priorities is None:  # TODO: define order wrt old graph
+                priorities = order(dsk, dependencies=graph_dependencies(
+                    dsk, self.dependencies))
+            new_keyorder = priorities
+            for key in dsk:  # fused keys may remain in given priorities
+                ts = tasks[key]
+                if ts.keyorder is None:
+                    # TODO: add test for this
+                    ts.keyorder = (self.generation, new_keyorder[key]) # prefer old
             self.generation += 1  # older graph generations take precedence
 
         for key in dsk:
-            for dep in self.dependencies[key]:
-                if dep in self.exceptions_blame:
-                    self.mark_failed(key, self.exceptions_blame[dep])
-
-        self.seed_ready_tasks(dsk)
+            ts = tasks[key]
+            if ts.exception_blame is not None:  # failed before, say so again
+                failed = tasks[ts.exception_blame]
+                self.report({'op': 'task-erred',
+                             'key': key,
+                             'exception': failed.exception,
+                             'traceback': failed.traceback})
+            for dep in ts.dependencies:
+                blame = tasks[dep].exception_blame
+                if blame is not None:
+                    self.mark_failed(key, blame)
+            ts.compact()
+
+        if len(new_keys) == 1 and self.stacks:
+            key, = new_keys
+            if not self.waiting.get(key, True):
+                self.place_ready_task(key)
+        else:
+            self.seed_ready_tasks(new_keys)
         for key in keys:
-            if self.who_has[key]:
+            if self.who_has.get(key):
                 self.mark_key_in_memory(key)
 
         for plugin in self.plugins[:]:
@@ -604,6 +1102,133 @@ class Scheduler(Server):
             except Exception as e:
                 logger.exception(e)
 
+    def add_tasks(self, dsk, keys, dependencies=None):
+        """ Add new tasks and the keys that the client wants to our state
+
+        This does to ``self.tasks`` what ``update_state`` does to the
+        dictionaries of a scheduler state.  Given dependencies that are
+        neither in the graph, held, nor known to have failed are ignored.
+        Keys that failed do not come back into play.
+
+        Returns the keys that we put into play.  These include tasks of
+        earlier graphs that nobody wanted until now.
+
+        See Also
+        --------
+        update_state
+        """
+        tasks = self.tasks
+        for key, task in dsk.items():
+            ts = tasks.get(key)
+            if ts is None:
+                ts = tasks[key] = TaskState(key)
+            ts.task = task
+
+        for key, task in dsk.items():  # add dependencies/dependents
+            ts = tasks[key]
+            if ts.dependencies is not None:
+                continue
+            if dependencies is not None and key in dependencies:
+                deps = dependencies[key]
+            else:
+                deps = _deps(tasks, task)
+            deps = {d for d in deps if d in tasks and
+                    (tasks[d].task is not NO_VALUE or tasks[d].held or
+                     tasks[d].exception_blame is not None)}
+            ts.dependencies = deps
+            for dep in deps:
+                dts = tasks[dep]
+                if dts.dependents is None or dts.dependents is EMPTY:
+                    dts.dependents = set()
+                dts.dependents.add(key)
+            if ts.dependents is None:
+                ts.dependents = set()
+
+        exterior = []  # keys_outside_frontier, with in_play as the frontier
+        stack = list(keys)
+        while stack:
+            ts = tasks[stack.pop()]
+            if ts.in_play or ts.exception_blame is not None:
+                continue
+            ts.in_play = True
+            exterior.append(ts)
+            stack.extend(ts.dependencies or ())
+
+        for ts in exterior:
+            ts.waiting = {dep for dep in ts.dependencies
+                              if not tasks[dep].who_has}
+            for dep in ts.dependencies:
+                dts = tasks[dep]
+                if dts.waiting_data is None or dts.waiting_data is EMPTY:
+                    dts.waiting_data = set()
+                dts.waiting_data.add(ts.key)
+            if ts.waiting_data is None:
+                ts.waiting_data = set()
+
+        self.held_data.update(keys)
+        return [ts.key for ts in exterior]
+
+    def handle_update_graph(self, dsk=None, keys=None, priorities=None,
+                            **kwargs):
+        """ Add a graph that a client sent us
+
+        Graphs with at least ``background_graph_size`` tasks are analyzed in a
+        separate thread.  In this case we return a Future.
+
+        See Also
+        --------
+        Scheduler.update_graph
+        Scheduler.update_graph_in_thread
+        """
+        if priorities is None and len(dsk) >= self.background_graph_size:
+            return self.update_graph_in_thread(dsk, keys, **kwargs)
+        else:
+            return self.update_graph(dsk=dsk, keys=keys,
+                                     priorities=priorities, **kwargs)
+
+    @property
+    def graph_thread(self):
+        """ Thread in which we analyze large graphs, started on first use """
+        if self._graph_thread is None:
+            self._graph_thread = ThreadPoolExecutor(1)
+        return self._graph_thread
+
+    @gen.coroutine
+    def update_graph_in_thread(self, dsk, keys, restrictions=None,
+                               loose_restrictions=None, dependencies=None,
+                               resources=None, boundary=None):
+        """ Analyze a large graph in a thread, then add it to our state
+
+        Finding dependencies and running ``dask.order`` only depend on the new
+        graph, so we run them in ``self.graph_thread`` while the event loop
+        continues to serve workers and clients.  Dependencies on keys outside
+        of the new graph are resolved against our state afterwards, on the
+        event loop, so that events arriving during analysis are accounted for.
+
+        If the client sent dependencies then we only order the graph.  Tasks
+        serialized by the client are never inspected.
+
+        See Also
+        --------
+        analyze_graph
+        Scheduler.update_graph
+        """
+        logger.debug("Analyze graph of %d tasks in thread", len(dsk))
+        if dependencies is not None:
+            priorities = yield self.graph_thread.submit(order, dsk,
+                    dependencies=graph_dependencies(dsk, dependencies))
+        else:
+            internal, outside, priorities = yield self.graph_thread.submit(
+                    analyze_graph, dsk)
+            dependencies = internal
+            for key, other in outside.items():
+                dependencies[key] |= other  # update_state drops non-keys
+
+        self.update_graph(dsk=dsk, keys=keys, restrictions=restrictions,
+                          loose_restrictions=loose_restrictions,
+                          dependencies=dependencies, priorities=priorities,
+                          resources=resources, boundary=boundary)
+
     def release_held_data(self, keys=None):
         """ Mark that a key is no longer externally required to be in memory """
         keys = set(keys)
@@ -612,8 +1237,10 @@ class Scheduler(Server):
             logger.debug("Release keys: %s", keys)
             self.held_data -= keys
             keys2 = {k for k in keys if not self.waiting_data.get(k)}
-            if keys2:
-                self.delete_data(keys=keys2)  # async
+            in_memory = {k for k in keys2 if self.who_has.get(k)}
+            if in_memory:
+                self.delete_data(keys=in_memory)  # async
+            self.forget(keys2 - self.in_play)
 
     def heal_state(self):
         """ Recover from catastrophic change """
@@ -624,6 +1251,7 @@ class Scheduler(Server):
         released = state['released']
         self.in_play.clear(); self.in_play.update(state['in_play'])
         add_keys = {k for k, v in self.waiting.items() if not v}
+        self.unrunnable.clear()  # among add_keys if still in play
         for key in self.held_data & released:
             self.report({'op': 'lost-key', 'key': key})
         if self.stacks:
@@ -777,21 +1405,27 @@ class Scheduler(Server):
                 key = msg['key']
                 who_has = msg['who_has']
                 task = msg['task']
-                if not istask(task):
+                duration = None
+                if (not istask(task) and not isinstance(task, bytes) and
+                    'chain' not in msg):
                     response, content = yield worker.update_data(
                             data={key: task}, report=self.center is not None)
                     assert response == b'OK', response
                     nbytes = content['nbytes'][key]
                 else:
-                    response, content = yield worker.compute(function=execute_task,
-                                                             args=(task,),
-                                                             who_has=who_has,
+                    if isinstance(task, bytes) or 'chain' in msg:
+                        payload = {'task': task, 'chain': msg.get('chain')}
+                    else:
+                        payload = {'function': execute_task, 'args': (task,),
+                                   'kwargs': {}}
+                    response, content = yield worker.compute(who_has=who_has,
                                                              key=key,
-                                                             kwargs={},
                                                              report=self.center
-                                                                     is not None)
+                                                                     is not None,
+                                                             **payload)
                     if response == b'OK':
                         nbytes = content['nbytes']
+                        duration = content.get('duration')
                 logger.debug("Compute response from worker %s, %s, %s, %s",
                              ident, key, response, content)
                 if response == b'error':
@@ -802,7 +1436,7 @@ class Scheduler(Server):
                     self.mark_missing_data(content.args, key=key, worker=ident)
 
                 else:
-                    self.mark_task_finished(key, ident, nbytes)
+                    self.mark_task_finished(key, ident, nbytes, duration)
 
         yield worker.close(close=True)
         worker.close_streams()
@@ -823,7 +1457,7 @@ class Scheduler(Server):
             self.deleted_keys.clear()
 
             coroutines = [self.rpc(ip=worker[0], port=worker[1]).delete_data(
-                                    keys=keys, report=False)
+                                    keys=list(keys), report=False)
                           for worker, keys in d.items()]
             for worker, keys in d.items():
                 logger.debug("Remove %d keys from worker %s", len(keys), worker)
@@ -832,17 +1466,68 @@ class Scheduler(Server):
         raise Return(b'OK')
 
     def delete_data(self, stream=None, keys=None):
-        who_has2 = {k: v for k, v in self.who_has.items() if k in keys}
+        """ Remove keys from distributed memory
+
+        Workers are told to drop the data in the next call to
+        ``clear_data_from_workers``, which sends each worker one message
+        for all of its keys.  Keys that nothing refers to any longer are then
+        forgotten entirely.
 
+        See Also
+        --------
+        Scheduler.forget
+        """
+        keys = set(keys)
+        removed = defaultdict(set)
         for key in keys:
-            for worker in self.who_has[key]:
-                self.has_what[worker].remove(key)
-                self.deleted_keys[worker].add(key)
-            del self.who_has[key]
-            if key in self.waiting_data:
-                del self.waiting_data[key]
-            if key in self.in_play:
-                self.in_play.remove(key)
+            ts = self.tasks.get(key)
+            if ts is None:
+                continue
+            for worker in ts.who_has or ():
+                removed[worker].add(key)
+            ts.who_has = ts.waiting_data = None
+            ts.in_play = False
+        for worker, worker_keys in removed.items():
+            self.has_what[worker] -= worker_keys
+            self.deleted_keys[worker] |= worker_keys
+
+        self.forget(keys)
+
+    def forget(self, keys):
+        """ Remove all record of keys that are no longer needed
+
+        A key is forgotten once it is neither held by a client, in play, nor
+        depended upon by any key that we still remember.  Forgetting a key may
+        let us forget its dependencies in turn.  This keeps the scheduler's
+        state proportional to the live graph rather than to every key ever
+        submitted.
+
+        We still remember where forgotten keys live in memory.  We forget the
+        exceptions of keys that failed, so that a client that submits such a
+        key again computes it again.
+        """
+        tasks = self.tasks
+        stack = list(keys)
+        while stack:
+            key = stack.pop()
+            ts = tasks.get(key)
+            if (ts is None or ts.held or ts.in_play or
+                ts.waiting is not None or ts.dependents):
+                continue
+            logger.debug("Forget key %s", key)
+            self.speculative.pop(key, None)
+            if ts.who_has:  # keep where it lives
+                new = tasks[key] = TaskState(key)
+                new.who_has = ts.who_has
+            else:
+                del tasks[key]
+            for dep in ts.dependencies or ():
+                dts = tasks.get(dep)
+                if dts is not None and dts.dependents is not None:
+                    if dts.dependents:
+                        dts.dependents.discard(key)
+                    if not dts.dependents:
+                        stack.append(dep)
 
     @gen.coroutine
     def nanny_listen(self, ip, port):
@@ -872,11 +1557,132 @@ class Scheduler(Server):
 
         raise gen.Return(remotes)
 
+    def scatter_plan(self, stream=None, nbytes=None, workers=None):
+        """ Choose workers for data that a client will send them directly
+
+        We only see the size of each piece of data.  The client sends the
+        data to the chosen workers and then tells us where it went with
+        ``update_data``.  Returns the chosen worker for each key and whether
+        workers should report new data to the center.
+
+        See Also
+        --------
+        place_data
+        Scheduler.scatter
+        """
+        if not self.ncores:
+            raise ValueError("No workers yet found.  "
+                             "Try syncing with center.\n"
+                             "  e.sync_center()")
+        if workers is None:
+            workers = self.ncores
+        memory = {w: sum(self.nbytes.get(k, 0) for k in self.has_what[w])
+                  for w in workers}
+        ncores = {w: self.ncores.get(w, 1) for w in workers}
+        return {'workers': place_data(nbytes, memory, ncores),
+                'report': self.center is not None}
+
+    @gen.coroutine
+    def replicate(self, stream=None, keys=None, n=None, workers=None):
+        """ Copy data onto many workers
+
+        Workers copy data from each other along a tree.  In each round every
+        worker with a key sends it to at most one new worker, so the number
+        of copies doubles each round while no single worker has to serve
+        them all.  We stop once each key is on ``n`` workers, all of
+        ``workers`` by default, or when a round makes no progress.
+
+        See Also
+        --------
+        plan_replication
+        """
+        workers = {w for w in (workers or self.ncores) if w in self.ncores}
+        n = len(workers) if n is None else min(n, len(workers))
+        keys = set(keys)
+
+        while True:
+            who_has = {k: self.who_has[k] for k in keys
+                       if 0 < len(self.who_has.get(k, ())) < n}
+            memory = {w: sum(self.nbytes.get(k, 0) for k in self.has_what[w])
+                      for w in workers}
+            moves = plan_replication(who_has, n, workers, memory, self.nbytes)
+            if not moves:
+                break
+            logger.debug("Replicate %d keys", len(moves))
+            copied = yield self.copy_data(moves)
+            if not copied:
+                break
+
+        raise Return(b'OK')
+
+    @gen.coroutine
+    def rebalance(self, stream=None, keys=None, workers=None):
+        """ Move data from workers with much in memory to those with little
+
+        Only the given ``keys`` move, and only between the given ``workers``,
+        all of them by default.  Data moves directly between workers.  Once
+        it arrives we update ``who_has`` and ``has_what`` in one step and then
+        delete the original.
+
+        See Also
+        --------
+        plan_rebalance
+        """
+        workers = [w for w in (workers or self.ncores) if w in self.ncores]
+        if keys is not None:
+            keys = set(keys)
+        moves = plan_rebalance(self.has_what, self.nbytes, workers, keys)
+        logger.debug("Rebalance %d keys", len(moves))
+        copied = yield self.copy_data(moves)
+        for key, source, target in moves:
+            if ((key, target) in copied and
+                source in self.who_has.get(key, ())):
+                self.who_has[key].remove(source)
+                self.has_what[source].remove(key)
+                self.deleted_keys[source].add(key)
+
+        raise Return(b'OK')
+
+    @gen.coroutine
+    def copy_data(self, moves):
+        """ Copy keys between workers
+
+        Takes a list of ``(key, source, target)`` triples.  Targets fetch data
+        from sources with ``Worker.gather``.  Returns the set of ``(key,
+        target)`` pairs that arrived, after adding them to ``who_has``.
+        """
+        copies = defaultdict(dict)
+        for key, source, target in moves:
+            copies[target].setdefault(key, set()).add(source)
+
+        @gen.coroutine
+        def copy(worker, who_has):
+            response, content = yield self.rpc(ip=worker[0],
+                    port=worker[1]).gather(who_has=who_has,
+                                           report=self.center is not None)
+            raise Return((worker, response, content))
+
+        results = yield ignore_exceptions(
+                [copy(w, who_has) for w, who_has in copies.items()],
+                socket.error, StreamClosedError, IOError)
+        copied = set()
+        for worker, response, content in results:
+            if response != b'OK':
+                continue
+            for key in content['nbytes']:
+                if self.who_has.get(key) and worker in self.has_what:
+                    self.who_has[key].add(worker)
+                    self.has_what[worker].add(key)
+                    copied.add((key, worker))
+                else:  # released while we copied it
+                    self.deleted_keys[worker].add(key)
+        raise Return(copied)
+
     @gen.coroutine
     def gather(self, stream=None, keys=None):
         """ Collect data in from workers """
         keys = list(keys)
-        who_has = {key: self.who_has[key] for key in keys}
+        who_has = {key: self.who_has.get(key, set()) for key in keys}
 
         try:
             data = yield gather_from_workers(who_has)
@@ -928,9 +1734,15 @@ class Scheduler(Server):
 
     def validate(self, allow_overlap=False):
         in_memory = {k for k, v in self.who_has.items() if v}
+        processing = {w: keys - self.losing_copies.get(w, set())
+                      for w, keys in self.processing.items()}
+        stacks = {w: list(concat([stack] + list(
+                        self.resource_blocked.get(w, {}).values())))
+                  for w, stack in self.stacks.items()}
+        stacks[None] = list(self.unrunnable)
         validate_state(self.dependencies, self.dependents, self.waiting,
-                self.waiting_data, in_memory, self.stacks,
-                self.processing, None, set(), self.in_play,
+                self.waiting_data, in_memory, stacks,
+                processing, None, set(), self.in_play,
                 allow_overlap=allow_overlap)
         assert (set(self.ncores) == \
                 set(self.has_what) == \
@@ -970,9 +1782,9 @@ class Scheduler(Server):
 
     def get_who_has(self, stream, keys=None):
         if keys is not None:
-            return {k: self.who_has[k] for k in keys}
+            return {k: self.who_has.get(k, set()) for k in keys}
         else:
-            return self.who_has
+            return self.who_has.copy()
 
     def get_has_what(self, stream, keys=None):
         if keys is not None:
@@ -987,16 +1799,363 @@ class Scheduler(Server):
             return self.ncores
 
     @gen.coroutine
-    def broadcast(self, stream, msg=None):
-        """ Broadcast message to workers, return all results """
-        workers = list(self.ncores)
-        results = yield All([send_recv(ip=ip, port=port, close=True, **msg)
-                             for ip, port in workers])
-        raise Return(dict(zip(workers, results)))
+    def broadcast(self, stream, msg=None, workers=None):
+        """ Broadcast message to workers, return all results
+
+        Send to all workers, or only to ``workers`` if given.  Large
+        messages travel along a tree of workers.  See
+        ``broadcast_to_workers``.
+        """
+        if workers is None:
+            workers = list(self.ncores)
+        else:
+            workers = [tuple(w) for w in workers]
+        results = yield broadcast_to_workers(workers, msg)
+        raise Return(results)
+
+
+class PriorityStack(object):
+    """ Stack of ready keys that pops the key with the highest priority
+
+    Priority is given by ``keyorder``, lower values running first.  Keys
+    without an entry in ``keyorder`` come before all others.  Keys of equal
+    priority are popped last in first out.  Pushing, popping and removing
+    keys are all logarithmic.
+    Removal is lazy; removed keys are skipped when they reach the top.
+
+    This supports the parts of the ``list`` interface used on stacks, so pure
+    functions like ``heal`` and ``steal_work`` accept either.  Iteration goes
+    from the bottom of the stack, the key that would run last, to the top.
+    It is lazy and sorts the stack only once between pushes.
+
+    >>> keyorder = {'x': (0, 2), 'y': (0, 1), 'z': (1, 0)}
+    >>> stack = PriorityStack(keyorder, ['x', 'z'])
+    >>> stack.append('y')
+    >>> list(stack)
+    ['z', 'x', 'y']
+    >>> stack.pop()
+    'y'
+    >>> stack.remove('x')
+    >>> stack.pop()
+    'z'
+    """
+    def __init__(self, keyorder=None, keys=()):
+        self.keyorder = keyorder if keyorder is not None else dict()
+        self.heap = []
+        self.counts = dict()
+        self.count = 0
+        self.sorted = None  # heap entries from the bottom, see __iter__
+        self.bottom = 0
+        self.extend(keys)
+
+    def append(self, key, count=None):
+        """ Push a key
+
+        Pass the ``count`` that ``popitem`` returned with a key to put it back
+        in its old place among keys of equal priority.
+        """
+        if count is None:
+            self.count += 1
+            count = self.count
+        self.counts[key] = count
+        heapq.heappush(self.heap, (self.keyorder.get(key, ()), -count, key))
+        self.sorted = None
+
+    def extend(self, keys):
+        for key in keys:
+            self.append(key)
+
+    def popitem(self):
+        """ Pop the top key along with its count """
+        while self.heap:
+            _, count, key = heapq.heappop(self.heap)
+            if self.counts.get(key) == -count:
+                del self.counts[key]
+                return key, -count
+        raise IndexError("pop from empty stack")
+
+    def pop(self):
+        return self.popitem()[0]
+
+    def remove(self, key):
+        if key not in self.counts:
+            raise ValueError("%s not in stack" % str(key))
+        del self.counts[key]
+        if len(self.heap) > 2 * len(self.counts) + 100:  # compact
+            self.heap = [(p, c, k) for p, c, k in self.heap
+                                   if self.counts.get(k) == -c]
+            heapq.heapify(self.heap)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __bool__(self):
+        return bool(self.counts)
+
+    __nonzero__ = __bool__
+
+    def __contains__(self, key):
+        return key in self.counts
+
+    def __iter__(self):
+        # Pops and removals leave the sorted entries valid, so we keep them
+        # until the next push and skip dead entries as we go.  Dead entries
+        # at the bottom are skipped for good, which keeps repeated scans from
+        # the bottom cheap as tasks are stolen from there.
+        if self.sorted is None:
+            self.sorted = sorted(self.heap, reverse=True)
+            self.bottom = 0
+        entries, counts = self.sorted, self.counts
+        i = self.bottom
+        while i < len(entries) and counts.get(entries[i][2]) != -entries[i][1]:
+            i += 1
+        self.bottom = i
+        return (k for p, c, k in islice(entries, i, None)
+                  if counts.get(k) == -c)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'PriorityStack(%s)' % list(self)
+
+
+NO_VALUE = object()  # an unknown task or traceback, either may be None
+EMPTY = frozenset()  # shared by TaskStates for sets without elements
+
+
+class TaskState(object):
+    """ Everything the scheduler knows about one key
+
+    The scheduler keeps one ``TaskState`` per key in ``Scheduler.tasks``
+    rather than an entry per key in each of many dictionaries.  A transition
+    looks up its key once and a key costs one small object.  The old
+    dictionaries and sets, like ``Scheduler.who_has``, remain as views onto
+    these objects.  See ``TaskStateMapping`` and ``TaskStateSet``.
+
+    Attributes match the scheduler state of the same name, except for
+    ``task`` (``dask``), ``exception`` (``exceptions``), ``traceback``
+    (``tracebacks``), ``exception_blame`` (``exceptions_blame``), ``held``
+    (``held_data``) and ``start`` (``task_start``).  Unknown values are
+    ``None``, or ``NO_VALUE`` for ``task`` and ``traceback``, which may be
+    ``None``.  Keys are in ``in_play``, ``held_data`` or
+    ``loose_restrictions`` if those attributes are true.
+
+    Sets without elements may be the shared frozenset ``EMPTY``, which saves
+    memory on the many tasks without dependencies, dependents or anything to
+    wait for.  Replace it with a new set before adding to it.
+    """
+    __slots__ = ('key', 'task', 'dependencies', 'dependents', 'waiting',
+                 'waiting_data', 'who_has', 'nbytes', 'keyorder',
+                 'restrictions', 'loose_restrictions',
+                 'resource_restrictions', 'exception', 'traceback',
+                 'exception_blame', 'in_play', 'held', 'start', 'fused')
+
+    def __init__(self, key):
+        self.key = key
+        self.task = self.traceback = NO_VALUE
+        self.dependencies = self.dependents = None
+        self.waiting = self.waiting_data = self.who_has = None
+        self.nbytes = self.keyorder = self.restrictions = None
+        self.resource_restrictions = self.exception = None
+        self.exception_blame = self.start = self.fused = None
+        self.loose_restrictions = self.in_play = self.held = False
+
+    def compact(self):
+        """ Replace empty sets with ``EMPTY`` """
+        if self.dependencies is not None and not self.dependencies:
+            self.dependencies = EMPTY
+        if self.dependents is not None and not self.dependents:
+            self.dependents = EMPTY
+        if self.waiting is not None and not self.waiting:
+            self.waiting = EMPTY
+        if self.waiting_data is not None and not self.waiting_data:
+            self.waiting_data = EMPTY
+
+    def __repr__(self):
+        return '<TaskState: %s>' % str(self.key)
+
+
+class TaskStateMapping(MutableMapping):
+    """ Dictionary view of one attribute of many TaskStates
+
+    Reading and writing ``view[key]`` reads and writes that attribute of
+    ``tasks[key]``, creating the TaskState of a new key.  Keys whose
+    attribute is ``missing`` are absent.  Given a ``default`` factory, like
+    that of a ``defaultdict``, reading an absent key stores a new default.
+    Reading an ``EMPTY`` set stores a new set in its place that the caller
+    may change.  Iteration and length scan all TaskStates.
+
+    >>> tasks = dict()
+    >>> nbytes = TaskStateMapping(tasks, 'nbytes')
+    >>> nbytes['x'] = 100
+    >>> tasks['x'].nbytes
+    100
+    >>> dict(nbytes)
+    {'x': 100}
+    """
+    def __init__(self, tasks, attr, missing=None, default=None):
+        self.tasks = tasks
+        self.attr = attr
+        self.missing = missing
+        self.default = default
+
+    def __getitem__(self, key):
+        ts = self.tasks.get(key)
+        value = self.missing if ts is None else getattr(ts, self.attr)
+        if value is self.missing:
+            if self.default is None:
+                raise KeyError(key)
+            value = self[key] = self.default()
+        elif value is EMPTY:
+            value = set()
+            setattr(ts, self.attr, value)
+        return value
+
+    def __setitem__(self, key, value):
+        ts = self.tasks.get(key)
+        if ts is None:
+            ts = self.tasks[key] = TaskState(key)
+        setattr(ts, self.attr, value)
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def __contains__(self, key):
+        ts = self.tasks.get(key)
+        return ts is not None and getattr(ts, self.attr) is not self.missing
+
+    def __iter__(self):
+        attr, missing = self.attr, self.missing
+        return (key for key, ts in self.tasks.items()
+                    if getattr(ts, attr) is not missing)
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+    def __bool__(self):
+        return any(True for key in self)
+
+    __nonzero__ = __bool__
+
+    def get(self, key, default=None):
+        ts = self.tasks.get(key)
+        if ts is None:
+            return default
+        value = getattr(ts, self.attr)
+        return default if value is self.missing else value
+
+    def pop(self, key, *default):
+        ts = self.tasks.get(key)
+        value = self.missing if ts is None else getattr(ts, self.attr)
+        if value is self.missing:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        setattr(ts, self.attr, self.missing)
+        return value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def items(self):
+        attr, missing = self.attr, self.missing
+        return [(key, getattr(ts, attr)) for key, ts in self.tasks.items()
+                if getattr(ts, attr) is not missing]
+
+    def values(self):
+        return [value for key, value in self.items()]
+
+    def clear(self):
+        for ts in self.tasks.values():
+            setattr(ts, self.attr, self.missing)
+
+    def copy(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return repr(self.copy())
+
+
+class TaskStateSet(MutableSet):
+    """ Set view of one boolean attribute of many TaskStates
+
+    A key is in the set if that attribute of ``tasks[key]`` is true.  Adding
+    a key creates its TaskState if needed.  Iteration and length scan all
+    TaskStates.
+
+    >>> tasks = dict()
+    >>> held_data = TaskStateSet(tasks, 'held')
+    >>> held_data.add('x')
+    >>> tasks['x'].held
+    True
+    >>> held_data == {'x'}
+    True
+    """
+    def __init__(self, tasks, attr):
+        self.tasks = tasks
+        self.attr = attr
+
+    @classmethod
+    def _from_iterable(cls, it):
+        return set(it)
+
+    def __contains__(self, key):
+        ts = self.tasks.get(key)
+        return ts is not None and getattr(ts, self.attr)
+
+    def __iter__(self):
+        attr = self.attr
+        return (key for key, ts in self.tasks.items() if getattr(ts, attr))
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+    def __bool__(self):
+        return any(True for key in self)
+
+    __nonzero__ = __bool__
+
+    def add(self, key):
+        ts = self.tasks.get(key)
+        if ts is None:
+            ts = self.tasks[key] = TaskState(key)
+        setattr(ts, self.attr, True)
+
+    def discard(self, key):
+        ts = self.tasks.get(key)
+        if ts is not None:
+            setattr(ts, self.attr, False)
+
+    def update(self, *others):
+        for keys in others:
+            for key in keys:
+                self.add(key)
+
+    def difference_update(self, *others):
+        for keys in others:
+            for key in keys:
+                self.discard(key)
+
+    def clear(self):
+        for ts in self.tasks.values():
+            setattr(ts, self.attr, False)
+
+    def copy(self):
+        return set(self)
+
+    def __repr__(self):
+        return repr(self.copy())
 
 
 def decide_worker(dependencies, stacks, who_has, restrictions,
-                  loose_restrictions, nbytes, key):
+                  loose_restrictions, nbytes, key, hosts=None, resources=None,
+                  resource_restrictions=None):
     """ Decide which worker should take task
 
     >>> dependencies = {'c': {'b'}, 'b': {'a'}}
@@ -1037,23 +2196,65 @@ def decide_worker(dependencies, stacks, who_has, restrictions,
 
     >>> decide_worker(dependencies, stacks, who_has, {}, set(), nbytes, 'c')
     ('bob', 8000)
+
+    Restrictions are resolved with a mapping from hostname to workers if one
+    is provided, rather than by scanning all workers
+
+    >>> hosts = {'alice': {('alice', 8000)}, 'bob': {('bob', 8000)}}
+    >>> decide_worker(dependencies, stacks, who_has, {'c': {'alice'}}, set(),
+    ...               nbytes, 'c', hosts)
+    ('alice', 8000)
+
+    Tasks that require resources only go to workers that have enough of them
+
+    >>> resources = {('alice', 8000): {'GPU': 1}}
+    >>> decide_worker(dependencies, stacks, who_has, {}, set(), nbytes, 'c',
+    ...               resources=resources,
+    ...               resource_restrictions={'c': {'GPU': 1}})
+    ('alice', 8000)
+
+    If no worker has those resources then we return ``None``.  A worker that
+    has them may yet arrive.
+
+    >>> decide_worker(dependencies, stacks, who_has, {}, set(), nbytes, 'c',
+    ...               resources=resources,
+    ...               resource_restrictions={'c': {'GPU': 2}})
     """
     deps = dependencies[key]
     workers = frequencies(w for dep in deps
                             for w in who_has[dep])
-    if not workers:
-        workers = stacks
+    valid = None
     if key in restrictions:
         r = restrictions[key]
-        workers = {w for w in workers if w[0] in r}  # TODO: nonlinear
+        if hosts is not None:
+            valid = set()
+            for host in r:
+                if host in hosts:
+                    valid.update(hosts[host])
+        else:
+            valid = {w for w in stacks if w[0] in r}
+    if resource_restrictions is not None and key in resource_restrictions:
+        required = resource_restrictions[key]
+        able = {w for w, r in resources.items()
+                  if w in stacks and has_resources(r, required)}
+        valid = able if valid is None else valid & able
+    if valid is not None:
+        workers = {w for w in workers if w in valid} or valid
         if not workers:
-            workers = {w for w in stacks if w[0] in r}
-            if not workers:
-                if key in loose_restrictions:
-                    return decide_worker(dependencies, stacks, who_has,
-                                         {}, set(), nbytes, key)
-                else:
-                    raise ValueError("Task has no valid workers", key, r)
+            if key in loose_restrictions and key in restrictions:
+                return decide_worker(dependencies, stacks, who_has,
+                                     {}, set(), nbytes, key, None,
+                                     resources, resource_restrictions)
+            elif (resource_restrictions is not None and
+                  key in resource_restrictions):
+                return None
+            else:
+                raise ValueError("Task has no valid workers", key,
+                                 restrictions.get(key),
+                                 resource_restrictions and
+                                 resource_restrictions.get(key))
+    elif not workers:
+        workers = stacks
     if not workers or not stacks:
         raise ValueError("No workers found")
 
@@ -1068,13 +2269,262 @@ def decide_worker(dependencies, stacks, who_has, restrictions,
     return worker
 
 
+def steal_work(stacks, processing, ncores, dependencies, who_has,
+               restrictions, loose_restrictions, nbytes, task_duration,
+               bandwidth=BANDWIDTH, resources=None,
+               resource_restrictions=None):
+    """ Rebalance queued tasks from saturated workers to idle workers
+
+    A worker is idle if it has no queued tasks and has free cores.  We take
+    tasks from the bottom of the longest stacks (those that would run last)
+    and give them to idle workers.  We only move a task if the expected time
+    to move its dependencies to the thief is less than the expected compute
+    time of the task, estimated from ``task_duration`` by key prefix.
+
+    This mutates stacks in place and returns a list of moves
+    ``(key, victim, thief)``.  These tasks have yet to be put on worker queues.
+
+    >>> dependencies = {'x': set(), 'y': set(), 'z': set()}
+    >>> stacks = {('alice', 8000): ['x', 'y', 'z'], ('bob', 8000): []}
+    >>> processing = {('alice', 8000): {'w'}, ('bob', 8000): set()}
+    >>> ncores = {('alice', 8000): 1, ('bob', 8000): 1}
+    >>> steal_work(stacks, processing, ncores, dependencies, {}, {}, set(),
+    ...            {}, {})
+    [('x', ('alice', 8000), ('bob', 8000))]
+    >>> stacks[('bob', 8000)]
+    ['x']
+    """
+    moves = []
+    thieves = [w for w, stack in stacks.items()
+                 if not stack and len(processing[w]) < ncores[w]]
+    if not thieves:
+        return moves
+
+    def queued(w):
+        return len(stacks[w]) / ncores[w]
+
+    for thief in thieves:
+        free = ncores[thief] - len(processing[thief])
+        scans = dict()  # keys this thief skipped stay skipped, so resume
+        while len(stacks[thief]) < free:
+            victim = max(stacks, key=queued)
+            stack = stacks[victim]
+            if not stack or victim == thief:
+                break
+            if victim not in scans:
+                scans[victim] = iter(stack if isinstance(stack, PriorityStack)
+                                     else list(stack))
+            for key in scans[victim]:
+                if key in restrictions and key not in loose_restrictions:
+                    if thief[0] not in restrictions[key]:
+                        continue
+                if resource_restrictions is not None and key in resource_restrictions:
+                    if not has_resources(resources.get(thief, {}),
+                                         resource_restrictions[key]):
+                        continue
+                commbytes = sum(nbytes.get(dep, 0)
+                                for dep in dependencies[key]
+                                if thief not in who_has.get(dep, ()))
+                duration = task_duration.get(key_split(key),
+                                             DEFAULT_TASK_DURATION)
+                if commbytes / bandwidth <= duration:
+                    break
+            else:
+                break
+            stack.remove(key)
+            stacks[thief].append(key)
+            moves.append((key, victim, thief))
+
+    return moves
+
+
+def find_stragglers(stacks, processing, ncores, task_start, task_duration,
+                    now, n, exclude=(), factor=SPECULATIVE_FACTOR,
+                    minimum=SPECULATIVE_MINIMUM, restrictions=None,
+                    loose_restrictions=None, available_resources=None,
+                    resource_restrictions=None):
+    """ Choose straggling tasks to duplicate onto idle workers
+
+    We only look once every stack is empty, so that duplicates never delay
+    work that has yet to start.  A task straggles if it has been processing
+    for ``factor`` times longer than the estimate for its key prefix in
+    ``task_duration``, and for at least ``minimum`` seconds.  We pick up to
+    ``n`` stragglers, those furthest behind their estimate first, and pair
+    each with an idle worker allowed to run it.  Keys in ``exclude`` are
+    already duplicated.
+
+    Returns a list of ``(key, worker, idle_worker)`` triples.
+
+    >>> alice, bob = ('alice', 8000), ('bob', 8000)
+    >>> stacks = {alice: [], bob: []}
+    >>> processing = {alice: {'x-1', 'x-2'}, bob: set()}
+    >>> ncores = {alice: 2, bob: 1}
+    >>> task_start = {'x-1': 0, 'x-2': 9}
+    >>> find_stragglers(stacks, processing, ncores, task_start, {'x': 1},
+    ...                 now=10, n=2)
+    [('x-1', ('alice', 8000), ('bob', 8000))]
+    """
+    if n <= 0 or any(stacks.values()):
+        return []
+    restrictions = restrictions or {}
+    loose_restrictions = loose_restrictions or set()
+    available_resources = available_resources or {}
+    resource_restrictions = resource_restrictions or {}
+
+    free = {w: ncores[w] - len(processing[w]) for w in processing}
+    if not any(v > 0 for v in free.values()):
+        return []
+
+    lagging = []
+    for worker, keys in processing.items():
+        for key in keys:
+            if key in exclude or key not in task_start:
+                continue
+            estimate = task_duration.get(key_split(key))
+            if estimate is None:
+                continue
+            elapsed = now - task_start[key]
+            if elapsed > max(factor * estimate, minimum):
+                lagging.append((elapsed / max(estimate, 1e-9), key, worker))
+    lagging.sort(reverse=True)
+
+    duplicates = []
+    for _, key, worker in lagging:
+        for thief in sorted(free, key=free.get, reverse=True):
+            if free[thief] <= 0 or thief == worker:
+                continue
+            if key in restrictions and key not in loose_restrictions:
+                if thief[0] not in restrictions[key]:
+                    continue
+            if key in resource_restrictions:
+                if not has_resources(available_resources.get(thief, {}),
+                                     resource_restrictions[key]):
+                    continue
+            free[thief] -= 1
+            duplicates.append((key, worker, thief))
+            break
+        if len(duplicates) >= n:
+            break
+
+    return duplicates
+
+
+def place_data(nbytes, memory, ncores):
+    """ Assign new pieces of data to workers, balancing memory per core
+
+    We place the largest pieces first, each on the worker with the fewest
+    bytes in memory per core, counting what we have already placed.
+
+    >>> alice, bob = ('alice', 8000), ('bob', 8000)
+    >>> placement = place_data({'x': 100, 'y': 10, 'z': 10},
+    ...                        {alice: 0, bob: 50}, {alice: 1, bob: 1})
+    >>> placement['x'], placement['y'], placement['z']
+    (('alice', 8000), ('bob', 8000), ('bob', 8000))
+    """
+    load = {w: memory.get(w, 0) / ncores.get(w, 1) for w in ncores}
+    heap = [(v, i, w) for i, (w, v) in enumerate(load.items())]
+    heapq.heapify(heap)
+    result = dict()
+    for key in sorted(nbytes, key=nbytes.get, reverse=True):
+        v, i, w = heapq.heappop(heap)
+        result[key] = w
+        heapq.heappush(heap, (v + nbytes[key] / ncores.get(w, 1), i, w))
+    return result
+
+
+def plan_replication(who_has, n, workers, memory, nbytes):
+    """ Plan one round of copies towards ``n`` replicas of each key
+
+    Each worker that has a key sends it to at most one new worker, so that
+    the number of copies at most doubles each round.  New copies go to the
+    workers among ``workers`` with the fewest bytes in ``memory``.
+
+    Returns a list of ``(key, source, target)`` copies.
+
+    >>> alice, bob, charlie = ('alice', 8000), ('bob', 8000), ('charlie', 8000)
+    >>> workers = [alice, bob, charlie]
+    >>> plan_replication({'x': {alice}}, 3, workers, {bob: 10, charlie: 0},
+    ...                  {'x': 100})
+    [('x', ('alice', 8000), ('charlie', 8000))]
+    """
+    load = {w: memory.get(w, 0) for w in workers}
+    moves = []
+    for key, holders in who_has.items():
+        holders = sorted(holders)
+        missing = [w for w in workers if w not in holders]
+        count = min(n - len(holders), len(holders), len(missing))
+        if count <= 0:
+            continue
+        targets = sorted(missing, key=load.get)[:count]
+        for source, target in zip(holders, targets):
+            moves.append((key, source, target))
+            load[target] += nbytes.get(key, 0)
+    return moves
+
+
+def plan_rebalance(has_what, nbytes, workers, keys=None):
+    """ Plan moves of data that even out memory across workers
+
+    Workers with more than the mean number of bytes send keys to the
+    workers with the least.  We try the largest keys first and only make a
+    move if neither worker crosses the mean, which keeps the number of bytes
+    moved low.  Each key goes to the least loaded worker that does not
+    already hold it.  Only ``keys`` move if given.
+
+    Returns a list of ``(key, source, target)`` moves.
+
+    >>> alice, bob = ('alice', 8000), ('bob', 8000)
+    >>> has_what = {alice: {'x', 'y', 'z'}, bob: set()}
+    >>> nbytes = {'x': 100, 'y': 20, 'z': 10}
+    >>> moves = plan_rebalance(has_what, nbytes, [alice, bob])
+    >>> [key for key, source, target in moves]
+    ['y', 'z']
+    >>> moves[0]
+    ('y', ('alice', 8000), ('bob', 8000))
+    """
+    if not workers:
+        return []
+    memory = {w: sum(nbytes.get(k, 0) for k in has_what.get(w, ()))
+              for w in workers}
+    mean = sum(memory.values()) / len(workers)
+
+    moves = []
+    for source in sorted(workers, key=memory.get, reverse=True):
+        if memory[source] <= mean:
+            break
+        candidates = has_what.get(source, ())
+        if keys is not None:
+            candidates = [k for k in candidates if k in keys]
+        for key in sorted(candidates, key=lambda k: nbytes.get(k, 0),
+                          reverse=True):
+            size = nbytes.get(key, 0)
+            if memory[source] - size < mean:
+                continue
+            for target in sorted(workers, key=memory.get):
+                if memory[target] + size > mean:
+                    break
+                if key in has_what.get(target, ()):
+                    continue
+                moves.append((key, source, target))
+                memory[source] -= size
+                memory[target] += size
+                break
+    return moves
+
+
 def update_state(dsk, dependencies, dependents, held_data,
                  who_has, in_play,
-                 waiting, waiting_data, new_dsk, new_keys):
+                 waiting, waiting_data, new_dsk, new_keys,
+                 new_dependencies=None):
     """ Update state given new dask graph and output keys
 
     This should operate in linear time relative to the size of edges of the
     added graph.  It assumes that the current runtime state is valid.
+
+    Optionally provide the dependencies of the new tasks if they are already
+    known, ``{key: {dependencies}}``, for example from the client.  Otherwise,
+    or for keys missing from this mapping, we find them in the tasks.  Given
+    dependencies that are neither in the graph nor held are ignored.
     """
     dsk.update(new_dsk)
     if not isinstance(new_keys, set):
@@ -1084,8 +2534,12 @@ def update_state(dsk, dependencies, dependents, held_data,
         if key in dependencies:
             continue
 
-        task = new_dsk[key]
-        deps = _deps(dsk, task) + _deps(held_data, task)
+        if new_dependencies is not None and key in new_dependencies:
+            deps = [d for d in new_dependencies[key]
+                      if d in dsk or d in held_data]
+        else:
+            task = new_dsk[key]
+            deps = _deps(dsk, task) + _deps(held_data, task)
         dependencies[key] = set(deps)
 
         for dep in deps:
@@ -1119,6 +2573,134 @@ def update_state(dsk, dependencies, dependents, held_data,
             'waiting_data': waiting_data}
 
 
+def analyze_graph(dsk):
+    """ Analysis of a new graph that does not depend on scheduler state
+
+    Returns three things
+
+    1.  Dependencies between keys within the graph, ``{key: {keys}}``
+    2.  Other hashable values within each task that may refer to keys outside
+        of the graph, ``{key: {values}}``.  Only tasks with such values appear.
+    3.  Priorities from ``dask.order``
+
+    >>> inc = lambda x: x + 1
+    >>> dsk = {'x': 1, 'y': (inc, 'x'), 'z': (inc, 'a')}
+    >>> internal, outside, priorities = analyze_graph(dsk)
+    >>> sorted(internal['y']), sorted(internal['z'])
+    (['x'], [])
+    >>> outside['z']
+    {'a'}
+    """
+    internal = dict()
+    outside = dict()
+    for key, task in dsk.items():
+        inside, other = set(), set()
+        stack = [task]
+        while stack:
+            arg = stack.pop()
+            if istask(arg):
+                stack.extend(arg[1:])
+            elif isinstance(arg, list):
+                stack.extend(arg)
+            elif isinstance(arg, dict):
+                stack.extend(arg.values())
+            else:
+                try:
+                    if arg in dsk:
+                        inside.add(arg)
+                    else:
+                        other.add(arg)
+                except TypeError:  # not hashable
+                    pass
+        internal[key] = inside
+        if other:
+            outside[key] = other
+
+    return internal, outside, order(dsk, dependencies=internal)
+
+
+def has_resources(available, required):
+    """ Whether a worker's resources cover the requirements of a task
+
+    >>> has_resources({'GPU': 2, 'MEMORY': 64e9}, {'GPU': 1})
+    True
+    >>> has_resources({'MEMORY': 64e9}, {'GPU': 1, 'MEMORY': 20e9})
+    False
+    """
+    return all(available.get(resource, 0) >= quantity
+               for resource, quantity in required.items())
+
+
+def fuse_chains(dsk, dependencies, keys, restrictions=None):
+    """ Collapse linear chains of tasks into the last task of each chain
+
+    A task joins its dependent if that dependent is its only dependent, if it
+    is that dependent's only dependency, and if nobody asked for it by name or
+    restricted where it runs.
+
+    Returns the smaller graph, its dependencies, and a mapping from the last
+    key of each chain to the ``(key, task)`` pairs to run, in order, before it.
+
+    >>> dsk = {'x': 1, 'y': (inc, 'x'), 'z': (inc, 'y')}  # doctest: +SKIP
+    >>> dependencies = {'x': set(), 'y': {'x'}, 'z': {'y'}}
+    >>> fuse_chains(dsk, dependencies, ['z'])  # doctest: +SKIP
+    ({'z': (inc, 'y')}, {'z': set()}, {'z': [('x', 1), ('y', (inc, 'x'))]})
+
+    See Also
+    --------
+    distributed.utils.execute_chain
+    """
+    keys = set(keys)
+    restrictions = restrictions or {}
+    dependents = defaultdict(set)
+    for key in dsk:
+        for dep in dependencies.get(key, ()):
+            dependents[dep].add(key)
+
+    parent = dict()
+    for key in dsk:
+        if (key in keys or key in restrictions or key not in dependencies or
+            len(dependents[key]) != 1):
+            continue
+        child, = dependents[key]
+        if (child in dependencies and len(dependencies[child]) == 1 and
+            child not in restrictions):
+            parent[child] = key
+
+    if not parent:
+        return dsk, dependencies, {}
+
+    fused_keys = set(parent.values())
+    dsk2 = {k: v for k, v in dsk.items() if k not in fused_keys}
+    dependencies2 = {k: v for k, v in dependencies.items()
+                          if k not in fused_keys}
+    fused = dict()
+    for key in dsk2:
+        if key in parent:
+            chain = [parent[key]]
+            while chain[-1] in parent:
+                chain.append(parent[chain[-1]])
+            chain.reverse()
+            fused[key] = [(k, dsk[k]) for k in chain]
+            dependencies2[key] = set(dependencies[chain[0]])
+    return dsk2, dependencies2, fused
+
+
+def graph_dependencies(dsk, dependencies):
+    """ Dependencies of each task restricted to keys within the graph
+
+    This is the form that ``dask.order`` expects.  We use it to order graphs
+    without looking inside of their tasks.
+
+    >>> dsk = {'x': b'...', 'y': b'...'}
+    >>> deps = graph_dependencies(dsk, {'x': {'a'}, 'y': {'x', 'a'}})
+    >>> deps['x'], deps['y']
+    (set(), {'x'})
+    """
+    return {key: {dep for dep in dependencies.get(key, ()) if dep in dsk}
+            for key in dsk}
+
+
 def validate_state(dependencies, dependents, waiting, waiting_data,
         in_memory, stacks, processing, finished_results, released, in_play,
         allow_overlap=False, **kwargs):
@@ -1204,7 +2786,7 @@ def keys_outside_frontier(dsk, dependencies, keys, frontier):
     ['b', 'z']
     """
     assert isinstance(keys, set)
-    assert isinstance(frontier, set)
+    assert isinstance(frontier, Set)
     stack = list(keys - frontier)
     result = set()
     while stack:
@@ -1312,7 +2894,8 @@ _round_robin = [0]
 
 
 def assign_many_tasks(dependencies, waiting, keyorder, who_has, stacks,
-        restrictions, loose_restrictions, nbytes, keys):
+        restrictions, loose_restrictions, nbytes, keys, hosts=None,
+        resources=None, resource_restrictions=None, unrunnable=None):
     """ Assign many new ready tasks to workers
 
     Often at the beginning of computation we have to assign many new leaves to
@@ -1325,14 +2908,21 @@ def assign_many_tasks(dependencies, waiting, keyorder, who_has, stacks,
     This mutates waiting and stacks in place and returns a dictionary,
     new_stacks, that serves as a diff between the old and new stacks.  These
     new tasks have yet to be put on worker queues.
+
+    Optionally provide a mapping from hostname to workers, ``hosts``, to
+    speed up placement of restricted tasks, and the resources of workers and
+    tasks.  See ``decide_worker``.  Tasks that need resources which no worker
+    has go into the set ``unrunnable``.
     """
+    resource_restrictions = resource_restrictions or {}
     leaves = list()  # ready tasks without data dependencies
     ready = list()   # ready tasks with data dependencies
     new_stacks = defaultdict(list)
 
     for k in keys:
         assert not waiting.pop(k)
-        if not dependencies[k] and k not in restrictions:
+        if (not dependencies[k] and k not in restrictions and
+            k not in resource_restrictions):
             leaves.append(k)
         else:
             ready.append(k)
@@ -1356,7 +2946,13 @@ def assign_many_tasks(dependencies, waiting, keyorder, who_has, stacks,
 
     for key in ready:
         worker = decide_worker(dependencies, stacks, who_has, restrictions,
-                loose_restrictions, nbytes, key)
+                loose_restrictions, nbytes, key, hosts, resources,
+                resource_restrictions)
+        if worker is None:
+            if unrunnable is None:
+                raise ValueError("Task has no valid workers", key)
+            unrunnable.add(key)
+            continue
         new_stacks[worker].append(key)
         stacks[worker].append(key)
 
@@ -1370,12 +2966,16 @@ def heal_missing_data(dsk, dependencies, dependents, held_data,
 
     When we identify that we're missing certain keys we rewind runtime state to
     evaluate those keys.
+
+    Returns the set of keys that were added back into play.
     """
     logger.debug("Healing missing: %s", missing)
     for key in missing:
         if key in in_play:
             in_play.remove(key)
 
+    added = set()
+
     def ensure_key(key):
         if key in in_play:
             return
@@ -1387,36 +2987,10 @@ def heal_missing_data(dsk, dependencies, dependents, held_data,
         waiting_data[key] = {dep for dep in dependents[key] if dep in in_play
                                                     and dep not in in_memory}
         in_play.add(key)
+        added.add(key)
 
     for key in missing:
         ensure_key(key)
 
     assert set(missing).issubset(in_play)
-
-
-def cover_aliases(dsk, new_keys):
-    """ Replace aliases with calls to identity
-
-    Warning: operates in place
-
-    >>> dsk = {'x': 1, 'y': 'x'}
-    >>> cover_aliases(dsk, ['y'])  # doctest: +SKIP
-    {'x': 1, 'y': (<function identity ...>, 'x')}
-    """
-    for key in new_keys:
-        try:
-            if dsk[key] in dsk:
-                dsk[key] = (identity, dsk[key])
-        except TypeError:
-            pass
-
-    return dsk
-
-
-def execute_task(task):
-    """ Evaluate a nested task """
-    if istask(task):
-        func, args = task[0], task[1:]
-        return func(*map(execute_task, args))
-    else:
-        return task
+    return added
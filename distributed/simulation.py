@@ -0,0 +1,364 @@
+""" Simulate the scheduler against fake workers
+
+This drives a ``Scheduler`` directly, without networking or task execution,
+so that we can measure the cost of scheduling decisions on their own.  Tasks
+are never run.  Instead each worker "finishes" tasks on a simulated clock
+after a configurable duration, transfer time and result size.
+
+>>> dsk, keys = tree_reduction(64)
+>>> result = simulate(dsk, keys, nworkers=4, duration=1)  # doctest: +SKIP
+>>> result['makespan']  # doctest: +SKIP
+16.0
+
+Run a standard suite of graphs from the command line with::
+
+    $ python -m distributed.simulation --nworkers 16 --n 10000
+
+On Python 3 this also reports the memory that the scheduler holds per task.
+"""
+from __future__ import print_function, division, absolute_import
+
+import heapq
+from timeit import default_timer
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+from tornado.queues import Queue
+
+from .scheduler import Scheduler, PriorityStack, BANDWIDTH
+
+
+def _task(*args):
+    """ Placeholder task function, never called """
+
+
+def map_graph(n):
+    """ Embarrassingly parallel map of ``n`` independent tasks
+
+    >>> dsk, keys = map_graph(3)
+    >>> sorted(keys)
+    [('x', 0), ('x', 1), ('x', 2)]
+    """
+    dsk = {('x', i): (_task, i) for i in range(n)}
+    return dsk, list(dsk)
+
+
+def tree_reduction(n, width=2):
+    """ Reduce ``n`` leaves to a single key, ``width`` inputs at a time
+
+    >>> dsk, keys = tree_reduction(4)
+    >>> keys
+    [('sum', 2, 0)]
+    >>> dsk[('sum', 1, 1)]  # doctest: +SKIP
+    (<function _task>, ('sum', 0, 2), ('sum', 0, 3))
+    """
+    dsk = {('sum', 0, i): (_task, i) for i in range(n)}
+    level = 0
+    while n > 1:
+        m = (n + width - 1) // width
+        for i in range(m):
+            deps = [('sum', level, j)
+                    for j in range(i * width, min((i + 1) * width, n))]
+            dsk[('sum', level + 1, i)] = (_task,) + tuple(deps)
+        level += 1
+        n = m
+    return dsk, [('sum', level, 0)]
+
+
+def shuffle_graph(n, splits=None):
+    """ All-to-all shuffle of ``n`` inputs into ``n`` outputs
+
+    Each input is split into ``splits`` pieces, each output gathers one piece
+    from every input.  ``splits`` defaults to ``n``.
+
+    >>> dsk, keys = shuffle_graph(2)
+    >>> sorted(keys)
+    [('out', 0), ('out', 1)]
+    >>> len(dsk)
+    8
+    """
+    splits = splits or n
+    dsk = {}
+    for i in range(n):
+        dsk[('in', i)] = (_task, i)
+        for j in range(splits):
+            dsk[('split', i, j)] = (_task, ('in', i), j)
+    for j in range(splits):
+        dsk[('out', j)] = (_task,) + tuple(('split', i, j) for i in range(n))
+    return dsk, [('out', j) for j in range(splits)]
+
+
+def chain_graph(n):
+    """ A single long chain of ``n`` dependent tasks
+
+    >>> dsk, keys = chain_graph(3)
+    >>> keys
+    [('chain', 2)]
+    """
+    dsk = {('chain', 0): (_task, 0)}
+    for i in range(1, n):
+        dsk[('chain', i)] = (_task, ('chain', i - 1))
+    return dsk, [('chain', n - 1)]
+
+
+graphs = {'map': map_graph,
+          'tree': tree_reduction,
+          'shuffle': shuffle_graph,
+          'chain': chain_graph}
+
+
+def _call(f, key):
+    return f(key) if callable(f) else f
+
+
+def add_fake_workers(s, nworkers, ncores=1):
+    """ Register workers with a scheduler without starting them
+
+    Messages for each worker accumulate in ``s.worker_queues`` and are never
+    consumed unless the caller does so.
+    """
+    workers = [('127.0.0.%d' % (i + 1), 8000) for i in range(nworkers)]
+    for w in workers:
+        s.ncores[w] = ncores
+        s.nannies[w] = None
+        s.has_what[w] = set()
+        s.processing[w] = set()
+        s.stacks[w] = PriorityStack(s.keyorder)
+        s.worker_queues[w] = Queue()
+        s.hosts[w[0]].add(w)
+    s.status = 'running'
+    return workers
+
+
+def simulate(dsk, keys, nworkers=4, ncores=1, duration=0.1, nbytes=1000,
+             bandwidth=BANDWIDTH, lose_workers=(), steal_interval=0.1,
+             release=True, scheduler=None):
+    """ Run a graph through the scheduler on simulated workers
+
+    Parameters
+    ----------
+    dsk: dict
+        Dask graph to schedule
+    keys: list
+        Output keys, held on behalf of a fake client
+    nworkers: int
+        Number of fake workers
+    ncores: int
+        Cores per fake worker
+    duration: float or callable
+        Seconds each task takes, or a function mapping key to seconds
+    nbytes: int or callable
+        Size of each result, or a function mapping key to bytes
+    bandwidth: float
+        Bytes per second used to charge transfers of non-local dependencies
+    lose_workers: iterable of floats
+        Simulated times at which to remove a worker, with healing
+    steal_interval: float
+        Simulated seconds between calls to ``Scheduler.work_steal``.
+        Set to ``None`` to disable stealing.
+    release: bool
+        Release the output keys at the end, as a client would
+    scheduler: Scheduler, optional
+        Scheduler to drive, a fresh one by default
+
+    Returns
+    -------
+    Dictionary with the following entries
+
+    *  **ntasks**: number of tasks in the graph
+    *  **transitions**: number of tasks that finished, including recomputation
+    *  **makespan**: simulated seconds from submission to completion
+    *  **scheduler_time**: wall clock seconds spent inside the scheduler
+    *  **time_per_task**: ``scheduler_time / transitions``
+    *  **state_size**: peak number of keys in the scheduler's per-key state
+    *  **final_state_size**: keys left after they are released
+    *  **lost_workers**: workers removed during the simulation
+
+    Tasks that ``Scheduler.ensure_occupied`` sends to a worker finish on the
+    simulated clock after ``duration`` plus time to move any dependencies
+    not already on that worker.  Only calls into the scheduler count towards
+    ``scheduler_time``.
+    """
+    s = scheduler or Scheduler(ip='127.0.0.1')
+    add_fake_workers(s, nworkers, ncores)
+
+    events = []     # heap of (finish time, counter, worker, key)
+    counter = [0]
+    clock = [0.0]
+    elapsed = [0.0]
+    peak = [0]
+
+    def timed(func, *args, **kwargs):
+        start = default_timer()
+        result = func(*args, **kwargs)
+        elapsed[0] += default_timer() - start
+        return result
+
+    def drain():
+        """ Start the tasks the scheduler sent out, track state size """
+        for w, q in s.worker_queues.items():
+            while q.qsize():
+                msg = q.get_nowait()
+                if msg['op'] != 'compute-task':
+                    continue
+                key = msg['key']
+                comm = sum(s.nbytes.get(dep, 0)
+                           for dep, who in msg['who_has'].items()
+                           if w not in who)
+                end = clock[0] + _call(duration, key) + comm / bandwidth
+                counter[0] += 1
+                heapq.heappush(events, (end, counter[0], w, key))
+        peak[0] = max(peak[0], state_size(s))
+
+    losses = sorted(lose_workers)
+    lost = []
+    next_steal = steal_interval
+    transitions = 0
+
+    timed(s.update_graph, dsk=dict(dsk), keys=list(keys))
+    drain()
+
+    while events:
+        end, _, w, key = heapq.heappop(events)
+        while losses and losses[0] <= end and len(s.ncores) > 1:
+            clock[0] = losses.pop(0)
+            victim = max(s.processing, key=lambda v: len(s.processing[v]))
+            timed(s.remove_worker, address=victim)
+            lost.append(victim)
+            drain()
+        while steal_interval and next_steal <= end:
+            clock[0] = next_steal
+            timed(s.work_steal)
+            next_steal += steal_interval
+            drain()
+        if key not in s.processing.get(w, ()):
+            continue  # worker was lost or key was released
+        clock[0] = end
+        transitions += 1
+        timed(s.mark_task_finished, key, w, _call(nbytes, key),
+              duration=_call(duration, key))
+        drain()
+
+    makespan = clock[0]
+    if release:
+        timed(s.release_held_data, keys=list(keys))
+
+    return {'ntasks': len(dsk),
+            'transitions': transitions,
+            'makespan': makespan,
+            'scheduler_time': elapsed[0],
+            'time_per_task': elapsed[0] / max(transitions, 1),
+            'state_size': peak[0],
+            'final_state_size': state_size(s),
+            'lost_workers': lost}
+
+
+def simulate_submit(n, nworkers=8, ncores=1, chain=False, nbytes=1000,
+                    scheduler=None):
+    """ Submit ``n`` single tasks one at a time, as ``Executor.submit`` does
+
+    Each task is sent as its own ``update_graph`` call.  Tasks finish as soon
+    as they reach a worker.  If ``chain`` is true then each task depends on
+    the previous one, as in ``x = e.submit(f, x)``.
+
+    Returns a dictionary with the number of submits, the wall clock seconds
+    spent in ``update_graph``, and ``submits_per_second``.
+    """
+    s = scheduler or Scheduler(ip='127.0.0.1')
+    add_fake_workers(s, nworkers, ncores)
+
+    elapsed = 0
+    for i in range(n):
+        key = ('submit', i)
+        if chain and i:
+            task = (_task, ('submit', i - 1))
+        else:
+            task = (_task, i)
+
+        start = default_timer()
+        s.update_graph(dsk={key: task}, keys=[key])
+        elapsed += default_timer() - start
+
+        for w, q in s.worker_queues.items():
+            while q.qsize():
+                msg = q.get_nowait()
+                if msg['op'] == 'compute-task':
+                    s.mark_task_finished(msg['key'], w, nbytes)
+
+    return {'submits': n,
+            'update_graph_time': elapsed,
+            'submits_per_second': n / max(elapsed, 1e-9)}
+
+
+def memory_per_task(dsk, keys, nworkers=8, ncores=1):
+    """ Bytes of scheduler state per task of a graph that has yet to run
+
+    We submit the graph to a fresh scheduler with fake workers and measure
+    what it allocates with ``tracemalloc``.  The tasks themselves are
+    allocated beforehand and do not count.  Returns ``None`` on Python 2,
+    which lacks ``tracemalloc``.
+    """
+    if tracemalloc is None:
+        return None
+    s = Scheduler(ip='127.0.0.1')
+    add_fake_workers(s, nworkers, ncores)
+    dsk, keys = dict(dsk), list(keys)
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        s.update_graph(dsk=dsk, keys=keys)
+        end = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return (end - start) / len(dsk)
+
+
+def state_size(s):
+    """ Number of keys in the scheduler's per-key state """
+    return len(s.tasks) + len(s.speculative)
+
+
+def main(n=1000, nworkers=8, ncores=1, lose=0):
+    """ Simulate each standard graph shape and print a summary line """
+    print('%-8s %8s %12s %10s %12s %10s %10s %10s' % ('graph', 'tasks',
+          'us/task', 'makespan', 'tasks/s', 'peak', 'final', 'bytes/task'))
+    for name in sorted(graphs):
+        k = int(n ** 0.5) if name == 'shuffle' else n
+        dsk, keys = graphs[name](k)
+        lose_workers = [0.1 * (i + 1) for i in range(lose)]
+        r = simulate(dsk, keys, nworkers=nworkers, ncores=ncores,
+                     lose_workers=lose_workers)
+        nbytes = memory_per_task(dsk, keys, nworkers, ncores)
+        print('%-8s %8d %12.1f %10.1f %12.0f %10d %10d %10s' % (name,
+              r['ntasks'], 1e6 * r['time_per_task'], r['makespan'],
+              r['transitions'] / max(r['scheduler_time'], 1e-9),
+              r['state_size'], r['final_state_size'],
+              '-' if nbytes is None else '%.0f' % nbytes))
+
+    print('')
+    for chain in [False, True]:
+        r = simulate_submit(n, nworkers=nworkers, ncores=ncores, chain=chain)
+        print('%-8s %8d submits %12.0f submits/s' % (
+              'submit' + ('-chain' if chain else ''), r['submits'],
+              r['submits_per_second']))
+
+
+if __name__ == '__main__':
+    import click
+
+    @click.command()
+    @click.option('--n', type=int, default=1000,
+                  help="Approximate number of tasks per graph")
+    @click.option('--nworkers', type=int, default=8,
+                  help="Number of simulated workers")
+    @click.option('--ncores', type=int, default=1,
+                  help="Cores per simulated worker")
+    @click.option('--lose', type=int, default=0,
+                  help="Number of workers to lose during each run")
+    def go(n, nworkers, ncores, lose):
+        main(n=n, nworkers=nworkers, ncores=ncores, lose=lose)
+
+    go()
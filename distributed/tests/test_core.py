@@ -5,7 +5,8 @@ import socket
 from tornado import gen, ioloop
 import pytest
 
-from distributed.core import read, write, pingpong, Server, rpc, connect
+from distributed.core import (read, write, pingpong, Server, rpc, connect,
+        spanning_tree, dumps, loads)
 from distributed.utils_test import slow, loop
 
 def test_server(loop):
@@ -128,3 +129,42 @@ def test_ports(loop):
         assert server3.port > 1024
     finally:
         server3.stop()
+
+
+def test_spanning_tree():
+    def nodes(tree):
+        for node, subtree in tree:
+            yield node
+            for n in nodes(subtree):
+                yield n
+
+    def depth(tree):
+        return 1 + max([depth(subtree) for _, subtree in tree] or [0])
+
+    tree = spanning_tree(range(100), fanout=3)
+    assert len(tree) == 3
+    assert sorted(nodes(tree)) == list(range(100))
+    assert depth(tree) <= 5
+
+    assert spanning_tree([], fanout=3) == []
+    assert spanning_tree([1, 2], fanout=3) == [(1, []), (2, [])]
+
+
+double = lambda x: 2 * x
+
+
+def make_adder(n):
+    def add(x):
+        return x + n
+    return add
+
+
+def test_dumps_functions_by_value():
+    # The C pickler refuses these, it can't find them by name in this module
+    assert loads(dumps(double))(2) == 4
+    assert loads(dumps(make_adder(1)))(2) == 3
+    assert loads(dumps({'op': 'compute', 'function': make_adder(2)}))[
+            'function'](2) == 4
+
+    msg = {'op': 'update-graph', 'dsk': {'x': b'123'}, 'keys': ['x']}
+    assert loads(dumps(msg)) == msg
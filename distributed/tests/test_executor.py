@@ -4,13 +4,17 @@ from operator import add, sub
 from collections import Iterator
 from concurrent.futures import CancelledError
 from datetime import timedelta
+from hashlib import md5
+from itertools import count
 import os
 import shutil
 import sys
+import tempfile
+import threading
 from time import sleep, time
 
 import pytest
-from toolz import identity, isdistinct, first
+from toolz import identity, isdistinct, first, concat
 from tornado.ioloop import IOLoop
 from tornado.iostream import IOStream
 from tornado import gen
@@ -19,7 +23,9 @@ from distributed import Center, Worker
 from distributed.core import rpc
 from distributed.client import WrappedKey
 from distributed.executor import (Executor, Future, _wait, wait, _as_completed,
-        as_completed, tokenize, _global_executor, default_executor)
+        as_completed, tokenize, _global_executor, default_executor,
+        merge_graph_updates, unpack_graph, split_graph)
+from distributed.diagnostics.plugin import SchedulerPlugin
 from distributed.scheduler import Scheduler
 from distributed.sizeof import sizeof
 from distributed.utils import ignoring, sync, tmp_text
@@ -69,7 +75,7 @@ def test_map(s, a, b):
     result = yield L2[1]._result()
     assert result == inc(inc(1))
     assert len(s.dask) == 10
-    assert L1[0].key in s.dask[L2[0].key]
+    assert L1[0].key in s.dependencies[L2[0].key]
 
     total = e.submit(sum, L2)
     result = yield total._result()
@@ -270,6 +276,48 @@ def test_gather(s, a, b):
     yield e._shutdown()
 
 
+@gen_cluster()
+def test_gather_direct_from_workers(s, a, b):
+    e = Executor((s.ip, s.port), start=False)
+    yield e._start()
+    gathers = []
+
+    def gather(stream=None, keys=None):
+        gathers.append(keys)
+        return Scheduler.gather(s, keys=keys)
+    s.handlers['gather'] = gather
+
+    x = e.submit(inc, 10)
+    L = e.map(inc, range(5))
+    result = yield e._gather([x] + L)
+    assert result == [11] + list(range(1, 6))
+    assert not gathers
+
+    result = yield e._gather(x, direct=False)
+    assert result == 11
+    assert len(gathers) == 1
+
+    yield e._shutdown()
+
+
+@gen_cluster()
+def test_gather_falls_back_to_scheduler(s, a, b):
+    e = Executor((s.ip, s.port), start=False)
+    yield e._start()
+
+    x = e.submit(inc, 10)
+    yield _wait([x])
+
+    def who_has(stream=None, keys=None):  # workers that we can not reach
+        return {key: {('127.0.0.1', 1)} for key in keys}
+    s.handlers['who_has'] = who_has
+
+    result = yield e._gather(x)
+    assert result == 11
+
+    yield e._shutdown()
+
+
 def test_gather_sync(loop):
     with cluster() as (s, [a, b]):
         with Executor(('127.0.0.1', s['port']), loop=loop) as e:
@@ -362,6 +410,39 @@ def test_as_completed(loop):
             assert set(seq) == {x, y, z}
 
 
+def test_imap(loop):
+    with cluster() as (s, [a, b]):
+        with Executor(('127.0.0.1', s['port']), loop=loop) as e:
+            seq = e.imap(inc, count(), maxsize=10)
+            assert isinstance(seq, Iterator)
+            results = []
+            for result in seq:
+                assert len(e.refcount) <= 10
+                results.append(result)
+                if len(results) == 50:
+                    break
+            assert results == list(map(inc, range(50)))
+
+            results = e.imap(add, range(20), range(5, 25), maxsize=3,
+                             ordered=False, pure=False)
+            assert sorted(results) == [i + j for i, j in zip(range(20),
+                                                             range(5, 25))]
+
+            assert list(e.imap(inc, [])) == []
+
+            seq = e.imap(div, [1, 1, 0, 1], [1, 1, 1, 0], maxsize=2)
+            assert next(seq) == 1
+            assert next(seq) == 1
+            assert next(seq) == 0
+            with pytest.raises(ZeroDivisionError):
+                next(seq)
+
+            with pytest.raises(ValueError):
+                e.imap(inc, [1], maxsize=0)
+            with pytest.raises(TypeError):
+                e.imap(1, [1])
+
+
 def test_wait_sync(loop):
     with cluster() as (s, [a, b]):
         with Executor(('127.0.0.1', s['port']), loop=loop) as e:
@@ -830,6 +911,10 @@ def test_aliases(s, a, b):
     result = yield e._get(dsk, 'y')
     assert result == 2
 
+    dsk = {'x': 1, 'y': 'x', 'z': 'not-a-key'}
+    result = yield e._get(dsk, ['y', 'z'])
+    assert result == [1, 'not-a-key']
+
     yield e._shutdown()
 
 
@@ -1020,6 +1105,112 @@ def test_directed_scatter(s, a, b):
     yield e._shutdown()
 
 
+@gen_cluster()
+def test_scatter_direct_to_workers(s, a, b):
+    e = Executor((s.ip, s.port), start=False)
+    yield e._start()
+
+    def scatter(stream=None, data=None, workers=None):
+        assert False, "data should not pass through the scheduler"
+    s.handlers['scatter'] = scatter
+
+    [big] = yield e._scatter([b'0' * 1000000], workers=[a.address])
+    assert s.nbytes[big.key] > 1000000
+    L = yield e._scatter(list(range(10)))
+    assert all(s.who_has[f.key] == {b.address} for f in L)  # a is full
+    assert set(b.data) == {f.key for f in L}
+
+    d = yield e._scatter({'x': 1, 'y': 2})
+    assert s.who_has['x'] and s.who_has['y']
+    assert {'x', 'y'}.issubset(s.held_data)
+    result = yield e._gather(d)
+    assert result == {'x': 1, 'y': 2}
+
+    yield e._shutdown()
+
+
+@gen_cluster([('127.0.0.1', 1)] * 5)
+def test_replicate(s, *workers):
+    e = Executor((s.ip, s.port), start=False)
+    yield e._start()
+
+    [x] = yield e._scatter([1], workers=[workers[0].address])
+    y = e.submit(inc, x)
+    yield e._replicate([x, y], n=3)
+    assert len(s.who_has[x.key]) == 3
+    assert len(s.who_has[y.key]) == 3
+    assert sum(x.key in w.data for w in workers) == 3
+    assert all(y.key in s.has_what[w] for w in s.who_has[y.key])
+
+    yield e._replicate([x])
+    assert s.who_has[x.key] == {w.address for w in workers}
+    assert all(w.data[x.key] == 1 for w in workers)
+
+    yield e._shutdown()
+
+
+@gen_cluster([('127.0.0.1', 1)] * 4)
+def test_scatter_broadcast(s, *workers):
+    e = Executor((s.ip, s.port), start=False)
+    yield e._start()
+
+    copies = []
+    original = s.rpc
+
+    def rpc(ip=None, port=None):  # record each round of copies
+        r = original(ip=ip, port=port)
+        copies.append((ip, port))
+        return r
+    s.rpc = rpc
+
+    d = yield e._scatter({'table': list(range(100))}, broadcast=True)
+    assert d['table'].key == 'table'
+    assert s.who_has['table'] == {w.address for w in workers}
+    assert all(w.data['table'] == list(range(100)) for w in workers)
+    assert len(copies) == 3
+
+    addresses = [workers[0].address, workers[1].address]
+    [x] = yield e._scatter([1], workers=addresses, broadcast=True)
+    assert s.who_has[x.key] == set(addresses)
+
+    yield e._shutdown()
+
+
+@gen_cluster([('127.0.0.1', 1)] * 3)
+def test_rebalance(s, a, b, c):
+    e = Executor((s.ip, s.port), start=False)
+    yield e._start()
+
+    L = yield e._scatter(list(range(100, 112)), workers=[a.address])
+    assert len(a.data) == 12
+    yield e._rebalance()
+    assert sorted(map(len, s.has_what.values())) == [4, 4, 4]
+    assert all(len(s.who_has[f.key]) == 1 for f in L)
+    result = yield e._gather(L)
+    assert result == list(range(100, 112))
+
+    while len(a.data) > 4:  # originals deleted soon after the move
+        yield gen.sleep(0.01)
+    assert all(set(w.data) == s.has_what[w.address] for w in [a, b, c])
+
+    yield e._shutdown()
+
+
+@gen_cluster([('127.0.0.1', 1)] * 3)
+def test_rebalance_restricted(s, a, b, c):
+    e = Executor((s.ip, s.port), start=False)
+    yield e._start()
+
+    L = yield e._scatter(list(range(100, 106)), workers=[a.address])
+    M = yield e._scatter(list(range(106, 112)), workers=[a.address])
+    yield e._rebalance(futures=L, workers=[a.address, b.address])
+    assert not s.has_what[c.address]
+    assert all(f.key in s.has_what[a.address] for f in M)
+    assert len(s.has_what[b.address]) == 6
+
+    yield e._shutdown()
+
+
 def test_directed_scatter_sync(loop):
     with cluster() as (s, [a, b]):
         with Executor(('127.0.0.1', s['port']), loop=loop) as e:
@@ -1233,6 +1424,67 @@ def test_upload_file(s, a, b):
     yield e._shutdown()
 
 
+@gen_cluster()
+def test_upload_file_sends_new_content_only(s, a, b):
+    e = Executor((s.ip, s.port), start=False)
+    yield e._start()
+    cache = tempfile.mkdtemp()
+    a.upload_cache = b.upload_cache = cache
+
+    sent = []
+    original = a.handlers['upload_file']
+
+    def upload_file(stream, data=None, **kwargs):
+        sent.append(data)
+        return original(stream, data=data, **kwargs)
+    a.handlers['upload_file'] = upload_file
+
+    with tmp_text('myfile3.py', 'x = 1') as fn:
+        yield e._upload_file(fn)
+        yield e._upload_file(fn)
+    assert len([d for d in sent if d is not None]) == 1
+
+    with tmp_text('myfile3.py', 'x = 2') as fn:
+        yield e._upload_file(fn)
+    assert len([d for d in sent if d is not None]) == 2
+
+    shutil.rmtree(cache)
+    yield e._shutdown()
+
+
+@gen_cluster()
+def test_upload_file_resends_to_missing_workers_only(s, a, b):
+    e = Executor((s.ip, s.port), start=False, direct_to_workers=False)
+    yield e._start()
+    a.upload_cache = tempfile.mkdtemp()
+    b.upload_cache = tempfile.mkdtemp()
+
+    sent = {a.address: [], b.address: []}
+
+    def record(w):
+        original = w.handlers['upload_file']
+
+        def upload_file(stream, data=None, **kwargs):
+            sent[w.address].append(data)
+            return original(stream, data=data, **kwargs)
+        w.handlers['upload_file'] = upload_file
+    record(a)
+    record(b)
+
+    with tmp_text('myfile4.py', 'x = 1') as fn:
+        with open(fn, 'rb') as f:
+            data = f.read()
+        b.upload_file(None, filename='myfile4.py', data=data,
+                      checksum=md5(data).hexdigest())
+        yield e._upload_file(fn)
+    assert sent[a.address] == [None, data]
+    assert sent[b.address] == [None]
+
+    shutil.rmtree(a.upload_cache)
+    shutil.rmtree(b.upload_cache)
+    yield e._shutdown()
+
+
 def test_upload_file_sync(loop):
     with cluster() as (s, [a, b]):
         with Executor(('127.0.0.1', s['port'])) as e:
@@ -1476,6 +1728,22 @@ def test_executor_with_scheduler(loop):
     _test_scheduler(f)
 
 
+@gen_cluster()
+def test_submit_with_resources(s, a, b):
+    s.resources[b.address] = {'X': 1}
+    s.available_resources[b.address] = {'X': 1}
+    e = Executor((s.ip, s.port), start=False)
+    yield e._start()
+
+    L = e.map(inc, range(5), resources={'X': 1})
+    x = e.submit(inc, 10, resources={'X': 1})
+    yield _wait(L + [x])
+    assert all(s.who_has[f.key] == {b.address} for f in L + [x])
+    assert s.available_resources[b.address] == {'X': 1}
+
+    yield e._shutdown()
+
+
 @pytest.mark.skipif(sys.platform!='linux',
                     reason="Need 127.0.0.2 to mean localhost")
 @gen_cluster([('127.0.0.1', 1), ('127.0.0.2', 2)])
@@ -1528,3 +1796,316 @@ def test_allow_restrictions(s, a, b):
 
     with pytest.raises(TypeError):
         e.map(inc, [20], workers='127.0.0.1', allow_other_workers='Hello!')
+
+
+def test_merge_graph_updates():
+    a = {'op': 'update-graph', 'dsk': {'x': 1}, 'keys': ['x']}
+    b = {'op': 'update-graph', 'dsk': {'y': (inc, 'x')}, 'keys': ['y'],
+         'restrictions': {'y': ['alice']}, 'loose_restrictions': {'y'}}
+    merge_graph_updates(a, b)
+    assert a == {'op': 'update-graph',
+                 'dsk': {'x': 1, 'y': (inc, 'x')},
+                 'keys': ['x', 'y'],
+                 'restrictions': {'y': ['alice']},
+                 'loose_restrictions': {'y'}}
+
+
+def test_merge_graph_updates_dependencies():
+    a = {'op': 'update-graph', 'dsk': {'x': 1}, 'keys': ['x'],
+         'dependencies': {'x': set()}}
+    b = {'op': 'update-graph', 'dsk': {'y': (inc, 'x')}, 'keys': ['y'],
+         'dependencies': {'y': {'x'}}}
+    merge_graph_updates(a, b)
+    assert a['dependencies'] == {'x': set(), 'y': {'x'}}
+
+
+def test_unpack_graph():
+    x = WrappedKey('x')
+    dsk = {'y': (add, x, 'z'), 'z': [(inc, 1), 2], 'w': 'w', 'v': 'z',
+           'u': x}
+    dsk2, dependencies = unpack_graph(dsk)
+    assert dsk2 == {'y': (add, x.key, 'z'), 'z': [(inc, 1), 2],
+                    'v': (identity, 'z'), 'u': (identity, x.key)}
+    assert dependencies == {'y': {x.key, 'z'}, 'z': set(), 'v': {'z'},
+                            'u': {x.key}}
+
+
+@gen_cluster()
+def test_client_sends_dependencies(s, a, b):
+    e = Executor((s.ip, s.port), start=False)
+    yield e._start()
+
+    x = e.submit(inc, 1)
+    y = e.submit(add, x, 10)
+    zs = e.map(add, [x, y], [1, 2])
+    result = yield e._get({'w': (inc, y), 'v': (add, 'w', 1)}, 'v')
+    assert result == 14
+
+    assert s.dependencies[y.key] == {x.key}
+    assert s.dependencies[zs[1].key] == {y.key}
+    assert s.dependencies['w'] == {y.key}
+    assert s.dependencies['v'] == {'w'}
+
+    yield e._shutdown()
+
+
+@gen_cluster()
+def test_release_batches_keys(s, a, b):
+    e = Executor((s.ip, s.port), start=False)
+    yield e._start()
+
+    futures = e.map(inc, range(100))
+    result = yield e._gather(futures)
+    assert result == list(map(inc, range(100)))
+    assert len(s.held_data) == 100
+
+    keys = [f.key for f in futures]
+    del futures
+    assert [m['op'] for m in e._pending_messages] == ['release-held-data']
+    assert sorted(e._pending_messages[0]['keys']) == sorted(keys)
+
+    start = time()
+    while s.held_data or a.data or b.data:
+        yield gen.sleep(0.01)
+        assert time() < start + 2
+    assert not s.who_has
+
+    yield e._shutdown()
+
+
+@gen_cluster()
+def test_submit_batches_graph_updates(s, a, b):
+    class Counter(SchedulerPlugin):
+        def __init__(self):
+            self.graphs = []
+
+        def update_graph(self, scheduler, dsk, keys, restrictions):
+            self.graphs.append(set(keys))
+
+    counter = Counter()
+    s.add_plugin(counter)
+
+    e = Executor((s.ip, s.port), start=False)
+    yield e._start()
+
+    futures = [e.submit(inc, i) for i in range(10)]
+    futures.append(e.submit(add, futures[0], futures[1], workers=a.ip))
+    futures.extend(e.map(dec, range(5)))
+
+    result = yield e._gather(futures)
+    assert result == [inc(i) for i in range(10)] + [3] + [dec(i) for i in range(5)]
+    assert counter.graphs == [{f.key for f in futures}]
+    assert s.restrictions[futures[10].key] == {a.ip}
+
+    x = e.submit(inc, 100)
+    e._send_to_scheduler({'op': 'release-held-data', 'keys': [x.key]})
+    y = e.submit(inc, 101)
+    yield y._result()
+    assert counter.graphs[1:] == [{x.key}, {y.key}]
+
+    yield e._shutdown()
+
+
+@gen_cluster()
+def test_buffered_messages_flush_on_executor_loop(s, a, b):
+    e = Executor((s.ip, s.port), start=False)
+    yield e._start()
+
+    x = e.submit(inc, 1)  # nothing but the flush timer sends this
+    start = time()
+    while x.status != 'finished':
+        yield gen.sleep(0.01)
+        assert time() < start + 2
+
+    yield e._shutdown()
+
+
+@gen_cluster()
+def test_release_while_holding_pending_lock(s, a, b):
+    e = Executor((s.ip, s.port), start=False)
+    yield e._start()
+
+    x = e.submit(inc, 1)
+    yield x._result()
+
+    # Garbage collection may release futures on the thread that is already
+    # buffering or sending a message
+    with e._pending_lock:
+        e._release_key(x.key)
+
+    start = time()
+    while s.held_data:
+        yield gen.sleep(0.01)
+        assert time() < start + 2
+
+    yield e._shutdown()
+
+
+def test_messages_written_from_event_loop(loop):
+    from distributed.diagnostics.progressbar import flush_futures
+    with cluster() as (s, [a, b]):
+        with Executor(('127.0.0.1', s['port']), loop=loop) as e:
+            threads = []
+            send_now = e._send_now
+
+            def record_thread(msg):
+                threads.append(threading.current_thread())
+                return send_now(msg)
+
+            e._send_now = record_thread
+
+            x = e.submit(inc, 1)
+            flush_futures([x])  # as progress bars do, from this thread
+            e._send_to_scheduler({'op': 'release-held-data', 'keys': []})
+            e._send_to_scheduler({'op': 'missing-data', 'missing': []})
+            assert x.result() == 2
+
+            assert threads
+            assert set(threads) == {e._loop_thread}
+
+
+class Unpicklable(object):
+    """ Serializes fine but fails when loaded, as if a library were missing """
+    def __reduce__(self):
+        return (_fail_to_load, ())
+
+
+def _fail_to_load():
+    raise ImportError("Cannot load this object here")
+
+
+@gen_cluster()
+def test_scheduler_keeps_tasks_serialized(s, a, b):
+    e = Executor((s.ip, s.port), start=False)
+    yield e._start()
+
+    x = e.submit(inc, 1)
+    y = e.submit(identity, Unpicklable())
+    zs = e.map(inc, [x, 10])
+    result = yield e._gather(zs)
+    assert result == [3, 11]
+
+    assert all(isinstance(s.dask[f.key], bytes) for f in [x, y] + zs)
+    assert s.dependencies[zs[0].key] == {x.key}
+
+    with pytest.raises(ImportError):
+        yield y._result()
+
+    yield e._shutdown()
+
+
+def test_split_graph():
+    dsk = {('x', i): (inc, i) for i in range(10)}
+    dsk.update({('y', i): (add, ('x', i), ('x', 9 - i)) for i in range(10)})
+    dsk['z'] = (sum, [('y', i) for i in range(10)])
+    dependencies = unpack_graph(dsk)[1]
+
+    chunks = split_graph(dsk, dependencies, 6)
+    assert [len(chunk) for chunk, _ in chunks] == [6, 6, 6, 3]
+    assert set(concat(chunk for chunk, _ in chunks)) == set(dsk)
+
+    seen = set()
+    for chunk, boundary in chunks:
+        for key in chunk:
+            assert dependencies[key] <= seen | set(chunk)
+        seen.update(chunk)
+        later = set(concat(dependencies[k] for k in dsk if k not in seen))
+        assert boundary == set(chunk) & later
+
+
+class KeysRecorder(SchedulerPlugin):
+    def __init__(self):
+        self.keys = []
+
+    def update_graph(self, scheduler, dsk, keys, restrictions):
+        self.keys.append(set(keys))
+
+
+@gen_cluster()
+def test_get_in_chunks(s, a, b):
+    recorder = KeysRecorder()
+    s.add_plugin(recorder)
+    e = Executor((s.ip, s.port), start=False)
+    yield e._start()
+
+    x = e.submit(inc, 100)
+    dsk = {('x', i): (inc, i) for i in range(20)}
+    dsk.update({('y', i): (add, ('x', i), ('x', 19 - i)) for i in range(20)})
+    dsk['z'] = (sum, [('y', i) for i in range(20)] + [x])
+
+    result = yield e._get(dsk, 'z', chunksize=8)
+    assert result == sum(2 * i + 2 for i in range(20)) + 101
+    assert len(recorder.keys) == 1 + 6
+    assert set.union(*recorder.keys) == {x.key, 'z'}  # boundary not wanted
+
+    while not s.held_data <= {x.key, 'z'} or len(s.dask) > 2:
+        yield gen.sleep(0.01)
+    s.validate()
+
+    yield e._shutdown()
+
+
+@gen_cluster()
+def test_get_in_chunks_does_not_fuse_boundary(s, a, b):
+    s.fuse = True
+    e = Executor((s.ip, s.port), start=False)
+    yield e._start()
+
+    # each ('a', i) is the only dependency of ('b', i), 'z' comes later
+    dsk = {('a', i): (inc, i) for i in range(10)}
+    dsk.update({('b', i): (inc, ('a', i)) for i in range(10)})
+    dsk['z'] = (sum, list(dsk))
+
+    result = yield e._get(dsk, 'z', chunksize=20)  # z comes alone
+    assert result == sum(2 * i + 3 for i in range(10))
+
+    yield e._shutdown()
+
+
+@gen_cluster()
+def test_messages_wait_behind_graph_pieces(s, a, b):
+    class Recorder(SchedulerPlugin):
+        def __init__(self):
+            self.keys = []
+
+        def update_graph(self, scheduler, dsk, keys, restrictions):
+            self.keys.append(set(dsk))
+
+    recorder = Recorder()
+    s.add_plugin(recorder)
+    e = Executor((s.ip, s.port), start=False)
+    yield e._start()
+
+    dsk = {('x', i): (inc, i) for i in range(20)}
+    dsk['z'] = (sum, list(dsk))
+    e._send_graph(dsk, {k: set(v[1]) if k == 'z' else set()
+                        for k, v in dsk.items()}, ['z'], chunksize=5)
+    assert e._pending_messages[-1]['op'] == 'graph-pieces'
+
+    y = e.submit(inc, 1)
+    e._send_to_scheduler({'op': 'release-held-data', 'keys': ['z']})
+    yield y._result()
+    assert len(recorder.keys) == 5 + 1
+    assert recorder.keys[-1] == {y.key}
+    assert not e._pending_messages and not e._sending_graph
+
+    yield e._shutdown()
+
+
+@gen_cluster()
+def test_fused_chains(s, a, b):
+    s.fuse = True
+    e = Executor((s.ip, s.port), start=False)
+    yield e._start()
+
+    x = e.submit(inc, 1)
+    dsk = {'a': (inc, x), 'b': (inc, 'a'), 'c': (add, 'b', 10)}
+    result = yield e._get(dsk, 'c')
+    assert result == 14
+    assert s.fused['c'] and 'a' not in s.dask and 'b' not in s.dask
+
+    dsk = {'p': (inc, 1), 'q': (div, 'p', 0), 'r': (inc, 'q')}
+    with pytest.raises(ZeroDivisionError):
+        yield e._get(dsk, 'r')
+
+    yield e._shutdown()
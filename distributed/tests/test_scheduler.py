@@ -1,8 +1,11 @@
 from copy import deepcopy
 from operator import add
-from time import time
+from time import time, sleep
+import os
+import shutil
+import tempfile
 
-from dask.core import get_deps
+from dask.core import get_deps, get_dependencies
 from toolz import merge, concat, valmap
 from tornado.queues import Queue
 from tornado.iostream import StreamClosedError
@@ -13,7 +16,11 @@ from distributed import Center, Nanny, Worker
 from distributed.core import connect, read, write, rpc
 from distributed.client import WrappedKey
 from distributed.scheduler import (validate_state, heal, update_state,
-        decide_worker, assign_many_tasks, heal_missing_data, Scheduler)
+        decide_worker, assign_many_tasks, heal_missing_data, steal_work,
+        PriorityStack, analyze_graph, fuse_chains,
+        find_stragglers, place_data, plan_replication, plan_rebalance,
+        Scheduler, TaskStateMapping, TaskStateSet, EMPTY)
+from distributed.simulation import add_fake_workers
 from distributed.utils_test import inc, ignoring
 
 
@@ -154,6 +161,30 @@ def test_update_state():
     assert in_play == {'x', 'y', 'a', 'z'}
 
 
+def test_update_state_with_given_dependencies():
+    dsk = {'x': 1}
+    dependencies = {'x': set()}
+    dependents = {'x': set()}
+    waiting = dict()
+    waiting_data = {'x': set()}
+    held_data = {'x'}
+    who_has = {'x': {'alice'}}
+    in_play = {'x'}
+
+    # the tasks are opaque to the scheduler, only the given dependencies count
+    new_dsk = {'y': 'opaque', 'z': (add, 'x', 'y')}
+    new_dependencies = {'y': {'x', 'unknown'}}
+
+    update_state(dsk, dependencies, dependents, held_data,
+                 who_has, in_play,
+                 waiting, waiting_data, new_dsk, {'z'}, new_dependencies)
+
+    assert dependencies['y'] == {'x'}
+    assert dependencies['z'] == {'x', 'y'}
+    assert dependents['x'] == {'y', 'z'}
+    assert waiting == {'y': set(), 'z': {'y'}}
+
+
 def test_update_state_with_processing():
     dsk = {'x': 1, 'y': (inc, 'x'), 'z': (inc, 'y')}
     dependencies, dependents = get_deps(dsk)
@@ -319,6 +350,86 @@ def test_decide_worker_with_loose_restrictions():
 
 
 
+def test_decide_worker_with_hosts():
+    alice, bob, charlie = ('alice', 8000), ('bob', 8000), ('charlie', 8000)
+    alice2 = ('alice', 8001)
+    stacks = {alice: [1, 2], alice2: [1], bob: [], charlie: []}
+    hosts = {'alice': {alice, alice2}, 'bob': {bob}, 'charlie': {charlie}}
+    restrictions = {'x': {'alice', 'david'}}
+
+    result = decide_worker({'x': set()}, stacks, {}, restrictions, set(), {},
+                           'x', hosts)
+    assert result == alice2
+
+    who_has = {'y': {alice, bob}}
+    result = decide_worker({'x': {'y'}}, stacks, who_has, restrictions,
+                           set(), {'y': 10}, 'x', hosts)
+    assert result == alice
+
+    restrictions = {'x': {'david'}}
+    with pytest.raises(ValueError):
+        decide_worker({'x': set()}, stacks, {}, restrictions, set(), {},
+                      'x', hosts)
+    result = decide_worker({'x': set()}, stacks, {}, restrictions, {'x'}, {},
+                           'x', hosts)
+    assert result in {bob, charlie}
+
+
+def test_priority_stack():
+    keyorder = {'a': (0, 3), 'b': (0, 1), 'c': (1, 0), 'd': (0, 2)}
+    stack = PriorityStack(keyorder)
+    stack.extend(['a', 'c', 'b'])
+    assert len(stack) == 3 and stack and 'b' in stack
+    stack.append('d')
+
+    assert stack.pop() == 'b'
+    stack.remove('d')
+    assert 'd' not in stack
+    with pytest.raises(ValueError):
+        stack.remove('d')
+    assert stack == ['c', 'a']
+    assert stack.pop() == 'a'
+    assert stack.pop() == 'c'
+    assert not stack
+    with pytest.raises(IndexError):
+        stack.pop()
+
+
+def test_priority_stack_lifo_without_keyorder():
+    stack = PriorityStack({}, [1, 2, 3])
+    assert [stack.pop() for i in range(3)] == [3, 2, 1]
+
+
+def test_priority_stack_pops_keys_without_keyorder_first():
+    stack = PriorityStack({'x': (0, 0), 'y': (0, 1)}, ['x', 'z', 'y'])
+    assert list(stack) == ['y', 'x', 'z']
+    assert [stack.pop() for i in range(3)] == ['z', 'x', 'y']
+
+
+def test_priority_stack_compacts_removed_keys():
+    stack = PriorityStack({}, range(1000))
+    for i in range(900):
+        stack.remove(i)
+    assert len(stack.heap) < 500
+    assert list(stack) == list(range(900, 1000))
+
+
+def test_priority_stack_iterates_from_bottom_without_resorting():
+    stack = PriorityStack({}, range(10))
+    assert list(stack) == list(range(10))
+    entries = stack.sorted
+    for i in range(5):
+        assert next(iter(stack)) == i
+        stack.remove(i)
+    assert stack.pop() == 9
+    assert list(stack) == [5, 6, 7, 8]
+    assert stack.sorted is entries
+    assert stack.bottom == 5
+
+    stack.append(0)
+    assert list(stack) == [5, 6, 7, 8, 0]
+
+
 def test_decide_worker_without_stacks():
     with pytest.raises(ValueError):
         result = decide_worker({'x': []}, [], {}, {}, set(), {}, 'x')
@@ -420,6 +531,193 @@ def test_assign_many_tasks_with_restrictions():
     assert set(concat(new_stacks.values())) == set(concat(stacks.values()))
 
 
+def test_steal_work():
+    alice, bob, charlie = ('alice', 8000), ('bob', 8000), ('charlie', 8000)
+    dependencies = {c: set() for c in 'abcdef'}
+    stacks = {alice: list('abcdef'), bob: [], charlie: []}
+    processing = {alice: {'z'}, bob: set(), charlie: {'y'}}
+    ncores = {alice: 1, bob: 2, charlie: 1}
+
+    moves = steal_work(stacks, processing, ncores, dependencies, {}, {},
+                       set(), {}, {})
+
+    assert stacks[bob] == ['a', 'b']
+    assert stacks[alice] == list('cdef')
+    assert not stacks[charlie]  # busy, not idle
+    assert moves == [('a', alice, bob), ('b', alice, bob)]
+
+
+def test_steal_work_respects_communication_costs():
+    alice, bob = ('alice', 8000), ('bob', 8000)
+    dependencies = {'a': {'x'}, 'b': set()}
+    who_has = {'x': {alice}}
+    nbytes = {'x': 1e9}
+    stacks = {alice: ['a', 'b'], bob: []}
+    processing = {alice: {'z'}, bob: set()}
+    ncores = {alice: 1, bob: 1}
+
+    moves = steal_work(stacks, processing, ncores, dependencies, who_has, {},
+                       set(), nbytes, {'a': 0.001})
+    assert moves == [('b', alice, bob)]
+    assert stacks == {alice: ['a'], bob: ['b']}
+
+
+def test_steal_work_respects_restrictions():
+    alice, bob = ('alice', 8000), ('bob', 8000)
+    dependencies = {'a': set(), 'b': set()}
+    stacks = {alice: ['a', 'b'], bob: []}
+    processing = {alice: {'z'}, bob: set()}
+    ncores = {alice: 1, bob: 1}
+    restrictions = {'a': {'alice'}, 'b': {'alice'}}
+
+    moves = steal_work(stacks, processing, ncores, dependencies, {},
+                       restrictions, set(), {}, {})
+    assert not moves
+
+    moves = steal_work(stacks, processing, ncores, dependencies, {},
+                       restrictions, {'b'}, {}, {})
+    assert moves == [('b', alice, bob)]
+
+
+def test_steal_work_respects_resources():
+    alice, bob = ('alice', 8000), ('bob', 8000)
+    dependencies = {'a': set(), 'b': set()}
+    stacks = {alice: ['a', 'b'], bob: []}
+    processing = {alice: {'z'}, bob: set()}
+    ncores = {alice: 1, bob: 1}
+    resources = {alice: {'GPU': 1}}
+    resource_restrictions = {'a': {'GPU': 1}, 'b': {'GPU': 1}}
+
+    moves = steal_work(stacks, processing, ncores, dependencies, {},
+                       {}, set(), {}, {}, resources=resources,
+                       resource_restrictions=resource_restrictions)
+    assert not moves
+
+    del resource_restrictions['b']
+    moves = steal_work(stacks, processing, ncores, dependencies, {},
+                       {}, set(), {}, {}, resources=resources,
+                       resource_restrictions=resource_restrictions)
+    assert moves == [('b', alice, bob)]
+
+
+def test_decide_worker_with_resources():
+    alice, bob = ('alice', 8000), ('bob', 8000)
+    dependencies = {'x': set()}
+    stacks = {alice: [], bob: []}
+    resources = {bob: {'GPU': 2}}
+
+    assert decide_worker(dependencies, stacks, {}, {}, set(), {}, 'x',
+                         resources=resources,
+                         resource_restrictions={'x': {'GPU': 1}}) == bob
+
+    # no worker has these resources yet, wait for one
+    assert decide_worker(dependencies, stacks, {}, {}, set(), {}, 'x',
+                         resources=resources,
+                         resource_restrictions={'x': {'GPU': 3}}) is None
+
+    assert decide_worker(dependencies, stacks, {}, {'x': {'alice'}}, set(),
+                         {}, 'x', resources=resources,
+                         resource_restrictions={'x': {'GPU': 1}}) is None
+
+
+def test_find_stragglers():
+    alice, bob, charlie = ('alice', 8000), ('bob', 8000), ('charlie', 8000)
+    stacks = {alice: [], bob: [], charlie: []}
+    processing = {alice: {'x-1', 'y-1'}, bob: {'x-2'}, charlie: set()}
+    ncores = {alice: 2, bob: 2, charlie: 1}
+    task_start = {'x-1': 0, 'y-1': 0, 'x-2': 5}
+    task_duration = {'x': 1, 'y': 0.5}
+
+    dups = find_stragglers(stacks, processing, ncores, task_start,
+                           task_duration, 10, 1)
+    assert dups == [('y-1', alice, bob)]
+
+    dups = find_stragglers(stacks, processing, ncores, task_start,
+                           task_duration, 10, 5)
+    assert [key for key, _, _ in dups] == ['y-1', 'x-1']  # two free cores
+    assert {thief for _, _, thief in dups} == {bob, charlie}
+
+    assert not find_stragglers(stacks, processing, ncores, task_start,
+                               task_duration, 10, 5,
+                               exclude={'x-1', 'x-2', 'y-1'})
+    assert not find_stragglers(merge(stacks, {bob: ['z']}), processing,
+                               ncores, task_start, task_duration, 10, 5)
+
+    dups = find_stragglers(stacks, processing, ncores, task_start,
+                           task_duration, 10, 5, exclude={'x-2', 'y-1'},
+                           restrictions={'x-1': {'bob'}})
+    assert dups == [('x-1', alice, bob)]
+
+
+def test_place_data():
+    alice, bob = ('alice', 8000), ('bob', 8000)
+    nbytes = {i: 10 for i in range(6)}
+    placement = place_data(nbytes, {}, {alice: 1, bob: 2})
+    assert sum(w == alice for w in placement.values()) == 2
+    assert sum(w == bob for w in placement.values()) == 4
+
+    placement = place_data(nbytes, {alice: 1000}, {alice: 1, bob: 1})
+    assert set(placement.values()) == {bob}
+
+    placement = place_data({'big': 100, 'small': 1}, {}, {alice: 1, bob: 1})
+    assert placement['big'] != placement['small']
+
+
+def test_plan_replication():
+    workers = [('w%d' % i, 8000) for i in range(8)]
+    who_has = {'x': {workers[0]}}
+    rounds = 0
+    while True:
+        moves = plan_replication(who_has, 8, workers, {}, {'x': 10})
+        if not moves:
+            break
+        sources = [source for _, source, _ in moves]
+        assert len(sources) == len(set(sources))  # each sends one copy
+        for key, source, target in moves:
+            assert target not in who_has[key]
+            who_has[key].add(target)
+        rounds += 1
+    assert who_has['x'] == set(workers)
+    assert rounds == 3
+
+    moves = plan_replication({'x': {workers[0]}, 'y': {workers[1]}}, 2,
+                             workers[:3], {workers[2]: 100}, {})
+    assert {target for _, _, target in moves} == {workers[1], workers[0]}
+
+
+def test_plan_rebalance():
+    alice, bob, charlie = ('alice', 8000), ('bob', 8000), ('charlie', 8000)
+    has_what = {alice: {'a%d' % i for i in range(6)}, bob: set(),
+                charlie: {'c'}}
+    nbytes = merge({'a%d' % i: 10 for i in range(6)}, {'c': 30})
+
+    moves = plan_rebalance(has_what, nbytes, [alice, bob, charlie])
+    assert len(moves) == 3
+    assert all(source == alice and target == bob
+               for _, source, target in moves)
+
+    moves = plan_rebalance(has_what, nbytes, [alice, bob, charlie],
+                           keys={'a0', 'a1'})
+    assert {key for key, _, _ in moves} == {'a0', 'a1'}
+
+    moves = plan_rebalance({alice: {'c'}, bob: set()}, nbytes, [alice, bob])
+    assert moves == []  # moving the only key would not help
+
+    has_what[bob] = {'a0'}
+    moves = plan_rebalance(has_what, nbytes, [alice, bob])
+    assert 'a0' not in [key for key, _, _ in moves]
+
+
+def test_plan_rebalance_skips_targets_holding_key():
+    alice, bob, charlie = ('alice', 8000), ('bob', 8000), ('charlie', 8000)
+    has_what = {alice: {'x', 'p', 'q'}, bob: {'x'}, charlie: {'c'}}
+    nbytes = {'x': 5, 'p': 10, 'q': 10, 'c': 6}
+
+    # bob has the least memory but already holds x, so x goes to charlie
+    moves = plan_rebalance(has_what, nbytes, [alice, bob, charlie])
+    assert moves == [('x', alice, charlie)]
+
+
 def test_fill_missing_data():
     dsk = {'x': 1, 'y': (inc, 'x'), 'z': (inc, 'y')}
     dependencies, dependents = get_deps(dsk)
@@ -632,6 +930,454 @@ def test_remove_worker_from_scheduler(s, a, b):
     s.validate()
 
 
+@gen_cluster()
+def test_remove_worker_recomputes_lost_data(s, a, b):
+    s.update_graph(dsk={'x': (inc, 1), 'y': (inc, 'x'), 'z': (inc, 'y'),
+                        'a': (inc, 10)},
+                   keys=['z', 'a'])
+    while not (s.who_has.get('z') and s.who_has.get('a')):
+        yield gen.sleep(0.01)
+
+    lost, = s.who_has['z']
+    other = a.address if lost == b.address else b.address
+    if s.who_has['a'] == {lost}:
+        s.update_data(who_has={'a': {other}}, nbytes={'a': s.nbytes['a']})
+    waiting_data = s.waiting_data.copy()
+
+    s.remove_worker(address=lost)
+
+    assert 'z' in s.in_play and not s.who_has.get('z')
+    assert s.waiting['z'] == {'y'}
+    assert s.stacks[other] == ['x'] or s.processing[other] == {'x'}
+    assert s.who_has['a'] == {other}
+    assert s.waiting_data.get('a') is waiting_data['a']  # untouched
+    s.validate()
+
+    while not s.who_has.get('z'):
+        yield gen.sleep(0.01)
+    assert s.who_has['z'] == {other}
+
+
+@pytest.mark.parametrize('heal', [True, False])
+def test_lose_dependency_after_dependent_is_ready(heal):
+    s = Scheduler(ip='127.0.0.1')
+    alice, bob = add_fake_workers(s, 2)
+
+    def sent(worker):
+        q = s.worker_queues[worker]
+        return [q.get_nowait()['key'] for i in range(q.qsize())]
+
+    s.update_graph(dsk={'x': (inc, 1)}, keys=['x'])
+    holder = alice if sent(alice) else bob
+    other = bob if holder == alice else alice
+    s.mark_task_finished('x', holder, 8)
+
+    # other is busy, so y waits on its stack while x sits on holder
+    s.update_graph(dsk={'z': (inc, 2)}, keys=['z'],
+                   restrictions={'z': {other[0]}})
+    s.update_graph(dsk={'y': (inc, 'x')}, keys=['y'],
+                   restrictions={'y': {other[0]}})
+    assert sent(other) == ['z']
+    assert s.stacks[other] == ['y']
+
+    s.remove_worker(address=holder, heal=heal)
+    assert not s.who_has.get('x')
+
+    s.mark_task_finished('z', other, 8)
+    assert sent(other) == ['x']
+    assert s.waiting.get('y') == {'x'} or s.stacks[other] == ['y']
+
+    s.mark_task_finished('x', other, 8)
+    assert sent(other) == ['y']
+    s.mark_task_finished('y', other, 8)
+    assert s.who_has['y'] == {other}
+
+
+@gen_cluster()
+def test_hosts_index(s, a, b):
+    assert s.hosts == {'127.0.0.1': {a.address, b.address}}
+
+    w = Worker(s.ip, s.port, ncores=1, ip='127.0.0.1')
+    yield w._start(0)
+    assert s.hosts['127.0.0.1'] == {a.address, b.address, w.address}
+
+    s.remove_worker(address=w.address)
+    assert s.hosts['127.0.0.1'] == {a.address, b.address}
+    s.remove_worker(address=a.address)
+    s.remove_worker(address=b.address)
+    assert not s.hosts
+
+    yield w._close()
+
+
+@gen_cluster()
+def test_update_graph_shares_resolved_restrictions(s, a, b):
+    dsk = {('x', i): (inc, i) for i in range(10)}
+    s.update_graph(dsk=dsk, keys=list(dsk),
+                   restrictions={k: ['localhost'] for k in dsk})
+    assert s.restrictions[('x', 0)] == {'127.0.0.1'}
+    assert len({id(r) for r in s.restrictions.values()}) == 1
+
+    while not all(s.who_has.get(k) for k in dsk):
+        yield gen.sleep(0.01)
+
+
+@gen_cluster()
+def test_update_graph_single_tasks(s, a, b):
+    for i in range(4):
+        s.update_graph(dsk={('x', i): (inc, i)}, keys=[('x', i)])
+        assert s.keyorder[('x', i)] == (0, 0)
+    assert s.generation == 0
+    assert all(s.stacks[w] or s.processing[w] for w in [a.address, b.address])
+
+    s.update_graph(dsk={'y': (add, ('x', 0), ('x', 1))}, keys=['y'])
+    while not s.who_has.get('y'):
+        yield gen.sleep(0.01)
+    assert (a.data.get('y') or b.data.get('y')) == 3
+    s.validate()
+
+
+def test_task_state_views():
+    tasks = dict()
+    dsk = TaskStateMapping(tasks, 'task', missing=object())
+    dependents = TaskStateMapping(tasks, 'dependents')
+    who_has = TaskStateMapping(tasks, 'who_has', default=set)
+    held_data = TaskStateSet(tasks, 'held')
+
+    dsk['x'] = None  # a task may be None
+    dsk['y'] = (inc, 'x')
+    assert dsk == {'x': None, 'y': (inc, 'x')}
+    assert set(tasks) == {'x', 'y'}
+
+    dependents['x'] = {'y'}
+    tasks['y'].dependents = EMPTY
+    assert dependents.get('y') is EMPTY
+    dependents['y'].add('z')  # materialized on read
+    assert tasks['y'].dependents == {'z'}
+
+    assert 'x' not in who_has
+    who_has['x'].add('alice')
+    assert who_has == {'x': {'alice'}}
+    del who_has['x']
+    assert not who_has and 'x' in tasks
+
+    held_data |= {'x'}
+    assert held_data == {'x'} and tasks['x'].held
+    assert held_data & {'x', 'y'} == {'x'}
+    held_data.discard('x')
+    assert not held_data
+
+
+def test_analyze_graph():
+    dsk = {('x', 0): 1,
+           ('x', 1): (inc, ('x', 0)),
+           'y': (add, [('x', 0), {'a': ('x', 1)}], 'z'),
+           'w': (sum, [slice(0, 1), 'y', 'q'])}
+    internal, outside, priorities = analyze_graph(dsk)
+
+    assert internal == {('x', 0): set(), ('x', 1): {('x', 0)},
+                        'y': {('x', 0), ('x', 1)}, 'w': {'y'}}
+    assert outside['y'] == {'z'}
+    assert outside['w'] == {'q'}
+    assert outside[('x', 0)] == {1}  # may have been a key
+    assert set(priorities) == set(dsk)
+
+
+@gen_cluster()
+def test_update_graph_in_thread(s, a, b):
+    s.background_graph_size = 10
+    s.update_graph(dsk={'x': (inc, 1)}, keys=['x'])
+
+    dsk = {('y', i): (add, 'x', i) for i in range(20)}
+    future = s.handle_update_graph(dsk=dsk, keys=list(dsk))
+    assert isinstance(future, gen.Future)
+    yield future
+
+    assert s.dependencies[('y', 0)] == {'x'}
+    assert s.keyorder[('y', 0)][0] == s.generation - 1
+    while not all(s.who_has.get(k) for k in dsk):
+        yield gen.sleep(0.01)
+    s.validate()
+
+
+@gen_cluster()
+def test_update_graph_is_synchronous(s, a, b):
+    s.background_graph_size = 10
+    dsk = {('x', i): (inc, i) for i in range(20)}
+    s.update_graph(dsk=dsk, keys=list(dsk))  # called directly, as by plugins
+
+    assert all(k in s.dependencies for k in dsk)
+    assert s._graph_thread is None  # never needed
+    while not all(s.who_has.get(k) for k in dsk):
+        yield gen.sleep(0.01)
+
+
+@gen_test()
+def test_close_shuts_down_graph_thread():
+    s = Scheduler()
+    s.listen(0)
+    s.start()
+    assert s._graph_thread is None
+    yield s.graph_thread.submit(inc, 1)
+    assert not s.graph_thread._shutdown
+
+    yield s.close()
+    assert s.graph_thread._shutdown
+
+
+def test_fuse_chains():
+    dsk = {'a': 1, 'b': (inc, 'a'), 'c': (inc, 'b'),    # chain a -> b -> c
+           'x': 1, 'y': (inc, 'x'), 'z': (add, 'y', 'c'),  # x -> y
+           'w': (inc, 'z'), 'v': (inc, 'z'),                # z is shared
+           'u': (inc, 'f')}                                 # f is a future
+    dependencies = {'a': set(), 'b': {'a'}, 'c': {'b'}, 'x': set(),
+                    'y': {'x'}, 'z': {'y', 'c'}, 'w': {'z'}, 'v': {'z'},
+                    'u': {'f'}}
+
+    dsk2, dependencies2, fused = fuse_chains(dsk, dependencies, ['w', 'v'])
+    assert set(dsk2) == {'c', 'y', 'z', 'w', 'v', 'u'}
+    assert fused == {'c': [('a', 1), ('b', (inc, 'a'))],
+                     'y': [('x', 1)]}
+    assert dependencies2['c'] == dependencies2['y'] == set()
+    assert dependencies2['z'] == {'y', 'c'}
+    assert dependencies2['u'] == {'f'}
+
+    _, _, fused = fuse_chains(dsk, dependencies, ['w', 'v', 'b'],
+                              restrictions={'x': {'alice'}})
+    assert fused == {'b': [('a', 1)]}
+
+
+@gen_cluster()
+def test_update_graph_fuses_chains(s, a, b):
+    s.fuse = True
+    dsk = {('x', i): (inc, i) for i in range(5)}
+    dsk.update({('y', i): (inc, ('x', i)) for i in range(5)})
+    dsk.update({('z', i): (add, ('y', i), 10) for i in range(5)})
+    dsk['total'] = (sum, [('z', i) for i in range(5)])
+    dependencies = {k: get_dependencies(dsk, k) for k in dsk}
+    s.update_graph(dsk=dsk, keys=['total'], dependencies=dependencies)
+
+    assert len(s.dask) == 6
+    assert s.dependencies[('z', 0)] == set()
+    while not s.who_has.get('total'):
+        yield gen.sleep(0.01)
+    result, = [w.data['total'] for w in [a, b] if 'total' in w.data]
+    assert result == sum(i + 12 for i in range(5))
+    assert not any(('x', 0) in w.data or ('y', 0) in w.data for w in [a, b])
+
+    s.release_held_data(keys=['total'])
+    assert not s.fused
+
+
+def slowinc(x, delay=0.05):
+    sleep(delay)
+    return x + 1
+
+
+@gen_cluster()
+def test_resources(s, a, b):
+    w = Worker(s.ip, s.port, ncores=4, ip='127.0.0.1',
+               resources={'GPU': 2})
+    yield w._start(0)
+    assert s.resources[w.address] == {'GPU': 2}
+
+    running = []
+
+    dsk = {('x', i): (slowinc, i) for i in range(10)}
+    s.update_graph(dsk=dsk, keys=list(dsk),
+                   resources={k: {'GPU': 1} for k in dsk})
+
+    while not all(s.who_has.get(k) for k in dsk):
+        running.append(len(s.processing[w.address]))
+        assert s.available_resources[w.address]['GPU'] >= 0
+        yield gen.sleep(0.01)
+
+    assert max(running) <= 2
+    assert all(s.who_has[k] == {w.address} for k in dsk)
+    assert s.available_resources[w.address] == {'GPU': 2}
+
+    s.release_held_data(keys=list(dsk))
+    yield w._close()
+
+
+def test_tasks_blocked_on_resources_keep_their_order():
+    dsk = {('x', i): (inc, i) for i in range(6)}
+    dsk.update({('y', i): (inc, i) for i in range(3)})
+
+    def run(resources):
+        s = Scheduler(ip='127.0.0.1')
+        w, = add_fake_workers(s, 1, ncores=4)
+        if resources:
+            s.resources[w] = {'GPU': 1}
+            s.available_resources[w] = {'GPU': 1}
+        s.update_graph(dsk=dict(dsk), keys=list(dsk), resources={
+            k: {'GPU': 1} for k in dsk if k[0] == 'x'} if resources else {})
+        q = s.worker_queues[w]
+        order = []
+        while q.qsize():
+            key = q.get_nowait()['key']
+            order.append(key)
+            s.mark_task_finished(key, w, 8)
+            if resources:
+                s.validate()
+                assert s.available_resources[w]['GPU'] >= 0
+                assert len(s.processing[w]) <= 4
+        return s, order
+
+    s, expected = run(False)
+    s, order = run(True)
+    assert sorted(order) == sorted(expected)
+    assert [k for k in order if k[0] == 'x'] == \
+           [k for k in expected if k[0] == 'x']
+    assert not s.resource_blocked
+    assert s.available_resources == {('127.0.0.1', 8000): {'GPU': 1}}
+
+
+def test_remove_last_worker_with_resources():
+    s = Scheduler(ip='127.0.0.1')
+    gpu, cpu = add_fake_workers(s, 2, ncores=2)
+    s.resources[gpu] = {'GPU': 1}
+    s.available_resources[gpu] = {'GPU': 1}
+
+    s.update_graph(dsk={'x': (inc, 1)}, keys=['x'],
+                   resources={'x': {'GPU': 1}})
+    s.update_graph(dsk={'y': (inc, 2)}, keys=['y'],
+                   restrictions={'y': [gpu[0]]}, loose_restrictions={'y'})
+    assert s.processing[gpu] == {'x', 'y'}
+
+    s.remove_worker(address=gpu)
+    assert s.unrunnable == {'x'}
+    assert s.processing[cpu] == {'y'}  # rescheduled all the same
+    s.validate()
+
+    s.update_graph(dsk={'z': (inc, 'y')}, keys=['z'],
+                   resources={'z': {'GPU': 1}})
+    s.mark_task_finished('y', cpu, 8)
+    assert s.unrunnable == {'x', 'z'}
+    s.validate()
+
+
+@gen_cluster()
+def test_resources_wait_for_worker(s, a, b):
+    s.update_graph(dsk={'x': (inc, 1)}, keys=['x'],
+                   resources={'x': {'GPU': 1}})
+    assert s.unrunnable == {'x'}
+
+    w = Worker(s.ip, s.port, ip='127.0.0.1', resources={'GPU': 1})
+    yield w._start(0)
+    while not s.who_has.get('x'):
+        yield gen.sleep(0.01)
+    assert s.who_has['x'] == {w.address}
+    assert not s.unrunnable
+    s.release_held_data(keys=['x'])
+
+    s.update_graph(dsk={'y': (slowinc, 1, 0.5)}, keys=['y'],
+                   resources={'y': {'GPU': 1}})
+    while 'y' not in s.processing[w.address]:
+        yield gen.sleep(0.01)
+    yield w._close()
+    while w.address in s.ncores:
+        yield gen.sleep(0.01)
+    assert s.unrunnable == {'y'}
+
+    w = Worker(s.ip, s.port, ip='127.0.0.1', resources={'GPU': 1})
+    yield w._start(0)
+    while not s.who_has.get('y'):
+        yield gen.sleep(0.01)
+    s.validate()
+
+    s.release_held_data(keys=['y'])
+    yield w._close()
+
+
+def slow_first_call(x, path):
+    """ Block the call that first creates ``path`` until ``path + '.go'``
+
+    Later calls return at once.
+    """
+    try:
+        os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except OSError:
+        return x + 1
+    end = time() + 10
+    while not os.path.exists(path + '.go') and time() < end:
+        sleep(0.01)
+    return x + 1
+
+
+@gen_cluster()
+def test_speculative_duplicates(s, a, b):
+    s.speculative_limit = 1
+    path = os.path.join(tempfile.mkdtemp(), 'claimed')
+    dsk = {('x', i): (inc, i) for i in range(1, 10)}
+    dsk[('x', 0)] = (slow_first_call, 0, path)
+    start = time()
+    s.update_graph(dsk=dsk, keys=list(dsk))
+
+    # A copy of the blocked task finishes elsewhere
+    while not all(s.who_has.get(k) for k in dsk):
+        yield gen.sleep(0.01)
+        assert time() < start + 5
+    assert not s.speculative
+    assert all(len(s.who_has[k]) == 1 for k in dsk)
+
+    # The slow copy keeps its core until its worker reports back
+    [loser] = s.losing_copies
+    assert s.losing_copies[loser] == {('x', 0)}
+    assert ('x', 0) in s.processing[loser]
+    s.validate()
+
+    open(path + '.go', 'w').close()
+    start = time()
+    while s.processing[loser]:
+        yield gen.sleep(0.01)
+        assert time() < start + 5
+    assert not s.losing_copies
+    assert s.who_has[('x', 0)] == {a.address, b.address} - {loser}
+    s.validate()
+    shutil.rmtree(os.path.dirname(path))
+
+
+@gen_cluster([('127.0.0.1', 1)] * 6)
+def test_broadcast_large_message_along_tree(s, *workers):
+    relays = []
+    for w in workers:
+        def relay(stream=None, msg=None, tree=None, w=w):
+            relays.append((w.address, len(tree)))
+            return Worker.relay(w, stream, msg=msg, tree=tree)
+        w.handlers['relay'] = relay
+
+    data = b'0' * 2000000
+    result = yield s.broadcast(None, msg={'op': 'upload_file', 'load': False,
+                                          'filename': 'big.dat', 'data': data})
+    assert result == {w.address: len(data) for w in workers}
+    assert sorted(address for address, _ in relays) == \
+            sorted(w.address for w in workers)
+    assert sum(n for _, n in relays) == 2  # forwarded by workers, not by us
+    assert all(os.path.exists(os.path.join(w.local_dir, 'big.dat'))
+               for w in workers)
+
+    relays[:] = []
+    result = yield s.broadcast(None, msg={'op': 'ping'})
+    assert result == {w.address: b'pong' for w in workers}
+    assert not relays
+
+
+@gen_cluster([('127.0.0.1', 1)] * 6)
+def test_broadcast_reports_failed_subtree(s, *workers):
+    def relay(stream=None, msg=None, tree=None):
+        raise ValueError('bad relay')
+    workers[0].handlers['relay'] = relay
+
+    data = b'0' * 2000000
+    result = yield s.broadcast(None, msg={'op': 'upload_file', 'load': False,
+                                          'filename': 'big.dat', 'data': data})
+    failed = {w for w, v in result.items() if isinstance(v, Exception)}
+    assert failed == {workers[0].address, workers[4].address}  # its subtree
+    assert all(result[w.address] == len(data)
+               for w in workers if w.address not in failed)
+
+
 @gen_cluster()
 def test_add_worker(s, a, b):
     w = Worker(s.ip, s.port, ncores=3, ip='127.0.0.1')
@@ -651,6 +1397,27 @@ def test_add_worker(s, a, b):
     s.validate(allow_overlap=True)
 
 
+@gen_cluster()
+def test_add_worker_steals_work(s, a, b):
+    dsk = {('x', i): (inc, i) for i in range(20)}
+    s.update_graph(dsk=dsk, keys=list(dsk))
+    assert s.stacks[a.address] or s.stacks[b.address]
+
+    w = Worker(s.ip, s.port, ncores=2, ip='127.0.0.1')
+    yield w._start(0)
+
+    assert s.stacks[w.address] or s.processing[w.address]
+    assert any(thief == w.address for _, _, _, thief in s.steal_log)
+    s.validate()
+
+    while not all(s.who_has.get(k) for k in dsk):
+        yield gen.sleep(0.01)
+
+    assert s.task_duration['x'] >= 0
+
+    yield w._close()
+
+
 @gen_cluster()
 def test_feed(s, a, b):
     def func(scheduler):
@@ -736,8 +1503,58 @@ def test_delete_data(s, a, b):
     assert set(a.data) | set(b.data) == {'x', 'y', 'z'}
 
     s.delete_data(keys=['x', 'y'])
+    assert set.union(*s.deleted_keys.values()) == {'x', 'y'}
+    assert set.union(*s.has_what.values()) == {'z'}
     yield s.clear_data_from_workers()
     assert set(a.data) | set(b.data) == {'z'}
+    assert not s.deleted_keys
+
+
+@gen_cluster()
+def test_release_held_data_forgets_keys(s, a, b):
+    dsk = {'x': (inc, 1), 'y': (inc, 'x'), 'z': (inc, 'y')}
+    s.update_graph(dsk=dsk, keys=['z'], restrictions={'x': [a.ip]})
+    while not s.who_has.get('z'):
+        yield gen.sleep(0.01)
+
+    assert not s.who_has.get('x') and not s.who_has.get('y')
+    assert 'x' in s.dask  # still referred to by z
+
+    s.release_held_data(keys=['z'])
+    for d in [s.dask, s.dependencies, s.dependents, s.nbytes, s.keyorder,
+              s.who_has, s.restrictions, s.waiting_data]:
+        assert not d
+    assert not s.in_play
+    assert not s.tasks
+
+
+@gen_cluster()
+def test_release_forgets_exceptions(s, a, b):
+    s.update_graph(dsk={'x': (div, 1, 0), 'y': (inc, 'x')}, keys=['y'])
+    while 'y' not in s.exceptions_blame:
+        yield gen.sleep(0.01)
+
+    s.release_held_data(keys=['y'])
+    assert not s.dask
+    assert not s.exceptions_blame and not s.tracebacks
+
+    # submitting again computes again, here without the failure
+    s.update_graph(dsk={'x': (div, 1, 1), 'y': (inc, 'x')}, keys=['y'])
+    while not s.who_has.get('y'):
+        yield gen.sleep(0.01)
+    assert not s.exceptions_blame
+
+
+@gen_cluster()
+def test_release_pending_key_forgotten_on_completion(s, a, b):
+    s.update_graph(dsk={'x': (inc, 1)}, keys=['x'])
+    s.release_held_data(keys=['x'])
+    assert 'x' in s.dask  # still computing
+
+    while 'x' in s.dask:
+        yield gen.sleep(0.01)
+    assert not s.who_has
+    assert not s.in_play
 
 
 @gen_cluster()
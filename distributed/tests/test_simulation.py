@@ -0,0 +1,64 @@
+from distributed.simulation import (simulate, simulate_submit, map_graph,
+        tree_reduction, shuffle_graph, chain_graph, graphs, memory_per_task,
+        tracemalloc)
+
+
+def test_map_graph_makespan():
+    dsk, keys = map_graph(40)
+    result = simulate(dsk, keys, nworkers=4, ncores=2, duration=1,
+                      steal_interval=None)
+
+    assert result['ntasks'] == result['transitions'] == 40
+    assert result['makespan'] == 5
+    assert result['time_per_task'] > 0
+    assert result['final_state_size'] == 0
+
+
+def test_chain_is_sequential():
+    dsk, keys = chain_graph(10)
+    result = simulate(dsk, keys, nworkers=4, duration=1, nbytes=0)
+    assert result['makespan'] == 10
+
+
+def test_all_graphs_complete():
+    for name, func in graphs.items():
+        dsk, keys = func(16)
+        result = simulate(dsk, keys, nworkers=3, duration=0.1)
+        assert result['transitions'] == len(dsk), name
+        assert result['state_size'] > 0
+        assert result['final_state_size'] == 0
+
+
+def test_lose_workers():
+    dsk, keys = tree_reduction(64)
+    result = simulate(dsk, keys, nworkers=4, duration=1,
+                      lose_workers=[2.5, 4.5])
+
+    assert len(result['lost_workers']) == 2
+    assert result['transitions'] >= len(dsk)
+    assert result['final_state_size'] == 0
+
+
+def test_duration_and_nbytes_callables():
+    dsk, keys = shuffle_graph(4)
+    durations = {'in': 1, 'split': 0.5, 'out': 2}
+    result = simulate(dsk, keys, nworkers=2,
+                      duration=lambda key: durations[key[0]],
+                      nbytes=lambda key: 1e6)
+    assert result['makespan'] > 1 + 0.5 + 2
+
+
+def test_simulate_submit():
+    for chain in [False, True]:
+        result = simulate_submit(50, nworkers=3, chain=chain)
+        assert result['submits'] == 50
+        assert result['submits_per_second'] > 0
+
+
+def test_memory_per_task():
+    dsk, keys = map_graph(100)
+    nbytes = memory_per_task(dsk, keys, nworkers=2)
+    if tracemalloc is None:
+        assert nbytes is None
+    else:
+        assert 0 < nbytes < 10000
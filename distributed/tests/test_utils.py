@@ -1,4 +1,7 @@
-from distributed.utils import All, sync, is_kernel, ensure_ip
+from operator import add
+
+from distributed.utils import (All, sync, is_kernel, ensure_ip,
+        execute_chain)
 from distributed.utils_test import loop, inc, throws
 import pytest
 from threading import Thread
@@ -96,3 +99,8 @@ def test_is_kernel():
 def test_ensure_ip():
     assert ensure_ip('localhost') == '127.0.0.1'
     assert ensure_ip('123.123.123.123') == '123.123.123.123'
+
+
+def test_execute_chain():
+    assert execute_chain(['x', 'y'], 1, (inc, 'x'), (add, 'y', 10)) == 12
+    assert execute_chain([], (inc, 1)) == 2
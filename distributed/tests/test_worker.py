@@ -1,17 +1,21 @@
+from hashlib import md5
 from operator import add
 import os
 import shutil
+import socket
 import sys
+import tempfile
 
 from distributed.center import Center
-from distributed.core import rpc
+from distributed.core import rpc, dumps, connect, send_recv
 from distributed.sizeof import sizeof
 from distributed.worker import Worker
-from distributed.utils_test import loop, _test_cluster, inc
+from distributed.utils_test import loop, _test_cluster, inc, gen_cluster
 import pytest
 
 from tornado import gen
 from tornado.ioloop import TimeoutError
+from tornado.iostream import IOStream
 
 
 def test_worker_ncores():
@@ -122,6 +126,29 @@ def test_workers_update_center(loop):
     _test_cluster(f)
 
 
+def test_compute_serialized_task(loop):
+    @gen.coroutine
+    def f(c, a, b):
+        aa = rpc(ip=a.ip, port=a.port)
+        bb = rpc(ip=b.ip, port=b.port)
+        yield aa.update_data(data={'x': 1})
+
+        response, info = yield bb.compute(key='y',
+                task=dumps((add, (inc, 'x'), 10)), who_has={'x': {a.address}})
+        assert response == b'OK'
+        assert b.data['y'] == 12
+
+        response, (error, traceback) = yield bb.compute(key='z',
+                task=b'not a pickle')
+        assert response == b'error'
+        assert 'z' not in b.data
+
+        aa.close_streams()
+        bb.close_streams()
+
+    _test_cluster(f)
+
+
 def test_delete_data_with_missing_worker(loop):
     @gen.coroutine
     def f(c, a, b):
@@ -145,6 +172,157 @@ def test_delete_data_with_missing_worker(loop):
     _test_cluster(f)
 
 
+def test_gather_from_peers_tracks_transfers(loop):
+    @gen.coroutine
+    def f(c, a, b):
+        a.data['x'] = b'0' * 10000
+        result = yield b.gather(who_has={'x': {a.address}}, report=False)
+        assert result[0] == b'OK'
+        assert b.data['x'] == a.data['x']
+        assert b.bandwidth[a.address] > 0
+        assert not b.transfers
+
+        yield a._close()
+        yield b._close()
+
+    _test_cluster(f)
+
+
+def test_fetches_are_coalesced(loop):
+    @gen.coroutine
+    def f(c, a, b):
+        for i in range(5):
+            a.data['x%d' % i] = i
+        calls = []
+        original = a.handlers['get_data']
+
+        def get_data(stream, keys=None, who=None):
+            calls.append(sorted(keys))
+            return original(stream, keys=keys, who=who)
+        a.handlers['get_data'] = get_data
+
+        r1, r2 = yield [b.gather_from_peers({'x0': {a.address},
+                                              'x1': {a.address}}),
+                        b.gather_from_peers({'x1': {a.address},
+                                              'x2': {a.address}})]
+        assert r1 == {'x0': 0, 'x1': 1}
+        assert r2 == {'x1': 1, 'x2': 2}
+        assert calls == [['x0', 'x1', 'x2']]
+        assert not b.fetching
+
+        b.fetch_batch = 2
+        del calls[:]
+        result = yield b.gather_from_peers({'x%d' % i: {a.address}
+                                            for i in range(5)})
+        assert result == {'x%d' % i: i for i in range(5)}
+        assert sorted(map(len, calls)) == [1, 2, 2]
+
+        try:
+            yield b.gather_from_peers({'x0': {a.address}, 'y': {a.address}})
+            assert False
+        except KeyError as e:
+            assert e.args == ('y',)
+        assert not b.fetching
+
+        yield a._close()
+        yield b._close()
+
+    _test_cluster(f)
+
+
+@gen_cluster(ncores=[('127.0.0.1', 1)] * 3)
+def test_fetch_retries_are_grouped_by_peer(s, a, b, c):
+    for i in range(3):
+        c.data['x%d' % i] = i
+    calls = []
+    original = c.handlers['get_data']
+
+    def get_data(stream, keys=None, who=None):
+        calls.append(sorted(keys))
+        return original(stream, keys=keys, who=who)
+    c.handlers['get_data'] = get_data
+
+    b.bandwidth[a.address] = 1e9  # try a, which lacks the data, first
+    b.bandwidth[c.address] = 1e6
+    result = yield b.gather_from_peers({'x%d' % i: {a.address, c.address}
+                                        for i in range(3)})
+    assert result == {'x0': 0, 'x1': 1, 'x2': 2}
+    assert calls == [['x0', 'x1', 'x2']]
+    assert not b.fetching and not b.fetch_who_has and not b.fetch_tried
+
+
+@gen_cluster(ncores=[('127.0.0.1', 1)] * 3)
+def test_fetch_in_flight_uses_peers_named_later(s, a, b, c):
+    b.data['x'] = 1
+    original = a.handlers['get_data']
+
+    @gen.coroutine
+    def slow_get_data(stream, keys=None, who=None):
+        yield gen.sleep(0.2)
+        result = yield original(stream, keys=keys, who=who)
+        raise gen.Return(result)
+    a.handlers['get_data'] = slow_get_data
+
+    first = c.gather_from_peers({'x': {a.address}})
+    yield gen.sleep(0.05)
+    assert c.fetch_tried['x'] == {a.address}
+    second = c.gather_from_peers({'x': {a.address, b.address}})
+    assert c.fetch_who_has['x'] == {b.address}
+
+    r1, r2 = yield [first, second]
+    assert r1 == r2 == {'x': 1}
+
+
+def test_outgoing_transfer_limit(loop):
+    @gen.coroutine
+    def f(c, a, b):
+        a.outgoing_limit = 1
+        a.data['x'] = 1
+        stream = yield connect(a.ip, a.port)
+        result = yield send_recv(stream, op='get_data', keys=['x'],
+                                 who=b.address)
+        assert result == {'x': 1}
+        assert len(a.outgoing) == 1
+
+        # a second connection waits until the first one closes
+        future = send_recv(ip=a.ip, port=a.port, op='get_data', keys=['x'],
+                           who=b.address, close=True)
+        yield gen.sleep(0.1)
+        assert not future.done()
+
+        # clients and the scheduler do not wait behind peers
+        result = yield send_recv(ip=a.ip, port=a.port, op='get_data',
+                                 keys=['x'], close=True)
+        assert result == {'x': 1}
+        assert len(a.outgoing) == 1
+
+        stream.close()
+        result = yield future
+        assert result == {'x': 1}
+        while a.outgoing:  # both connections closed
+            yield gen.sleep(0.01)
+
+        yield a._close()
+        yield b._close()
+
+    _test_cluster(f)
+
+
+@gen_cluster()
+def test_get_data_keeps_close_callback(s, a, b):
+    left, right = socket.socketpair()
+    stream, other = IOStream(left), IOStream(right)
+    closed = []
+    stream.set_close_callback(lambda: closed.append(True))
+
+    result = yield a.get_data(stream, keys=['x'], who=b.address)
+    assert result == {}
+    other.close()
+    while not closed:
+        yield gen.sleep(0.01)
+    stream.close()
+
+
 def test_upload_file(loop):
     @gen.coroutine
     def f(c, a, b):
@@ -177,6 +355,204 @@ def test_upload_file(loop):
     _test_cluster(f)
 
 
+def test_upload_file_by_checksum(loop):
+    @gen.coroutine
+    def f(c, a, b):
+        cache = tempfile.mkdtemp()
+        a.upload_cache = b.upload_cache = cache
+        data = b'x = 123'
+        checksum = md5(data).hexdigest()
+        aa = rpc(ip=a.ip, port=a.port)
+        bb = rpc(ip=b.ip, port=b.port)
+
+        result = yield aa.upload_file(filename='foobar2.py', checksum=checksum)
+        assert result is None  # ask for the data
+        result = yield aa.upload_file(filename='foobar2.py', checksum=checksum,
+                                      data=data)
+        assert result == len(data)
+        assert os.path.exists(os.path.join(cache, checksum, 'foobar2.py'))
+
+        # b shares the cache on this host, no need to send data
+        result = yield bb.upload_file(filename='foobar2.py', checksum=checksum)
+        assert result == len(data)
+        with open(os.path.join(b.local_dir, 'foobar2.py'), 'rb') as f:
+            assert f.read() == data
+
+        # unchanged content is neither written nor reloaded again
+        os.remove(os.path.join(a.local_dir, 'foobar2.py'))
+        result = yield aa.upload_file(filename='foobar2.py', checksum=checksum)
+        assert result == len(data)
+        assert not os.path.exists(os.path.join(a.local_dir, 'foobar2.py'))
+
+        yield a._close()
+        yield b._close()
+        aa.close_streams()
+        bb.close_streams()
+        shutil.rmtree(cache)
+
+    _test_cluster(f)
+
+
+def test_upload_file_loads_unchanged_file(loop):
+    @gen.coroutine
+    def f(c, a, b):
+        cache = tempfile.mkdtemp()
+        a.upload_cache = cache
+        data = b'x = 123'
+        checksum = md5(data).hexdigest()
+        aa = rpc(ip=a.ip, port=a.port)
+
+        result = yield aa.upload_file(filename='foobar5.py', data=data,
+                                      checksum=checksum, load=False)
+        assert result == len(data)
+        assert 'foobar5' not in sys.modules
+
+        # same content, but this time we must load it
+        result = yield aa.upload_file(filename='foobar5.py',
+                                      checksum=checksum, load=True)
+        assert result == len(data)
+        assert sys.modules['foobar5'].x == 123
+
+        # now it is loaded there is nothing left to do
+        os.remove(os.path.join(a.local_dir, 'foobar5.py'))
+        result = yield aa.upload_file(filename='foobar5.py',
+                                      checksum=checksum, load=False)
+        assert result == len(data)
+        assert not os.path.exists(os.path.join(a.local_dir, 'foobar5.py'))
+
+        del sys.modules['foobar5']
+        yield a._close()
+        yield b._close()
+        aa.close_streams()
+        shutil.rmtree(cache)
+
+    _test_cluster(f)
+
+
+def test_upload_file_checksum_mismatch(loop):
+    @gen.coroutine
+    def f(c, a, b):
+        cache = tempfile.mkdtemp()
+        a.upload_cache = cache
+        aa = rpc(ip=a.ip, port=a.port)
+
+        checksum = md5(b'x = 1').hexdigest()
+        result = yield aa.upload_file(filename='foobar3.py', checksum=checksum,
+                                      data=b'x = 2')
+        assert isinstance(result, ValueError)
+        assert not os.listdir(cache)
+        assert not os.path.exists(os.path.join(a.local_dir, 'foobar3.py'))
+
+        yield a._close()
+        yield b._close()
+        aa.close_streams()
+        shutil.rmtree(cache)
+
+    _test_cluster(f)
+
+
+def test_upload_cache_drops_least_recently_used(loop):
+    @gen.coroutine
+    def f(c, a, b):
+        cache = tempfile.mkdtemp()
+        a.upload_cache = cache
+        a.upload_cache_nbytes = 10
+        aa = rpc(ip=a.ip, port=a.port)
+
+        checksums = []
+        for i in range(3):
+            data = ('x%d = %d' % (i, i)).encode()  # 6 bytes each
+            checksums.append(md5(data).hexdigest())
+            yield aa.upload_file(filename='foobar4.py', data=data,
+                                 checksum=checksums[-1], load=False)
+            assert os.listdir(cache) == [checksums[-1]]
+
+        # using an entry keeps it over newer ones
+        a.upload_cache_nbytes = 12
+        data = b'y = 1'
+        yield aa.upload_file(filename='foobar5.py', data=data,
+                             checksum=md5(data).hexdigest(), load=False)
+        os.utime(os.path.join(cache, md5(data).hexdigest(), 'foobar5.py'),
+                 (1, 1))
+        os.utime(os.path.join(cache, checksums[-1], 'foobar4.py'), (0, 0))
+        yield aa.upload_file(filename='foobar4.py', checksum=checksums[-1],
+                             load=False)
+        data = b'z = 1'
+        yield aa.upload_file(filename='foobar6.py', data=data,
+                             checksum=md5(data).hexdigest(), load=False)
+        assert sorted(os.listdir(cache)) == sorted([checksums[-1],
+                                                    md5(data).hexdigest()])
+
+        yield a._close()
+        yield b._close()
+        aa.close_streams()
+        shutil.rmtree(cache)
+
+    _test_cluster(f)
+
+
+def test_upload_file_ignores_corrupt_cache(loop):
+    @gen.coroutine
+    def f(c, a, b):
+        cache = tempfile.mkdtemp()
+        a.upload_cache = cache
+        aa = rpc(ip=a.ip, port=a.port)
+
+        data = b'x = 1'
+        checksum = md5(data).hexdigest()
+        os.mkdir(os.path.join(cache, checksum))
+        with open(os.path.join(cache, checksum, 'foobar7.py'), 'wb') as f:
+            f.write(b'raise ValueError()')
+
+        result = yield aa.upload_file(filename='foobar7.py', checksum=checksum)
+        assert result is None  # ask for the data
+        assert not os.path.exists(os.path.join(a.local_dir, 'foobar7.py'))
+
+        yield a._close()
+        yield b._close()
+        aa.close_streams()
+        shutil.rmtree(cache)
+
+    _test_cluster(f)
+
+
+def test_upload_file_without_usable_cache(loop):
+    @gen.coroutine
+    def f(c, a, b):
+        fd, not_a_dir = tempfile.mkstemp()
+        os.close(fd)
+        caches = [not_a_dir]
+        if hasattr(os, 'geteuid') and os.geteuid() == 0:
+            other = tempfile.mkdtemp()
+            os.chown(other, 12345, -1)  # belongs to another user
+            caches.append(other)
+        aa = rpc(ip=a.ip, port=a.port)
+
+        for i, cache in enumerate(caches):
+            a.upload_cache = cache
+            filename = 'foobar8%d.py' % i
+            data = ('x = %d' % i).encode()
+            checksum = md5(data).hexdigest()
+            result = yield aa.upload_file(filename=filename,
+                                          checksum=checksum)
+            assert result is None
+            result = yield aa.upload_file(filename=filename, data=data,
+                                          checksum=checksum)
+            assert result == len(data)
+            with open(os.path.join(a.local_dir, filename), 'rb') as f:
+                assert f.read() == data
+
+        yield a._close()
+        yield b._close()
+        aa.close_streams()
+        os.remove(not_a_dir)
+        for cache in caches[1:]:
+            assert not os.listdir(cache)
+            shutil.rmtree(cache)
+
+    _test_cluster(f)
+
+
 def test_upload_egg(loop):
     @gen.coroutine
     def f(c, a, b):
@@ -10,6 +10,7 @@ import sys
 import tempfile
 
 from dask import istask
+from dask.core import subs
 from toolz import memoize
 from tornado import gen
 
@@ -196,6 +197,42 @@ def key_split(s):
         return 'Other'
 
 
+def execute_task(task):
+    """ Evaluate a nested task
+
+    >>> inc = lambda x: x + 1
+    >>> execute_task((inc, (inc, 1)))
+    3
+    >>> execute_task(1)
+    1
+    """
+    if istask(task):
+        func, args = task[0], task[1:]
+        return func(*map(execute_task, args))
+    else:
+        return task
+
+
+def execute_chain(keys, *tasks):
+    """ Evaluate a linear chain of tasks, each feeding the next
+
+    ``keys`` names the results of all tasks but the last.  Each task may
+    refer to the result of the task just before it by key.
+
+    >>> inc = lambda x: x + 1
+    >>> execute_chain(['x', 'y'], 1, (inc, 'x'), (inc, 'y'))
+    3
+
+    See Also
+    --------
+    distributed.scheduler.fuse_chains
+    """
+    result = execute_task(tasks[0])
+    for key, task in zip(keys, tasks[1:]):
+        result = execute_task(subs(task, key, result))
+    return result
+
+
 @contextmanager
 def log_errors():
     try:
@@ -221,6 +258,23 @@ def ensure_ip(hostname):
     else:
         return socket.gethostbyname(hostname)
 
+
+def parse_resources(text):
+    """ Parse abstract worker resources from the command line
+
+    >>> parse_resources('GPU=2 MEMORY=64e9')  # doctest: +SKIP
+    {'GPU': 2.0, 'MEMORY': 64000000000.0}
+    >>> parse_resources('LICENSE=1,GPU=1') == {'LICENSE': 1, 'GPU': 1}
+    True
+    >>> parse_resources('')
+    {}
+    """
+    resources = dict()
+    for item in text.replace(',', ' ').split():
+        name, quantity = item.split('=')
+        resources[name] = float(quantity)
+    return resources
+
 import logging
 logging.basicConfig(format='%(name)s - %(levelname)s - %(message)s',
                     level=logging.INFO)
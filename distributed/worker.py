@@ -2,6 +2,8 @@ from __future__ import print_function, division, absolute_import
 
 from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
+from functools import partial
+from hashlib import md5
 from importlib import import_module
 import logging
 from multiprocessing.pool import ThreadPool
@@ -10,26 +12,55 @@ import pkg_resources
 import tempfile
 import traceback
 import shutil
+import socket
+import stat
 import sys
+from time import time
 
-from toolz import merge
+from toolz import merge, partition_all
+from tornado.concurrent import Future
 from tornado.gen import Return
 from tornado import gen
 from tornado.ioloop import IOLoop, PeriodicCallback
 from tornado.iostream import StreamClosedError
+from tornado.locks import Condition, Semaphore
 
-from .client import _gather, pack_data, gather_from_workers
+from .client import _gather, pack_data, pick_source, _get_data
 from .compatibility import reload
-from .core import rpc, Server, pingpong
+from .core import rpc, Server, pingpong, loads, relay
 from .sizeof import sizeof
-from .utils import funcname, get_ip
+from .utils import funcname, get_ip, execute_task, execute_chain
 
 _ncores = ThreadPool()._processes
 
+# Uploaded files by content hash, shared by the workers of one user on a host.
+# We remove the least recently used files when they take more than
+# UPLOAD_CACHE_NBYTES.  Windows has a temporary directory per user already.
+if hasattr(os, 'getuid'):
+    UPLOAD_CACHE = os.path.join(tempfile.gettempdir(),
+                                'distributed-uploads-%d' % os.getuid())
+else:
+    UPLOAD_CACHE = os.path.join(tempfile.gettempdir(), 'distributed-uploads')
+UPLOAD_CACHE_NBYTES = 1e9
+
+# Concurrent transfers of data from and to peers
+INCOMING_TRANSFERS = 10
+OUTGOING_TRANSFERS = 10
+
+# Most keys to request from one peer in a single get_data call
+FETCH_BATCH = 100
+
 
 logger = logging.getLogger(__name__)
 
 
+def _deserialize(task):
+    """ Load a task serialized by the client, pass through anything else """
+    if isinstance(task, bytes):
+        return loads(task)
+    return task
+
+
 class Worker(Server):
     """ Worker Node
 
@@ -63,21 +94,52 @@ class Worker(Server):
        Start worker at:            127.0.0.1:8788
        Registered with center at:  127.0.0.1:8787
 
+    Workers may declare abstract resources, like the number of GPUs, so that
+    the scheduler only sends them tasks that they can accommodate:
+
+    >>> w = Worker(c.ip, c.port, resources={'GPU': 2})  # doctest: +SKIP
+
+    Workers fetch data from peers on the same host first, then from peers
+    to which they have the fewest transfers in flight, then from the
+    fastest peers seen so far.  They hold at most ``incoming_transfers``
+    connections to peers for data and serve at most ``outgoing_transfers``
+    connections to peers at once, so that a popular key does not saturate
+    one machine.  Concurrent tasks that need data from the same peer share
+    one ``get_data`` request of at most ``fetch_batch`` keys, and share
+    fetches of the same key.
+
     See Also
     --------
     distributed.center.Center:
     """
 
     def __init__(self, center_ip, center_port, ip=None, ncores=None,
-                 loop=None, nanny_port=None, local_dir=None, **kwargs):
+                 loop=None, nanny_port=None, local_dir=None, resources=None,
+                 incoming_transfers=INCOMING_TRANSFERS,
+                 outgoing_transfers=OUTGOING_TRANSFERS, **kwargs):
         self.ip = ip or get_ip()
         self._port = 0
         self.nanny_port = nanny_port
         self.ncores = ncores or _ncores
+        self.resources = resources or {}
         self.data = dict()
         self.loop = loop or IOLoop.current()
         self.status = None
         self.local_dir = local_dir or tempfile.mkdtemp(prefix='worker-')
+        self.upload_cache = UPLOAD_CACHE
+        self.upload_cache_nbytes = UPLOAD_CACHE_NBYTES
+        self.uploads = dict()
+        self.transfers = dict()
+        self.bandwidth = dict()
+        self.incoming = Semaphore(incoming_transfers)
+        self.outgoing = set()
+        self.outgoing_limit = outgoing_transfers
+        self.outgoing_done = Condition()
+        self.fetch_batch = FETCH_BATCH
+        self.fetching = dict()
+        self.fetch_who_has = dict()
+        self.fetch_tried = dict()
+        self.fetch_pending = set()
         self.executor = ThreadPoolExecutor(self.ncores)
         self.center = rpc(ip=center_ip, port=center_port)
 
@@ -89,10 +151,12 @@ class Worker(Server):
 
         handlers = {'compute': self.compute,
                     'get_data': self.get_data,
+                    'gather': self.gather,
                     'update_data': self.update_data,
                     'delete_data': self.delete_data,
                     'terminate': self.terminate,
                     'ping': pingpong,
+                    'relay': self.relay,
                     'upload_file': self.upload_file}
 
         super(Worker, self).__init__(handlers, **kwargs)
@@ -108,7 +172,8 @@ class Worker(Server):
             try:
                 resp = yield self.center.register(
                         ncores=self.ncores, address=(self.ip, self.port),
-                        nanny_port=self.nanny_port, keys=list(self.data))
+                        nanny_port=self.nanny_port, keys=list(self.data),
+                        resources=self.resources)
                 break
             except (OSError, StreamClosedError):
                 logger.debug("Unable to register with center.  Waiting")
@@ -148,8 +213,29 @@ class Worker(Server):
 
     @gen.coroutine
     def compute(self, stream, function=None, key=None, args=(), kwargs={},
-            needed=[], who_has=None, report=True):
-        """ Execute function """
+            needed=[], who_has=None, report=True, task=None, chain=None):
+        """ Execute function
+
+        Alternatively we receive a whole task, usually serialized by the
+        client and passed through the scheduler untouched.  We deserialize and
+        run it.  A ``chain`` of ``(key, task)`` pairs runs first, each result
+        feeding the next, without storing or reporting intermediate results.
+        """
+        if task is not None:
+            try:
+                task = _deserialize(task)
+                chain = [(k, _deserialize(t)) for k, t in chain or ()]
+            except Exception as e:
+                exc_type, exc_value, exc_traceback = sys.exc_info()
+                raise Return((b'error',
+                              (e, traceback.format_tb(exc_traceback))))
+            if chain:
+                function = partial(execute_chain, [k for k, _ in chain])
+                args = tuple(t for _, t in chain) + (task,)
+            else:
+                function, args = execute_task, (task,)
+            kwargs = {}
+
         if needed:
             needed = [n for n in needed if n not in self.data]
         if who_has:
@@ -161,7 +247,7 @@ class Worker(Server):
                 if who_has:
                     logger.info("gather %d keys from peers: %s", len(who_has),
                             str(who_has))
-                    other = yield gather_from_workers(who_has)
+                    other = yield self.gather_from_peers(who_has)
                 elif needed:
                     logger.info("gather %d keys from peers: %s", len(needed),
                             str(needed))
@@ -185,6 +271,7 @@ class Worker(Server):
             job_counter[0] += 1
             i = job_counter[0]
             logger.info("Start job %d: %s - %s", i, funcname(function), key)
+            start = time()
             future = self.executor.submit(function, *args2, **kwargs)
             pc = PeriodicCallback(lambda: logger.debug("future state: %s - %s",
                 key, future._state), 1000)
@@ -204,6 +291,7 @@ class Worker(Server):
             finally:
                 pc.stop()
             result = future.result()
+            duration = time() - start
             logger.info("Finish job %d: %s - %s", i, funcname(function), key)
             self.data[key] = result
             if report:
@@ -212,7 +300,7 @@ class Worker(Server):
                 if not response == b'OK':
                     logger.warn('Could not report results to center: %s',
                                 response.decode())
-            out = (b'OK', {'nbytes': sizeof(result)})
+            out = (b'OK', {'nbytes': sizeof(result), 'duration': duration})
         except Exception as e:
             exc_type, exc_value, exc_traceback = sys.exc_info()
             tb = traceback.format_tb(exc_traceback)
@@ -236,6 +324,46 @@ class Worker(Server):
         info = {'nbytes': {k: sizeof(v) for k, v in data.items()}}
         raise Return((b'OK', info))
 
+    @gen.coroutine
+    def gather(self, stream=None, who_has=None, report=True):
+        """ Copy data from peers into local memory
+
+        ``who_has`` maps keys to the workers from which we may fetch them.
+        This lets the scheduler move and replicate data between workers
+        without it passing through the scheduler.
+        """
+        who_has = {k: v for k, v in who_has.items() if k not in self.data}
+        try:
+            data = yield self.gather_from_peers(who_has)
+        except KeyError as e:
+            logger.warn("Could not find data during gather: %s", e)
+            raise Return((b'missing-data', e))
+        self.data.update(data)
+        if report and data:
+            yield self.center.add_keys(address=(self.ip, self.port),
+                                       keys=list(data))
+        raise Return((b'OK', {'nbytes': {k: sizeof(v)
+                                         for k, v in data.items()}}))
+
+    @gen.coroutine
+    def relay(self, stream=None, msg=None, tree=None):
+        """ Handle a broadcast message, then pass it on to our subtree
+
+        Returns the results of this worker and of every worker below it.
+
+        See Also
+        --------
+        distributed.core.broadcast_to_workers
+        """
+        kwargs = dict(msg)
+        handler = self.handlers[kwargs.pop('op')]
+        result = yield gen.maybe_future(handler(stream, **kwargs))
+        results = {self.address: result}
+        if tree:
+            children = yield relay(tree, msg)
+            results.update(children)
+        raise Return(results)
+
     @gen.coroutine
     def delete_data(self, stream, keys=None, report=True):
         for key in keys:
@@ -248,14 +376,177 @@ class Worker(Server):
                                           keys=keys)
         raise Return(b'OK')
 
-    def get_data(self, stream, keys=None):
-        return {k: self.data[k] for k in keys if k in self.data}
+    @gen.coroutine
+    def gather_from_peers(self, who_has):
+        """ Fetch data from peers, choosing among them by locality and load
+
+        Requests made during the same event loop iteration are combined into
+        one ``get_data`` call per peer, and keys already being fetched for
+        another task are not requested again.  Peers named for a key that is
+        already being fetched are kept as alternatives for that fetch.
+
+        See Also
+        --------
+        distributed.client.gather_from_workers
+        """
+        futures = dict()
+        for key, addresses in who_has.items():
+            if key in self.fetching:
+                self.fetch_who_has[key] |= set(addresses) - \
+                                           self.fetch_tried[key]
+            else:
+                self.fetching[key] = Future()
+                self.fetch_who_has[key] = set(addresses)
+                self.fetch_tried[key] = set()
+                self._queue_fetch(key)
+            futures[key] = self.fetching[key]
+
+        results = dict()
+        missing = []
+        for key, future in futures.items():
+            try:
+                results[key] = yield future
+            except KeyError:
+                missing.append(key)
+        if missing:
+            raise KeyError(*missing)
+        raise Return(results)
+
+    def _queue_fetch(self, key):
+        if not self.fetch_pending:
+            self.loop.add_callback(self._fetch)
+        self.fetch_pending.add(key)
+
+    def _fetch(self):
+        """ Send out pending fetches, grouped by peer
+
+        Each key goes to the best peer that we have not yet tried for it.
+        Keys with no such peer left fail with a ``KeyError``.
+        """
+        keys, self.fetch_pending = self.fetch_pending, set()
+        by_peer = dict()
+        for key in keys:
+            addresses = self.fetch_who_has[key]
+            if not addresses:
+                self._fetch_done(key, exception=KeyError(key))
+                continue
+            addr = pick_source(addresses, self.ip, self.transfers,
+                               self.bandwidth)
+            addresses.remove(addr)
+            self.fetch_tried[key].add(addr)
+            by_peer.setdefault(addr, []).append(key)
+        for addr, keys in by_peer.items():
+            for batch in partition_all(self.fetch_batch, keys):
+                self.loop.add_callback(self._fetch_batch, addr, list(batch))
+
+    @gen.coroutine
+    def _fetch_batch(self, addr, keys):
+        """ Get a batch of keys from one peer
+
+        Keys that the peer does not send back are queued again, so that
+        retries from the same alternative peer share one request.
+        """
+        data = dict()
+        try:
+            data = yield _get_data(addr, keys, self.transfers,
+                                   self.bandwidth, self.incoming,
+                                   who=self.address)
+        except (socket.error, StreamClosedError):
+            logger.info("Lost connection to %s:%d during fetch", *addr)
+        except Exception as e:
+            logger.exception(e)
+        for key in keys:
+            if key in data:
+                self._fetch_done(key, result=data[key])
+            else:
+                self._queue_fetch(key)
+
+    def _fetch_done(self, key, result=None, exception=None):
+        future = self.fetching.pop(key)
+        del self.fetch_who_has[key]
+        del self.fetch_tried[key]
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    @gen.coroutine
+    def get_data(self, stream, keys=None, who=None):
+        """ Serve data to a peer, or to a client or the scheduler
+
+        Requests from a peer worker name it in ``who``.  Each such
+        connection counts as an outgoing transfer until it closes, see
+        ``Worker.handle_stream``.  New ones wait while ``outgoing_limit``
+        transfers are active.  Requests from clients and from the scheduler
+        are served at once.
+        """
+        if who is not None and stream is not None and \
+                stream not in self.outgoing:
+            while len(self.outgoing) >= self.outgoing_limit:
+                yield self.outgoing_done.wait()
+            if not stream.closed():
+                self.outgoing.add(stream)
+        raise Return({k: self.data[k] for k in keys if k in self.data})
 
-    def upload_file(self, stream, filename=None, data=None, load=True):
+    @gen.coroutine
+    def handle_stream(self, stream, address):
+        """ Serve a connection, then end any outgoing transfer on it """
+        try:
+            yield super(Worker, self).handle_stream(stream, address)
+        finally:
+            if stream in self.outgoing:
+                self.outgoing.discard(stream)
+                self.outgoing_done.notify_all()
+
+    def upload_file(self, stream, filename=None, data=None, load=True,
+                    checksum=None):
+        """ Write a file to our local directory and import it
+
+        Given the ``checksum`` of the contents we keep a copy in a cache
+        shared by the workers of this user on this host, which outlives this
+        worker.  Then ``data`` may be omitted.  We return ``None`` if we do
+        not have that content yet, so that the client knows to send it.  We
+        skip writing and reloading a file that has not changed, unless we
+        must now load a file that we did not load before.  The cache
+        keeps at most ``upload_cache_nbytes``, dropping the least recently
+        used files first.
+
+        We only use cached files whose contents match their checksum.  If
+        we can not use the cache at all then we ask for and write the data
+        as though we had no cache.
+        """
         out_filename = os.path.join(self.local_dir, filename)
+        if checksum is not None:
+            if data is not None and md5(data).hexdigest() != checksum:
+                return ValueError("Data of %s does not match checksum %s"
+                                  % (filename, checksum))
+            cached = os.path.join(self.upload_cache, checksum, filename)
+            try:
+                _check_private_dir(self.upload_cache)
+                if data is None:
+                    data = _read_verified(cached, checksum)
+                elif not os.path.exists(cached):
+                    _write_atomic(cached, data)
+                    _trim_cache(self.upload_cache, self.upload_cache_nbytes,
+                                keep=os.path.dirname(cached))
+            except (IOError, OSError) as e:
+                logger.warning("Can not use upload cache %s: %s",
+                               self.upload_cache, e)
+            if data is None:  # not cached, trimmed meanwhile, or corrupt
+                return None
+            # unchanged, and loaded before if we need to load it now
+            if self.uploads.get(filename) in ((checksum, True),
+                                              (checksum, load)):
+                return len(data)
+
+        nbytes = len(data)
         with open(out_filename, 'wb') as f:
             f.write(data)
             f.flush()
+        if checksum is not None:
+            self.uploads[filename] = (checksum, False)
+        else:
+            self.uploads.pop(filename, None)
 
         if load:
             try:
@@ -275,7 +566,83 @@ class Worker(Server):
             except Exception as e:
                 logger.exception(e)
                 return e
-        return len(data)
+            if checksum is not None:
+                self.uploads[filename] = (checksum, True)
+        return nbytes
+
+
+def _check_private_dir(dirname):
+    """ Make a directory that only we may use, or check that one is ours
+
+    Raises ``OSError`` if the directory belongs to another user, who could
+    otherwise plant files in it for us to import.
+    """
+    try:
+        os.makedirs(dirname, 0o700)
+    except OSError:  # another worker on this host made it first
+        pass
+    st = os.lstat(dirname)
+    if not stat.S_ISDIR(st.st_mode):
+        raise OSError("%s is not a directory" % dirname)
+    if hasattr(os, 'getuid') and st.st_uid != os.getuid():
+        raise OSError("%s belongs to another user" % dirname)
+
+
+def _read_verified(filename, checksum):
+    """ Contents of a cached file, or ``None`` if missing or corrupt """
+    try:
+        with open(filename, 'rb') as f:
+            data = f.read()
+        os.utime(filename, None)
+    except (IOError, OSError):
+        return None
+    if md5(data).hexdigest() != checksum:
+        logger.warning("Cached %s does not match checksum %s",
+                       filename, checksum)
+        return None
+    return data
+
+
+def _write_atomic(filename, data):
+    """ Write a file so that readers never see it half written """
+    dirname = os.path.dirname(filename)
+    if not os.path.exists(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:  # another worker on this host made it first
+            pass
+    fd, tmp = tempfile.mkstemp(dir=dirname)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.rename(tmp, filename)
+
+
+def _trim_cache(dirname, nbytes, keep=None):
+    """ Remove least recently used entries of a cache directory
+
+    Each entry is a subdirectory.  We remove whole entries, oldest first by
+    the time their files were last used, until the cache holds at most
+    ``nbytes``.  We never remove ``keep``.  Other workers on this host may
+    trim the same directory at the same time.
+    """
+    entries = []
+    for name in os.listdir(dirname):
+        path = os.path.join(dirname, name)
+        try:
+            files = [os.path.join(path, fn) for fn in os.listdir(path)]
+            size = sum(os.path.getsize(fn) for fn in files)
+            used = max([os.path.getmtime(fn) for fn in files] or [0])
+        except OSError:  # removed by another worker
+            continue
+        entries.append((used, path, size))
+
+    total = sum(size for _, _, size in entries)
+    for used, path, size in sorted(entries):
+        if total <= nbytes:
+            break
+        if path != keep:
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
 
 
 job_counter = [0]